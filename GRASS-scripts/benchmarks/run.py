@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+#  -*- coding:utf-8 -*-
+##############################################################################
+# MODULE:    benchmarks.run
+# AUTHOR(S): Monia Molinari, Marco Minghini
+# PURPOSE:   Time v.osm.precomp, v.osm.preproc and v.osm.acc on synthetic
+#            road networks
+# COPYRIGHT: (C) 2015 by the GRASS Development Team
+#
+# This program is free software under the GNU General Public
+# License (>=v2). Read the file COPYING that comes with GRASS
+# for details.
+# ############################################################################
+"""Benchmarks of the three modules on synthetic networks.
+
+run must be started inside a GRASS session on a projected location. For
+every network and size it imports a REF network and its OSM copy (see
+synthetic), runs the modules of this working tree once for every method
+with the profile option and writes the wall time, the time of every stage
+and the numbers computed to a JSON file named after the git version. The
+numbers of every method are compared with the ones of the first method, so
+faster engines are checked against the overlay one. compare prints the
+speed-up between two result files.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import synthetic
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+
+METHODS = {"precomp": ["overlay", "profile", "memory"],
+           "preproc": ["overlay", "memory"],
+           "acc": ["overlay", "profile", "memory"]}
+
+
+def version():
+    """Return the git version of the working tree"""
+    try:
+        out = subprocess.check_output(["git", "describe", "--always",
+                                       "--dirty"], cwd=SCRIPTS)
+        return out.decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_module(module, options, tmp):
+    """Run the module of the working tree with the profile option and
+    return its wall time and stages"""
+    profile = os.path.join(tmp, "profile.json")
+    script = os.path.join(SCRIPTS, module, module + ".py")
+    args = [sys.executable, script, "--overwrite", "--quiet",
+            "profile=" + profile]
+    args += ["{k}={v}".format(k=k, v=v) for k, v in sorted(options.items())]
+    start = time.time()
+    subprocess.check_call(args)
+    wall = time.time() - start
+    fil = open(profile)
+    stages = json.load(fil)["stages"]
+    fil.close()
+    return round(wall, 3), stages
+
+
+def import_lines(lines, name):
+    import grass.script as grass
+
+    grass.write_command("v.in.ascii", input="-", output=name,
+                        format="standard", flags="n",
+                        stdin=synthetic.ascii_lines(lines), overwrite=True,
+                        quiet=True)
+
+
+def precomp_numbers(tmp):
+    fil = open(os.path.join(tmp, "precomp.json"))
+    data = json.load(fil)
+    fil.close()
+    return [[row[c] for c in ("buffer", "osm_in", "ref_in")]
+            for row in sorted(data["rows"], key=lambda r: r["buffer"])]
+
+
+def preproc_numbers(tmp):
+    for line in open(os.path.join(tmp, "preproc.txt")):
+        if line.startswith("Processed OSM dataset length"):
+            return [float(line.split(": ")[1].split(" ")[0])]
+
+
+def acc_numbers(grid):
+    import grass.script as grass
+
+    data = grass.read_command("v.db.select", map=grid, columns="cat,OSM,TOL",
+                              flags="c", quiet=True)
+    numbers = []
+    for item in data.split("\n")[0:-1]:
+        cat, osm, tol = item.split("|")
+        numbers.append([int(cat)] + [float(v) if v else None
+                                     for v in (osm, tol)])
+    return sorted(numbers)
+
+
+def difference(numbers, other):
+    """Return the largest difference between two lists of numbers"""
+    a = np.array(numbers, dtype=float)
+    b = np.array(other, dtype=float)
+    if a.shape != b.shape:
+        return None
+    both = ~(np.isnan(a) & np.isnan(b))
+    if np.any(np.isnan(a[both]) | np.isnan(b[both])):
+        return None
+    return float(np.abs(a[both] - b[both]).max()) if both.any() else 0.0
+
+
+def run_case(network, size, seed, spacing, methods, tmp):
+    import grass.script as grass
+
+    rng = np.random.RandomState(seed)
+    ref_lines = synthetic.NETWORKS[network](size, spacing, rng)
+    osm_lines, truth = synthetic.derive_osm(ref_lines, rng, spacing=spacing)
+    ref = "bench_ref"
+    osm = "bench_osm"
+    import_lines(ref_lines, ref)
+    import_lines(osm_lines, osm)
+    grass.run_command("g.region", vect="%s,%s" % (ref, osm), quiet=True)
+    region = grass.region()
+
+    case = {"network": network, "size": size, "seed": seed,
+            "segments": synthetic.segment_count(ref_lines), "truth": truth,
+            "runs": []}
+
+    def record(module, method, options, numbers):
+        wall, stages = run_module("v.osm." + module, options, tmp)
+        run = {"module": module, "method": method, "time": wall,
+               "stages": stages, "numbers": numbers()}
+        first = [r for r in case["runs"] if r["module"] == module]
+        if first:
+            run["difference"] = difference(run["numbers"],
+                                           first[0]["numbers"])
+        case["runs"].append(run)
+        print("{ne} {si} {mo} {me}: {ti} s".format(
+            ne=network, si=size, mo=module, me=method, ti=wall))
+
+    for method in methods.get("precomp", []):
+        record("precomp", method,
+               {"osm": osm, "ref": ref, "buffers": "1,2,5,10",
+                "method": method, "output": os.path.join(tmp, "precomp.txt"),
+                "out_data": os.path.join(tmp, "precomp.json"),
+                "data_format": "json"},
+               lambda: precomp_numbers(tmp))
+
+    preproc = "bench_preproc"
+    for method in methods.get("preproc", []):
+        record("preproc", method,
+               {"osm": osm, "ref": ref, "buffer": 5, "angle_thres": 30,
+                "method": method, "output": preproc,
+                "out_file": os.path.join(tmp, "preproc.txt")},
+               lambda: preproc_numbers(tmp))
+
+    if not grass.find_file(name=preproc, element='vector')['file']:
+        preproc = osm
+    box = 5 * spacing
+    for method in methods.get("acc", []):
+        grid = "bench_acc_" + method
+        grass.run_command("g.remove", type="vect", name=grid, flags="f",
+                          quiet=True)
+        record("acc", method,
+               {"osm": preproc, "ref": ref, "output": grid,
+                "ul_grid": "%r,%r" % (region['n'], region['w']),
+                "lr_grid": "%r,%r" % (region['s'], region['e']),
+                "box_grid": "%r,%r" % (box, box), "tol_max": 10,
+                "method": method},
+               lambda: acc_numbers(grid))
+    return case
+
+
+def run(args):
+    methods = {}
+    for module in args.modules.split(","):
+        methods[module] = [m for m in args.methods.split(",")
+                           if m in METHODS[module]]
+    results = {"version": version(), "date": time.strftime("%Y-%m-%d %H:%M"),
+               "python": sys.version.split()[0], "cases": []}
+    tmp = tempfile.mkdtemp()
+    try:
+        for network in args.networks.split(","):
+            for size in [int(s) for s in args.sizes.split(",")]:
+                results["cases"].append(run_case(network, size, args.seed,
+                                                 args.spacing, methods, tmp))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    fileName = os.path.join(args.output, "{ve}_{da}.json".format(
+        ve=results["version"], da=time.strftime("%Y%m%d%H%M%S")))
+    fil = open(fileName, "w")
+    json.dump(results, fil, indent=2, sort_keys=True)
+    fil.write("\n")
+    fil.close()
+    print("Results written to " + fileName)
+
+
+def compare(args):
+    times = []
+    for fileName in (args.old, args.new):
+        fil = open(fileName)
+        data = json.load(fil)
+        fil.close()
+        times.append(dict(((c["network"], c["size"], r["module"],
+                            r["method"]), r["time"])
+                          for c in data["cases"] for r in c["runs"]))
+    for key in sorted(set(times[0]) & set(times[1])):
+        print("{0} {1} {2} {3}: ".format(*key) +
+              "{ol} s -> {ne} s (x{sp})".format(
+                  ol=times[0][key], ne=times[1][key],
+                  sp=round(times[0][key] / max(times[1][key], 1e-3), 2)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    sub = commands.add_parser("run", help="run the benchmarks")
+    sub.add_argument("--networks", default="grid,radial,random",
+                     help="networks separated by comma")
+    sub.add_argument("--sizes", default="1000,10000,100000,1000000",
+                     help="number of REF segments separated by comma")
+    sub.add_argument("--modules", default="precomp,preproc,acc",
+                     help="modules separated by comma")
+    sub.add_argument("--methods", default="overlay,profile,memory",
+                     help="methods separated by comma; the first one of "
+                     "each module is the reference of the others")
+    sub.add_argument("--seed", type=int, default=0)
+    sub.add_argument("--spacing", type=float, default=100.0,
+                     help="distance between the nodes of the networks")
+    sub.add_argument("--output", default=os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), "results"),
+        help="folder of the result files")
+    sub.set_defaults(func=run)
+    sub = commands.add_parser("compare", help="compare two result files")
+    sub.add_argument("old")
+    sub.add_argument("new")
+    sub.set_defaults(func=compare)
+    args = parser.parse_args()
+    args.func(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
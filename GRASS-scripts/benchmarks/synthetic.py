@@ -0,0 +1,146 @@
+#  -*- coding:utf-8 -*-
+##############################################################################
+# MODULE:    benchmarks.synthetic
+# AUTHOR(S): Monia Molinari, Marco Minghini
+# PURPOSE:   Synthetic REF road networks and OSM copies with known errors
+# COPYRIGHT: (C) 2015 by the GRASS Development Team
+#
+# This program is free software under the GNU General Public
+# License (>=v2). Read the file COPYING that comes with GRASS
+# for details.
+# ############################################################################
+"""Synthetic road networks for the benchmarks.
+
+A network is a list of lines, each one a NumPy array of (x, y) vertices.
+The REF generators build a network with about the requested number of
+segments; derive_osm makes an OSM copy of it with positional noise, missing
+and extra roads and a different segmentation, and returns the lengths it
+changed as ground truth.
+"""
+
+import math
+
+import numpy as np
+
+
+def grid_network(n, spacing=100.0, rng=None):
+    """Return a regular grid of streets with about n segments"""
+    k = int(math.ceil(math.sqrt(n / 2.0))) + 1
+    ticks = np.arange(k) * spacing
+    lines = []
+    for t in ticks:
+        lines.append(np.column_stack((ticks, np.repeat(t, k))))
+        lines.append(np.column_stack((np.repeat(t, k), ticks)))
+    return lines
+
+
+def radial_network(n, spacing=100.0, rng=None):
+    """Return spokes and rings around a centre with about n segments"""
+    rings = max(int(math.ceil(math.sqrt(n / 8.0))), 1)
+    spokes = 4 * rings
+    radii = np.arange(1, rings + 1) * spacing
+    angles = np.arange(spokes) * 2 * math.pi / spokes
+    lines = []
+    for a in angles:
+        r = np.concatenate(([0.0], radii))
+        lines.append(np.column_stack((r * math.cos(a), r * math.sin(a))))
+    closed = np.concatenate((angles, [angles[0]]))
+    for r in radii:
+        lines.append(np.column_stack((r * np.cos(closed), r * np.sin(closed))))
+    return lines
+
+
+def random_network(n, spacing=100.0, rng=None):
+    """Return a random planar network with about n segments.
+
+    Nodes are a jittered lattice; every lattice edge is kept with
+    probability 0.8 and a cell gets one of its diagonals with probability
+    0.3, so roads never cross.
+    """
+    rng = rng or np.random.RandomState(0)
+    k = int(math.ceil(math.sqrt(n / 1.9))) + 1
+    nodes = (np.indices((k, k)).transpose(1, 2, 0) * spacing +
+             rng.uniform(-0.2, 0.2, (k, k, 2)) * spacing)
+    lines = []
+    for i in range(k):
+        for j in range(k):
+            if i + 1 < k and rng.uniform() < 0.8:
+                lines.append(np.array([nodes[i, j], nodes[i + 1, j]]))
+            if j + 1 < k and rng.uniform() < 0.8:
+                lines.append(np.array([nodes[i, j], nodes[i, j + 1]]))
+            if i + 1 < k and j + 1 < k and rng.uniform() < 0.3:
+                if rng.uniform() < 0.5:
+                    lines.append(np.array([nodes[i, j], nodes[i + 1, j + 1]]))
+                else:
+                    lines.append(np.array([nodes[i + 1, j], nodes[i, j + 1]]))
+    return lines
+
+
+NETWORKS = {"grid": grid_network, "radial": radial_network,
+            "random": random_network}
+
+
+def line_length(line):
+    return float(np.hypot(*np.diff(line, axis=0).T).sum())
+
+
+def segment_count(lines):
+    return sum(len(line) - 1 for line in lines)
+
+
+def derive_osm(lines, rng=None, noise=1.0, missing=0.05, extra=0.05,
+               split=0.3, densify=0.3, spacing=100.0):
+    """Return an OSM copy of lines and its ground truth.
+
+    Every line is dropped with probability missing; the others get a new
+    vertex in the middle of each segment with probability densify, are cut
+    at an inner vertex with probability split and have every vertex moved
+    by a normal error with standard deviation noise. extra * len(lines)
+    roads not in lines are added. The truth holds the lengths before the
+    noise.
+    """
+    rng = rng or np.random.RandomState(0)
+    osm = []
+    truth = {"ref_length": 0.0, "missing_length": 0.0, "extra_length": 0.0,
+             "noise": noise}
+    for line in lines:
+        length = line_length(line)
+        truth["ref_length"] += length
+        if rng.uniform() < missing:
+            truth["missing_length"] += length
+            continue
+        mid = (line[:-1] + line[1:]) / 2
+        dense = [line[0]]
+        for k in range(len(mid)):
+            if rng.uniform() < densify:
+                dense.append(mid[k])
+            dense.append(line[k + 1])
+        dense = np.array(dense)
+        dense = dense + rng.normal(0, noise, dense.shape)
+        if len(dense) > 2 and rng.uniform() < split:
+            cut = rng.randint(1, len(dense) - 1)
+            osm.extend([dense[:cut + 1], dense[cut:]])
+        else:
+            osm.append(dense)
+    points = np.concatenate(lines)
+    low = points.min(axis=0)
+    high = points.max(axis=0)
+    for k in range(int(round(extra * len(lines)))):
+        start = rng.uniform(low, high)
+        angle = rng.uniform(0, 2 * math.pi)
+        end = start + spacing * np.array([math.cos(angle), math.sin(angle)])
+        road = np.array([start, end])
+        truth["extra_length"] += line_length(road)
+        osm.append(road)
+    return osm, truth
+
+
+def ascii_lines(lines):
+    """Return the lines in the standard format of v.in.ascii, with
+    categories from 1 on"""
+    out = []
+    for cat, line in enumerate(lines, 1):
+        out.append("L  %d 1\n" % len(line))
+        out.extend(" %r %r\n" % (float(x), float(y)) for x, y in line)
+        out.append(" 1 %d\n" % cat)
+    return "".join(out)
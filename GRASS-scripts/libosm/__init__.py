@@ -0,0 +1,12 @@
+#  -*- coding:utf-8 -*-
+##############################################################################
+# LIBRARY:   libosm
+# AUTHOR(S): Monia Molinari, Marco Minghini
+# PURPOSE:   Shared code of the v.osm.precomp, v.osm.preproc and v.osm.acc
+#            modules
+# COPYRIGHT: (C) 2015 by the GRASS Development Team
+#
+# This program is free software under the GNU General Public
+# License (>=v2). Read the file COPYING that comes with GRASS
+# for details.
+# ############################################################################
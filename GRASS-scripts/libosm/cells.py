@@ -0,0 +1,378 @@
+#  -*- coding:utf-8 -*-
+##############################################################################
+# LIBRARY:   libosm.cells
+# AUTHOR(S): Monia Molinari, Marco Minghini
+# PURPOSE:   Lengths and tolerances of line maps by grid cell, in memory
+# COPYRIGHT: (C) 2015 by the GRASS Development Team
+#
+# This program is free software under the GNU General Public
+# License (>=v2). Read the file COPYING that comes with GRASS
+# for details.
+# ############################################################################
+"""Lengths of OSM pieces near REF pieces, cell by cell, in memory.
+
+Pieces are segments tagged with the index of their cell. The part of an OSM
+piece within a distance from the REF pieces is the union of its intervals
+inside their buffers (see libosm.matcher), so the covered length is exact
+and every cell is computed at once with NumPy.
+"""
+
+import hashlib
+import math
+
+import numpy as np
+
+from libosm.matcher import buffer_intervals, candidates
+from libosm.segments import GridIndex
+
+
+def lattice_pieces(coords, west, north, ewres, nsres, rows, cols):
+    """Split the segments at the edges of a regular grid.
+
+    Return the pieces inside the grid and the cell of every piece, numbered
+    as row * cols + col with rows counted from north.
+    """
+    pieces = []
+    cells = []
+    for x1, y1, x2, y2 in coords.tolist():
+        dx = x2 - x1
+        dy = y2 - y1
+        ts = [0.0, 1.0]
+        if dx != 0:
+            c_a, c_b = sorted(((x1 - west) / ewres, (x2 - west) / ewres))
+            for c in range(int(math.floor(c_a)) + 1, int(math.ceil(c_b))):
+                ts.append((west + c * ewres - x1) / dx)
+        if dy != 0:
+            r_a, r_b = sorted(((north - y1) / nsres, (north - y2) / nsres))
+            for r in range(int(math.floor(r_a)) + 1, int(math.ceil(r_b))):
+                ts.append((north - r * nsres - y1) / dy)
+        ts.sort()
+        for t0, t1 in zip(ts[:-1], ts[1:]):
+            if t1 <= t0:
+                continue
+            tm = (t0 + t1) / 2
+            col = int(math.floor((x1 + tm * dx - west) / ewres))
+            row = int(math.floor((north - y1 - tm * dy) / nsres))
+            if 0 <= row < rows and 0 <= col < cols:
+                pieces.append((x1 + t0 * dx, y1 + t0 * dy,
+                               x1 + t1 * dx, y1 + t1 * dy))
+                cells.append(row * cols + col)
+    return (np.array(pieces, dtype=float).reshape((-1, 4)),
+            np.array(cells, dtype=int))
+
+
+def lengths(coords):
+    """Return the length of the segments"""
+    return np.hypot(coords[:, 2] - coords[:, 0], coords[:, 3] - coords[:, 1])
+
+
+def cell_lengths(coords, cells, ncell):
+    """Return the length of the segments in every cell"""
+    return np.bincount(cells, weights=lengths(coords), minlength=ncell)
+
+
+def pairs(osm, ref, dmax, osm_cell=None, ref_cell=None):
+    """Return the pairs of osm and ref segments closer than dmax, only
+    between segments of the same cell if the cells are given"""
+    if len(osm) == 0 or len(ref) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int)
+    i_osm, i_ref = candidates(GridIndex(ref), osm, dmax)
+    if osm_cell is not None:
+        same = osm_cell[i_osm] == ref_cell[i_ref]
+        i_osm = i_osm[same]
+        i_ref = i_ref[same]
+    return i_osm, i_ref
+
+
+def covered(osm, ref, i_osm, i_ref, dist):
+    """Return the length of every osm segment within dist of the ref
+    segments paired with it; dist may vary by pair"""
+    if len(i_osm) == 0:
+        return np.zeros(len(osm))
+    t_min, t_max = buffer_intervals(ref[i_ref], osm[i_osm], dist,
+                                    np.zeros(len(i_osm), dtype=bool))
+    inside = t_max > t_min
+    seg = i_osm[inside]
+    # Intervals of different segments are moved apart by 2, so a single
+    # sweep merges the overlapping intervals of each segment
+    start = 2 * seg + t_min[inside]
+    end = 2 * seg + t_max[inside]
+    order = np.argsort(start, kind='mergesort')
+    seg = seg[order]
+    start = start[order]
+    end = end[order]
+    reached = np.concatenate(([-np.inf], np.maximum.accumulate(end)[:-1]))
+    part = np.maximum(end - np.maximum(start, reached), 0)
+    return np.bincount(seg, weights=part, minlength=len(osm)) * lengths(osm)
+
+
+def clip_boxes(coords, boxes):
+    """Clip every segment with its box (west, south, east, north).
+
+    Return the clipped segments and a boolean array telling which ones
+    are not empty.
+    """
+    x1, y1, x2, y2 = coords[:, 0], coords[:, 1], coords[:, 2], coords[:, 3]
+    dx = x2 - x1
+    dy = y2 - y1
+    t_min = np.zeros(len(coords))
+    t_max = np.ones(len(coords))
+    for a, d, low, high in ((x1, dx, boxes[:, 0], boxes[:, 2]),
+                            (y1, dy, boxes[:, 1], boxes[:, 3])):
+        flat = d == 0
+        div = np.where(flat, 1, d)
+        t1 = (low - a) / div
+        t2 = (high - a) / div
+        inside = (a >= low) & (a <= high)
+        t_min = np.maximum(t_min, np.where(flat, np.where(inside, 0, 2),
+                                           np.minimum(t1, t2)))
+        t_max = np.minimum(t_max, np.where(flat, np.where(inside, 1, -1),
+                                           np.maximum(t1, t2)))
+    clipped = np.column_stack((x1 + t_min * dx, y1 + t_min * dy,
+                               x1 + t_max * dx, y1 + t_max * dy))
+    return clipped, t_max > t_min
+
+
+def _point_distance(px, py, ref):
+    """Return the distance of every point from its paired ref segment"""
+    ax, ay = ref[:, 0], ref[:, 1]
+    ex = ref[:, 2] - ax
+    ey = ref[:, 3] - ay
+    l2 = ex * ex + ey * ey
+    u = np.clip(((px - ax) * ex + (py - ay) * ey) / np.where(l2 > 0, l2, 1),
+                0, 1)
+    return np.hypot(ax + u * ex - px, ay + u * ey - py)
+
+
+def segment_distance(osm, ref):
+    """Return the smallest distance between paired osm and ref segments and
+    the parameter along the osm segments where it is reached"""
+    px, py = osm[:, 0], osm[:, 1]
+    dx = osm[:, 2] - px
+    dy = osm[:, 3] - py
+    l2 = dx * dx + dy * dy
+    l2 = np.where(l2 > 0, l2, 1)
+    # Segments that don't cross are closest at one of the four ends
+    dists = [_point_distance(px, py, ref),
+             _point_distance(osm[:, 2], osm[:, 3], ref)]
+    params = [np.zeros(len(osm)), np.ones(len(osm))]
+    for cx, cy in ((ref[:, 0], ref[:, 1]), (ref[:, 2], ref[:, 3])):
+        t = np.clip(((cx - px) * dx + (cy - py) * dy) / l2, 0, 1)
+        dists.append(np.hypot(px + t * dx - cx, py + t * dy - cy))
+        params.append(t)
+    ex = ref[:, 2] - ref[:, 0]
+    ey = ref[:, 3] - ref[:, 1]
+    den = dx * ey - dy * ex
+    div = np.where(den != 0, den, 1)
+    t = ((ref[:, 0] - px) * ey - (ref[:, 1] - py) * ex) / div
+    u = ((ref[:, 0] - px) * dy - (ref[:, 1] - py) * dx) / div
+    cross = (den != 0) & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+    dists.append(np.where(cross, 0.0, np.inf))
+    params.append(np.clip(t, 0, 1))
+    dists = np.array(dists)
+    best = np.argmin(dists, axis=0)
+    cols = np.arange(len(osm))
+    return dists[best, cols], np.array(params)[best, cols]
+
+
+def _first_reached(cells, x, d_slope, jump, target):
+    """Return the smallest x where the piecewise linear length of every
+    cell reaches its target, inf where it doesn't.
+
+    Events are sorted by cell and x; the slope of the length changes by
+    d_slope and the length steps up by jump at every event.
+    """
+    ncell = len(target)
+    result = np.repeat(np.inf, ncell)
+    if len(cells) == 0:
+        return result
+    first = np.flatnonzero(np.concatenate(([True], cells[1:] != cells[:-1])))
+    group = np.cumsum(np.concatenate(([0], (cells[1:] != cells[:-1]))))
+    cum = np.cumsum(d_slope)
+    slope = np.maximum(cum - (cum[first] - d_slope[first])[group], 0)
+    last = np.concatenate((cells[1:] != cells[:-1], [True]))
+    width = np.where(last, 0, np.diff(np.append(x, x[-1])))
+    inc = jump + slope * width
+    cum = np.cumsum(inc)
+    after = cum - (cum[first] - inc[first])[group] - slope * width
+    goal = target[cells]
+    found = np.where(after >= goal, x, np.inf)
+    # Within the run up to the next event
+    ramp = ~last & (after + slope * width >= goal) & (slope > 0)
+    found = np.where(ramp & np.isinf(found),
+                     x + (goal - after) / np.where(slope > 0, slope, 1),
+                     found)
+    result[cells[first]] = np.minimum.reduceat(found, first)
+    return result
+
+
+def _breaks(osm, ref, t_near):
+    """Return the parameters along the paired osm segments where the
+    distance from the ref segment is smallest or stops being linear"""
+    px, py = osm[:, 0], osm[:, 1]
+    dx = osm[:, 2] - px
+    dy = osm[:, 3] - py
+    ex = ref[:, 2] - ref[:, 0]
+    ey = ref[:, 3] - ref[:, 1]
+    den = dx * ex + dy * ey
+    div = np.where(den != 0, den, 1)
+    params = [t_near]
+    for cx, cy in ((ref[:, 0], ref[:, 1]), (ref[:, 2], ref[:, 3])):
+        params.append(np.where(den != 0, ((cx - px) * ex + (cy - py) * ey) /
+                               div, 0))
+    return np.clip(np.array(params), 0, 1)
+
+
+def _at(coords, seg, par):
+    """Return the points at the parameters par along the segments seg"""
+    return (coords[seg, 0] + par * (coords[seg, 2] - coords[seg, 0]),
+            coords[seg, 1] + par * (coords[seg, 3] - coords[seg, 1]))
+
+
+def _nearest_ref(osm, i_osm, ref, seg, par):
+    """Return the distance of the points at par along the osm segments seg
+    from the nearest ref segment paired with them, and its position.
+
+    i_osm is sorted and every segment of seg has at least one pair.
+    """
+    start = np.searchsorted(i_osm, seg, 'left')
+    count = np.searchsorted(i_osm, seg, 'right') - start
+    point = np.repeat(np.arange(len(seg)), count)
+    first = np.cumsum(count) - count
+    pair = start[point] + np.arange(len(point)) - np.repeat(first, count)
+    if len(point) == 0:
+        return np.zeros(0), np.zeros(0, dtype=int)
+    x, y = _at(osm, seg, par)
+    dist = _point_distance(x[point], y[point], ref[pair])
+    best = np.minimum.reduceat(dist, first)
+    # First pair of every point at the smallest distance
+    at_best = np.flatnonzero(dist == best[point])
+    first_best = at_best[np.unique(point[at_best], return_index=True)[1]]
+    return best, pair[first_best]
+
+
+def cell_tolerance(osm, osm_cell, ref, boxes, target, tol_max,
+                   precision=1e-4):
+    """Return the smallest distance from ref within which every cell has the
+    target length of osm, or NaN where tol_max is not enough.
+
+    ref segments are clipped with the box of each cell before measuring the
+    distances. Every osm segment is split in parts where its distance from
+    ref changes linearly, within precision: first where the distance from
+    one of the ref segments is smallest or stops being linear, or where the
+    nearest ref segment changes, then in halves where the distance is
+    curved. The distance of all the cells is then read at once from the
+    lengths of the parts sorted by distance.
+    """
+    i_osm, i_ref = pairs(osm, ref, tol_max)
+    ref_box, inside = clip_boxes(ref[i_ref], boxes[osm_cell[i_osm]])
+    order = np.argsort(i_osm[inside], kind='mergesort')
+    ref_box = ref_box[inside][order]
+    i_osm = i_osm[inside][order]
+    # Lengths are summed in different orders
+    target = np.asarray(target, dtype=float) * (1 - 1e-9)
+    if len(i_osm) == 0:
+        return np.where(target <= 0, 0.0, np.nan)
+
+    # Ends of the parts of every osm segment
+    t_near = segment_distance(osm[i_osm], ref_box)[1]
+    segs = np.unique(i_osm)
+    seg = np.concatenate((segs, segs, np.tile(i_osm, 3)))
+    par = np.concatenate((np.zeros(len(segs)), np.ones(len(segs)),
+                          _breaks(osm[i_osm], ref_box, t_near).ravel()))
+    order = np.lexsort((par, seg))
+    seg = seg[order]
+    par = par[order]
+    new = np.concatenate(([True], (seg[1:] != seg[:-1]) |
+                          (par[1:] != par[:-1])))
+    seg = seg[new]
+    par = par[new]
+
+    # Where two ref segments are nearest to the ends of a part, the part is
+    # split again where their distances cross
+    dist, near = _nearest_ref(osm, i_osm, ref_box, seg, par)
+    a = np.flatnonzero((seg[1:] == seg[:-1]) & (near[1:] != near[:-1]))
+    b = a + 1
+    f = [_point_distance(*(_at(osm, seg[e], par[e]) + (ref_box[near[r]],)))
+         for e in (a, b) for r in (a, b)]
+    den = (f[2] - f[0]) - (f[3] - f[1])
+    cross = (f[1] - f[0]) / np.where(den != 0, den, 1)
+    ok = (den != 0) & (cross > 0) & (cross < 1)
+    seg = np.concatenate((seg, seg[a][ok]))
+    par = np.concatenate((par, par[a][ok] + cross[ok] * (par[b] - par[a])[ok]))
+    order = np.lexsort((par, seg))
+    seg = seg[order]
+    par = par[order]
+    dist = _nearest_ref(osm, i_osm, ref_box, seg, par)[0]
+
+    # Parts are halved until their middle is within precision of the mean
+    # distance of their ends
+    a = np.flatnonzero(seg[1:] == seg[:-1])
+    todo = [seg[a], par[a], par[a + 1], dist[a], dist[a + 1]]
+    parts = []
+    while len(todo[0]) > 0:
+        p_seg, p_start, p_end, d_start, d_end = todo
+        p_mid = (p_start + p_end) / 2
+        d_mid = _nearest_ref(osm, i_osm, ref_box, p_seg, p_mid)[0]
+        split = ((np.abs(d_mid - (d_start + d_end) / 2) > precision) &
+                 (np.minimum(d_start, d_end) <= tol_max))
+        parts.append([item[~split] for item in todo])
+        todo = [np.tile(p_seg[split], 2),
+                np.concatenate((p_start[split], p_mid[split])),
+                np.concatenate((p_mid[split], p_end[split])),
+                np.concatenate((d_start[split], d_mid[split])),
+                np.concatenate((d_mid[split], d_end[split]))]
+    p_seg, p_start, p_end, d_start, d_end = [np.concatenate(item)
+                                             for item in zip(*parts)]
+
+    # The slope of the length changes at the distances of the ends of the
+    # parts, or the length steps up where they are equal
+    low = np.minimum(d_start, d_end)
+    high = np.maximum(d_start, d_end)
+    part = (p_end - p_start) * lengths(osm)[p_seg]
+    cells = osm_cell[p_seg]
+    keep = low <= tol_max
+    low, high, part, cells = low[keep], high[keep], part[keep], cells[keep]
+    ramp = high > low
+    slope = part / np.where(ramp, high - low, 1)
+    cells = np.concatenate((cells, cells[ramp]))
+    x = np.concatenate((low, high[ramp]))
+    d_slope = np.concatenate((np.where(ramp, slope, 0), -slope[ramp]))
+    jump = np.concatenate((np.where(ramp, 0, part), np.zeros(ramp.sum())))
+    order = np.lexsort((x, cells))
+    tol = _first_reached(cells[order], x[order], d_slope[order],
+                         jump[order], target)
+    tol = np.where(target <= 0, 0.0, tol)
+    return np.where(tol <= tol_max, tol, np.nan)
+
+
+def cell_fingerprints(layers, salt=""):
+    """Return a hex digest of the geometry inside every cell.
+
+    layers is a sequence of (coords, boxes) pairs, with one box (west, south,
+    east, north) for each cell; the segments of every layer are clipped with
+    the box of the cell. Coordinates are rounded to 6 decimals and segments
+    are oriented and sorted, so the digest depends neither on the order of
+    the lines nor on their direction. salt goes into every digest.
+    """
+    indexes = [GridIndex(coords) for coords, boxes in layers]
+    digests = []
+    for k in range(len(layers[0][1]) if layers else 0):
+        digest = hashlib.md5(salt.encode("utf-8"))
+        for (coords, boxes), index in zip(layers, indexes):
+            box = np.asarray(boxes[k], dtype=float)
+            found = index.query(*box)
+            clipped, inside = clip_boxes(coords[found],
+                                         np.tile(box, (len(found), 1)))
+            # Adding 0.0 turns -0.0 into 0.0
+            clipped = np.round(clipped[inside], 6) + 0.0
+            swap = ((clipped[:, 0] > clipped[:, 2]) |
+                    ((clipped[:, 0] == clipped[:, 2]) &
+                     (clipped[:, 1] > clipped[:, 3])))
+            clipped[swap] = clipped[swap][:, [2, 3, 0, 1]]
+            clipped = clipped[np.lexsort(clipped.T[::-1])]
+            digest.update(box.tobytes())
+            digest.update(np.array([len(clipped)], dtype=np.int64).tobytes())
+            digest.update(np.ascontiguousarray(clipped).tobytes())
+        digests.append(digest.hexdigest())
+    return digests
@@ -0,0 +1,100 @@
+#  -*- coding:utf-8 -*-
+##############################################################################
+# LIBRARY:   libosm.dag
+# AUTHOR(S): Monia Molinari, Marco Minghini
+# PURPOSE:   Concurrent execution of GRASS commands with dependencies
+# COPYRIGHT: (C) 2015 by the GRASS Development Team
+#
+# This program is free software under the GNU General Public
+# License (>=v2). Read the file COPYING that comes with GRASS
+# for details.
+# ############################################################################
+"""Graph of GRASS steps run concurrently where dependencies allow.
+
+Steps are added to a Graph with the names of the steps they depend on; run()
+starts every step as soon as its dependencies are done, keeping at most cap
+steps running. Each step runs in a thread which mostly waits for its GRASS
+module, so the modules themselves run in parallel.
+"""
+
+import threading
+
+import grass.script as grass
+
+
+class Graph(object):
+    """Steps with their dependencies"""
+
+    def __init__(self):
+        self.steps = []
+        self.funcs = {}
+
+    def add(self, name, func, args=(), after=()):
+        """Add the step name calling func(*args) after the steps in after"""
+        if name in self.funcs:
+            raise ValueError("Step <{st}> already defined".format(st=name))
+        self.steps.append((name, tuple(after)))
+        self.funcs[name] = (func, args)
+
+    def command(self, name, prog, after=(), **kwargs):
+        """Add the step name running the GRASS module prog"""
+        self.add(name, lambda: grass.run_command(prog, **kwargs),
+                 after=after)
+
+    def run(self, cap=2):
+        """Run all the steps and return their results by name.
+
+        The first error raised by a step is raised again once the running
+        steps are over; the steps not yet started are skipped.
+        """
+        for name, after in self.steps:
+            for dep in after:
+                if dep not in self.funcs:
+                    raise ValueError("Step <{st}> depends on unknown step "
+                                     "<{de}>".format(st=name, de=dep))
+        results = {}
+        errors = []
+        finished = []
+        started = set()
+        running = [0]
+        cond = threading.Condition()
+
+        def worker(name):
+            func, args = self.funcs[name]
+            try:
+                result = func(*args)
+            except BaseException as e:
+                result = None
+                errors.append(e)
+            cond.acquire()
+            results[name] = result
+            finished.append(name)
+            running[0] -= 1
+            cond.notify()
+            cond.release()
+
+        cond.acquire()
+        try:
+            while True:
+                if not errors:
+                    for name, after in self.steps:
+                        if running[0] >= max(cap, 1):
+                            break
+                        if name not in started and all(dep in results
+                                                       for dep in after):
+                            started.add(name)
+                            running[0] += 1
+                            thread = threading.Thread(target=worker,
+                                                      args=(name,))
+                            thread.daemon = True
+                            thread.start()
+                if running[0] == 0:
+                    break
+                cond.wait()
+        finally:
+            cond.release()
+        if errors:
+            raise errors[0]
+        if len(results) < len(self.steps):
+            raise ValueError("Dependency cycle among the steps")
+        return results
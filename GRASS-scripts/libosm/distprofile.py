@@ -0,0 +1,223 @@
+#  -*- coding:utf-8 -*-
+##############################################################################
+# LIBRARY:   libosm.distprofile
+# AUTHOR(S): Monia Molinari, Marco Minghini
+# PURPOSE:   Distance profiles of line maps with respect to other line maps
+# COPYRIGHT: (C) 2015 by the GRASS Development Team
+#
+# This program is free software under the GNU General Public
+# License (>=v2). Read the file COPYING that comes with GRASS
+# for details.
+# ############################################################################
+"""Distance profiles of line maps.
+
+A distance profile tells how much of a line map lies within any distance
+from another line map: it is computed once with v.split and v.distance and
+then read for every distance with a binary search, instead of buffering and
+overlaying the maps for each distance.
+
+Every piece of the split map is measured twice: v.distance gives its
+smallest distance from the other map and the largest distance of its
+vertices bounds the others. Within these two distances the length of the
+piece is counted as if the distance changed linearly along it, which is
+exact for straight pieces moving away from a straight line. Otherwise only
+the pieces crossing the distance can be miscounted, by at most their
+length, so the error is bounded by the split step for every crossing.
+"""
+
+from bisect import bisect_left, bisect_right
+
+
+def make_profile(pieces, total):
+    """Return the distance profile of pieces.
+
+    pieces are tuples (low, high, length) with the smallest and the largest
+    distance of every piece. The profile is a tuple with the distances and
+    the length within each of them, where the length changes linearly from
+    one distance to the next and steps up where a distance is repeated,
+    and the total length, including the pieces left out of pieces.
+    """
+    events = {}
+    for low, high, length in pieces:
+        event = events.setdefault(low, [0.0, 0.0])
+        if high > low:
+            event[0] += length / (high - low)
+            events.setdefault(high, [0.0, 0.0])[0] -= length / (high - low)
+        else:
+            event[1] += length
+    dists = []
+    cum_length = []
+    value = 0.0
+    slope = 0.0
+    for dist in sorted(events):
+        if dists:
+            value = max(value, value + slope * (dist - dists[-1]))
+        d_slope, jump = events[dist]
+        dists.append(dist)
+        cum_length.append(value)
+        if jump > 0:
+            value += jump
+            dists.append(dist)
+            cum_length.append(value)
+        slope += d_slope
+    return (dists, cum_length, total)
+
+
+def _nearest(data, layer, ftype, other, dmax, column, g_data, g_other):
+    """Return the distance of the features of data in g_data from the
+    nearest feature of other within dmax, of the same group with column"""
+    import grass.script as grass
+
+    if column:
+        dist_data = grass.read_command("v.distance", from_=data,
+                                       from_layer=layer, from_type=ftype,
+                                       to=other, to_type="line",
+                                       upload="cat,dist", dmax=dmax,
+                                       flags="pa", quiet=True)
+    else:
+        dist_data = grass.read_command("v.distance", from_=data,
+                                       from_layer=layer, from_type=ftype,
+                                       to=other, to_type="line",
+                                       upload="dist", dmax=dmax, flags="p",
+                                       quiet=True)
+    dists = {}
+    for item in dist_data.split("\n")[1:-1]:
+        values = item.split("|")
+        cat, val = values[0], values[-1]
+        if cat not in g_data or len(val) == 0:
+            continue
+        if column and g_other.get(values[1]) != g_data[cat]:
+            continue
+        if cat not in dists or float(val) < dists[cat]:
+            dists[cat] = float(val)
+    return dists
+
+
+def get_profile(data, other, step, dmax, processid):
+    """Return the distance profile of data with respect to other.
+
+    data is split in pieces not longer than step and the distance of every
+    piece and of its vertices from the nearest feature of other is computed
+    with v.distance (see make_profile); pieces farther than dmax are only
+    counted in the total length.
+    """
+    return get_profiles(data, other, step, dmax, processid)[None]
+
+
+def get_profiles(data, other, step, dmax, processid, column=None):
+    """Return the distance profiles of data with respect to other by group.
+
+    Without column the result has a single profile with key None. With
+    column the features of data and other are grouped by the value of the
+    column in their attribute table and the distances are measured only
+    between features of the same group, giving one profile for each group
+    of data.
+    """
+    import grass.script as grass
+
+    name = data.split('@')[0]
+    split = "prof_split_{idd}_{st}".format(idd=processid, st=name)
+    pieces = "prof_pieces_{idd}_{st}".format(idd=processid, st=name)
+    points = "prof_points_{idd}_{st}".format(idd=processid, st=name)
+    grass.run_command("v.split", input=data, output=split, length=step,
+                      overwrite=True, quiet=True)
+    grass.run_command("v.category", input=split, output=pieces, layer=2,
+                      option="add", type="line", overwrite=True, quiet=True)
+
+    # Length of every piece
+    l_pieces = {}
+    length_data = grass.read_command("v.to.db", map=pieces, layer=2,
+                                     type="line", option="length", flags="p",
+                                     quiet=True)
+    for item in length_data.split("\n")[1:-1]:
+        cat, val = item.split("|")[0:2]
+        l_pieces[cat] = float(val)
+
+    # Group of every piece and of every feature of other
+    g_pieces = dict.fromkeys(l_pieces)
+    g_other = {}
+    if column:
+        group_data = grass.read_command("v.to.db", map=pieces, layer=2,
+                                        type="line", option="query",
+                                        query_layer=1, query_column=column,
+                                        flags="p", quiet=True)
+        for item in group_data.split("\n")[1:-1]:
+            cat, val = item.split("|")[0:2]
+            g_pieces[cat] = val
+        group_data = grass.read_command("v.db.select", map=other,
+                                        columns="cat,{st}".format(st=column),
+                                        flags="c", quiet=True)
+        for item in group_data.split("\n")[0:-1]:
+            cat, val = item.split("|")[0:2]
+            g_other[cat] = val
+
+    # Distance of every piece from the nearest feature of other
+    d_pieces = _nearest(pieces, 2, "line", other, dmax, column, g_pieces,
+                        g_other)
+
+    # Largest distance of the vertices of the pieces within dmax, which
+    # can't be farther than dmax + step
+    grass.run_command("v.to.points", input=pieces, layer=2, type="line",
+                      output=points, use="vertex", overwrite=True,
+                      quiet=True)
+    p_pieces = {}
+    point_data = grass.read_command("v.db.select", map=points, layer=2,
+                                    columns="cat,lcat", flags="c", quiet=True)
+    for item in point_data.split("\n")[0:-1]:
+        cat, lcat = item.split("|")[0:2]
+        if lcat in d_pieces:
+            p_pieces[cat] = lcat
+    d_points = _nearest(points, 2, "point", other, dmax + step, column,
+                        dict((c, g_pieces[l]) for c, l in p_pieces.items()),
+                        g_other)
+    h_pieces = dict(d_pieces)
+    for cat, lcat in p_pieces.items():
+        h_pieces[lcat] = max(h_pieces[lcat], d_points.get(cat, dmax + step))
+
+    groups = {}
+    totals = {}
+    if not column:
+        groups[None] = []
+        totals[None] = 0
+    for cat, piece in l_pieces.items():
+        groups.setdefault(g_pieces[cat], [])
+        totals[g_pieces[cat]] = totals.get(g_pieces[cat], 0) + piece
+    for cat, low in d_pieces.items():
+        high = min(h_pieces[cat], low + l_pieces[cat])
+        groups[g_pieces[cat]].append((low, high, l_pieces[cat]))
+
+    grass.run_command("g.remove", type="vect", flags="f", quiet=True,
+                      name="{sp},{pi},{po}".format(sp=split, pi=pieces,
+                                                   po=points))
+
+    return dict((group, make_profile(groups[group], totals[group]))
+                for group in groups)
+
+
+def profile_length(profile, buff):
+    """Return the length within buff and the total length of a profile"""
+    dists, cum_length, total = profile
+    idx = bisect_right(dists, buff)
+    if idx == 0:
+        return (0, total)
+    if idx == len(dists):
+        return (cum_length[-1], total)
+    d0, d1 = dists[idx - 1], dists[idx]
+    c0, c1 = cum_length[idx - 1], cum_length[idx]
+    return (c0 + (c1 - c0) * (buff - d0) / (d1 - d0), total)
+
+
+def profile_distance(profile, value):
+    """Return the smallest distance within which the profile reaches the
+    length value, or None if it doesn't reach it within its distances"""
+    dists, cum_length, total = profile
+    # Cumulative lengths are summed in another order than the total
+    value = value * (1 - 1e-9)
+    idx = bisect_left(cum_length, value)
+    if idx == len(dists):
+        return None
+    if idx == 0 or dists[idx] == dists[idx - 1]:
+        return dists[idx]
+    d0, d1 = dists[idx - 1], dists[idx]
+    c0, c1 = cum_length[idx - 1], cum_length[idx]
+    return d0 + (d1 - d0) * (value - c0) / (c1 - c0)
@@ -0,0 +1,422 @@
+#  -*- coding:utf-8 -*-
+##############################################################################
+# LIBRARY:   libosm.engine
+# AUTHOR(S): Monia Molinari, Marco Minghini
+# PURPOSE:   Comparison of OSM and reference line files without GRASS
+# COPYRIGHT: (C) 2015 by the GRASS Development Team
+#
+# This program is free software under the GNU General Public
+# License (>=v2). Read the file COPYING that comes with GRASS
+# for details.
+# ############################################################################
+"""The three comparison steps on line files, without a GRASS session.
+
+buffer_stats, match_pieces and grid_accuracy compute in memory the
+statistics of v.osm.precomp, the matched OSM pieces of v.osm.preproc and the
+cell values of v.osm.acc from arrays of segments (see libosm.segments);
+the memory methods of v.osm.precomp and v.osm.acc call the same functions.
+read_lines and write_lines move the segments from and to GeoPackage or
+Shapefile layers with the GDAL/OGR bindings, which are only needed by them.
+The module can be run from the GRASS-scripts directory:
+
+    python -m libosm.engine precomp osm.gpkg ref.gpkg --buffers 5,10,20 --output precomp.txt
+    python -m libosm.engine preproc osm.gpkg ref.gpkg --buffer 10 --angle-thres 30 --output preproc.gpkg
+    python -m libosm.engine acc osm.gpkg ref.gpkg --ul 1000,0 --lr 0,1000 --box 100,100 --tol-max 20 --output acc.gpkg
+"""
+
+import argparse
+import math
+import os
+import sys
+
+import numpy as np
+
+from libosm.cells import (cell_lengths, cell_tolerance, covered,
+                          lattice_pieces, lengths, pairs)
+from libosm.matcher import match
+from libosm.segments import min_degree
+
+DRIVERS = {".gpkg": "GPKG", ".shp": "ESRI Shapefile"}
+
+
+def _ogr():
+    try:
+        from osgeo import ogr
+    except ImportError:
+        raise ImportError("GDAL/OGR Python bindings are required to read "
+                          "and write files")
+    return ogr
+
+
+def _layer(source, path, layer):
+    lyr = source.GetLayerByName(layer) if layer else source.GetLayer(0)
+    if lyr is None:
+        raise IOError("Layer <%s> not found in <%s>" % (layer or 0, path))
+    return lyr
+
+
+def read_lines(path, layer=None):
+    """Return the segments of the lines of a layer of path and its spatial
+    reference; without layer the first one is read"""
+    ogr = _ogr()
+    source = ogr.Open(path)
+    if source is None:
+        raise IOError("Unable to open <%s>" % path)
+    lyr = _layer(source, path, layer)
+    coords = []
+    for feature in lyr:
+        geom = feature.GetGeometryRef()
+        if geom is None:
+            continue
+        if geom.GetGeometryName() == "MULTILINESTRING":
+            parts = [geom.GetGeometryRef(k)
+                     for k in range(geom.GetGeometryCount())]
+        elif geom.GetGeometryName() == "LINESTRING":
+            parts = [geom]
+        else:
+            continue
+        for part in parts:
+            pts = part.GetPoints() or []
+            for p1, p2 in zip(pts[:-1], pts[1:]):
+                coords.append((p1[0], p1[1], p2[0], p2[1]))
+    srs = lyr.GetSpatialRef()
+    srs = srs.Clone() if srs is not None else None
+    return np.array(coords, dtype=float).reshape((-1, 4)), srs
+
+
+def _create(path, srs, geom_type):
+    ogr = _ogr()
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in DRIVERS:
+        raise IOError("Unknown format of <%s>, use one of %s" %
+                      (path, ", ".join(sorted(DRIVERS))))
+    driver = ogr.GetDriverByName(DRIVERS[ext])
+    if os.path.exists(path):
+        driver.DeleteDataSource(path)
+    source = driver.CreateDataSource(path)
+    name = os.path.splitext(os.path.basename(path))[0]
+    return source, source.CreateLayer(name, srs, geom_type)
+
+
+def write_lines(path, coords, srs=None):
+    """Write the segments to a new line layer named after path"""
+    ogr = _ogr()
+    source, lyr = _create(path, srs, ogr.wkbLineString)
+    for x1, y1, x2, y2 in coords.tolist():
+        geom = ogr.Geometry(ogr.wkbLineString)
+        geom.AddPoint_2D(x1, y1)
+        geom.AddPoint_2D(x2, y2)
+        feature = ogr.Feature(lyr.GetLayerDefn())
+        feature.SetGeometry(geom)
+        lyr.CreateFeature(feature)
+    source.SyncToDisk()
+
+
+def write_cells(path, cells, boxes, columns, values, srs=None):
+    """Write the boxes (west, south, east, north) to a new polygon layer
+    named after path, with the cell number and the columns of values"""
+    ogr = _ogr()
+    source, lyr = _create(path, srs, ogr.wkbPolygon)
+    lyr.CreateField(ogr.FieldDefn("cell", ogr.OFTInteger))
+    for column in columns:
+        lyr.CreateField(ogr.FieldDefn(column, ogr.OFTReal))
+    for cell, (w, s, e, n), row in zip(cells, boxes, values):
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for x, y in ((w, s), (w, n), (e, n), (e, s), (w, s)):
+            ring.AddPoint_2D(x, y)
+        geom = ogr.Geometry(ogr.wkbPolygon)
+        geom.AddGeometry(ring)
+        feature = ogr.Feature(lyr.GetLayerDefn())
+        feature.SetGeometry(geom)
+        feature.SetField("cell", int(cell))
+        for column in columns:
+            if column in row:
+                feature.SetField(column, float(row[column]))
+        lyr.CreateFeature(feature)
+    source.SyncToDisk()
+
+
+def buffer_stats(osm, ref, buffers):
+    """Return the statistics of v.osm.precomp for every buffer value.
+
+    Every item is (ref_in, ref_out, osm_in, osm_out): the length of ref
+    inside and outside the buffer around osm and vice versa. Buffers have
+    round caps, like the ones of v.buffer.
+    """
+    if len(buffers) == 0:
+        return []
+    dmax = max(buffers)
+    ref_pairs = pairs(ref, osm, dmax)
+    osm_pairs = pairs(osm, ref, dmax)
+    s_ref = float(lengths(ref).sum())
+    s_osm = float(lengths(osm).sum())
+    stats = []
+    for buff in buffers:
+        ref_in = float(covered(ref, osm, ref_pairs[0], ref_pairs[1],
+                               buff).sum())
+        osm_in = float(covered(osm, ref, osm_pairs[0], osm_pairs[1],
+                               buff).sum())
+        stats.append((ref_in, s_ref - ref_in, osm_in, s_osm - osm_in))
+    return stats
+
+
+def merge_pieces(segs, i_seg, pieces):
+    """Return the union of the pieces lying on the same segments"""
+    if len(i_seg) == 0:
+        return np.zeros((0, 4))
+    seg = segs[i_seg]
+    dx = seg[:, 2] - seg[:, 0]
+    dy = seg[:, 3] - seg[:, 1]
+    l2 = dx * dx + dy * dy
+    l2 = np.where(l2 > 0, l2, 1)
+    t1 = ((pieces[:, 0] - seg[:, 0]) * dx + (pieces[:, 1] - seg[:, 1]) * dy)
+    t2 = ((pieces[:, 2] - seg[:, 0]) * dx + (pieces[:, 3] - seg[:, 1]) * dy)
+    # Intervals of different segments are moved apart by 2, as in
+    # libosm.cells.covered
+    start = 2 * i_seg + np.clip(np.minimum(t1, t2) / l2, 0, 1)
+    end = 2 * i_seg + np.clip(np.maximum(t1, t2) / l2, 0, 1)
+    order = np.argsort(start, kind='mergesort')
+    start = start[order]
+    end = end[order]
+    reached = np.concatenate(([-np.inf], np.maximum.accumulate(end)[:-1]))
+    first = np.flatnonzero(start > reached)
+    num = np.floor(start[first] / 2).astype(int)
+    t_min = start[first] - 2 * num
+    t_max = np.maximum.reduceat(end, first) - 2 * num
+    seg = segs[num]
+    dx = seg[:, 2] - seg[:, 0]
+    dy = seg[:, 3] - seg[:, 1]
+    return np.column_stack((seg[:, 0] + t_min * dx, seg[:, 1] + t_min * dy,
+                            seg[:, 0] + t_max * dx, seg[:, 1] + t_max * dy))
+
+
+def match_pieces(osm, ref, buff, angle_thres):
+    """Return the pieces of osm kept by v.osm.preproc.
+
+    ref segments touching nodes of minimum degree get buffers with flat
+    caps; the pieces accepted for different ref segments are merged.
+    """
+    cats = np.arange(len(ref))
+    flat = np.isin(cats, np.array(sorted(min_degree(cats, ref)), dtype=int))
+    i_ref, i_osm, pieces = match(ref, osm, buff, angle_thres, flat)
+    return merge_pieces(osm, i_osm, pieces)
+
+
+def enlarge_boxes(boxes):
+    """Return the boxes (west, south, east, north) 10% bigger than boxes,
+    as in the BigBox function of v.osm.acc"""
+    boxes = np.asarray(boxes, dtype=float).reshape((-1, 4))
+    ew_ext = np.ceil(boxes[:, 2] - boxes[:, 0]) * 10 / 100
+    ns_ext = np.ceil(boxes[:, 3] - boxes[:, 1]) * 10 / 100
+    return np.column_stack((boxes[:, 0] - ew_ext / 2,
+                            boxes[:, 1] - ns_ext / 2,
+                            boxes[:, 2] + ew_ext / 2,
+                            boxes[:, 3] + ns_ext / 2))
+
+
+def cell_values(osm_pieces, osm_cell, ref_pieces, ref_cell, ncell, tol_eval):
+    """Return the values of v.osm.acc with tol_eval for ncell cells.
+
+    The values of a cell are a dict with OSM and, if the cell has ref
+    pieces, the t_ and p_ columns of every tolerance of tol_eval.
+    """
+    l_osm = cell_lengths(osm_pieces, osm_cell, ncell)
+    values = [{"OSM": float(l)} for l in l_osm]
+    has_ref = np.bincount(ref_cell, minlength=ncell) > 0
+    i_osm, i_ref = pairs(osm_pieces, ref_pieces,
+                         max(float(item) for item in tol_eval),
+                         osm_cell, ref_cell)
+    for item in tol_eval:
+        val = np.bincount(osm_cell, minlength=ncell,
+                          weights=covered(osm_pieces, ref_pieces, i_osm,
+                                          i_ref, float(item)))
+        for i in np.flatnonzero(has_ref):
+            values[i]["t_%s" % item] = float(val[i])
+            if l_osm[i] > 0:
+                values[i]["p_%s" % item] = float(val[i] * 100.0 / l_osm[i])
+    return values
+
+
+def cell_tolerances(osm_pieces, osm_cell, ref, boxes, tol_max, perc=100.0):
+    """Return the values of v.osm.acc with tol_max for the cells of boxes.
+
+    The values of a cell are a dict with OSM and, unless perc percent of
+    its length is farther than tol_max from the ref segments inside the
+    box 10% bigger than the cell, TOL rounded up to the next hundredth.
+    """
+    ncell = len(boxes)
+    l_osm = cell_lengths(osm_pieces, osm_cell, ncell)
+    values = [{"OSM": float(l)} for l in l_osm]
+    tol = cell_tolerance(osm_pieces, osm_cell, ref, enlarge_boxes(boxes),
+                         l_osm * perc / 100.0, float(tol_max))
+    for i in np.flatnonzero(~np.isnan(tol)):
+        values[i]["TOL"] = math.ceil(tol[i] * 100) / 100
+    return values
+
+
+def grid_accuracy(osm, ref, west, north, ewres, nsres, rows, cols,
+                  tol_eval=(), tol_max=None, perc=100.0):
+    """Return the cells of a regular grid holding osm data, their boxes
+    and the values of v.osm.acc for each of them.
+
+    Cells are numbered as in libosm.cells.lattice_pieces. The values are
+    the ones of cell_values with tol_eval and of cell_tolerances with
+    tol_max.
+    """
+    osm_pieces, osm_cell = lattice_pieces(osm, west, north, ewres, nsres,
+                                          rows, cols)
+    cells = np.unique(osm_cell)
+    ncell = len(cells)
+    osm_cell = np.searchsorted(cells, osm_cell)
+    row = cells // cols
+    col = cells % cols
+    boxes = np.column_stack((west + col * ewres, north - (row + 1) * nsres,
+                             west + (col + 1) * ewres, north - row * nsres))
+
+    if len(tol_eval) > 0:
+        ref_pieces, ref_cell = lattice_pieces(ref, west, north, ewres,
+                                              nsres, rows, cols)
+        keep = np.isin(ref_cell, cells)
+        values = cell_values(osm_pieces, osm_cell, ref_pieces[keep],
+                             np.searchsorted(cells, ref_cell[keep]), ncell,
+                             tol_eval)
+    elif tol_max is not None:
+        values = cell_tolerances(osm_pieces, osm_cell, ref, boxes, tol_max,
+                                 perc)
+    else:
+        values = [{"OSM": float(l)}
+                  for l in cell_lengths(osm_pieces, osm_cell, ncell)]
+    return cells, boxes, values
+
+
+def _perc(value, total):
+    if total == 0:
+        return 0.0
+    return round(value / total * 100, 1)
+
+
+def _precomp(args):
+    osm, srs = read_lines(args.osm, args.osm_layer)
+    ref, srs = read_lines(args.ref, args.ref_layer)
+    s_osm = float(lengths(osm).sum())
+    s_ref = float(lengths(ref).sum())
+    buffers = [float(item) for item in args.buffers.split(",")]
+    fil = open(args.output, "w") if args.output else sys.stdout
+    fil.write("REF length: {rl} m\n".format(rl=round(s_ref, 1)))
+    fil.write("OSM length: {ol} m\n".format(ol=round(s_osm, 1)))
+    fil.write("REF-OSM difference: {di} m ({dp}%)\n".format(
+        di=round(s_ref - s_osm, 1), dp=_perc(s_ref - s_osm, s_ref)))
+    fil.write("\n")
+    fil.write("BUFFER(m)|OSM_IN(m)|OSM_IN(%)|OSM_OUT(m)|OSM_OUT(%)|REF_IN(m)"
+              "|REF_IN(%)|REF_OUT(m)|REF_OUT(%)\n")
+    for buff, (ref_in, ref_out, osm_in, osm_out) in zip(
+            buffers, buffer_stats(osm, ref, buffers)):
+        values = (buff, round(osm_in, 1), _perc(osm_in, s_osm),
+                  round(osm_out, 1), _perc(osm_out, s_osm),
+                  round(ref_in, 1), _perc(ref_in, s_ref),
+                  round(ref_out, 1), _perc(ref_out, s_ref))
+        fil.write("|".join(str(val) for val in values) + "\n")
+    if fil is not sys.stdout:
+        fil.close()
+
+
+def _preproc(args):
+    osm, srs = read_lines(args.osm, args.osm_layer)
+    ref, srs_ref = read_lines(args.ref, args.ref_layer)
+    pieces = match_pieces(osm, ref, args.buffer, args.angle_thres)
+    write_lines(args.output, pieces, srs)
+    l_ref = float(lengths(ref).sum())
+    l_osm = float(lengths(osm).sum())
+    l_osm_proc = float(lengths(pieces).sum())
+    print("REF dataset length: %s m" % round(l_ref, 1))
+    print("Original OSM dataset length: %s m" % round(l_osm, 1))
+    print("Processed OSM dataset length: %s m" % round(l_osm_proc, 1))
+    print("Difference between OSM original and processed datasets length: "
+          "%s m (%s%%)" % (round(l_osm - l_osm_proc, 1),
+                           _perc(l_osm - l_osm_proc, l_osm)))
+    print("Difference between REF dataset and processed OSM dataset length: "
+          "%s m (%s%%)" % (round(l_ref - l_osm_proc, 1),
+                           _perc(l_ref - l_osm_proc, l_ref)))
+
+
+def _acc(args):
+    if bool(args.tol_eval) == (args.tol_max is not None):
+        raise ValueError("Please specify one between --tol-eval and "
+                         "--tol-max")
+    osm, srs = read_lines(args.osm, args.osm_layer)
+    ref, srs_ref = read_lines(args.ref, args.ref_layer)
+    # Corners are read as ul_grid and lr_grid of v.osm.acc
+    n, w = [float(item) for item in args.ul.split(",")]
+    s, e = [float(item) for item in args.lr.split(",")]
+    ewres, nsres = [float(item) for item in args.box.split(",")]
+    rows = int(math.ceil((n - s) / nsres))
+    cols = int(math.ceil((e - w) / ewres))
+    if args.tol_eval:
+        tol_eval = args.tol_eval.split(",")
+        columns = ["OSM"] + ["%s_%s" % (c, item) for item in tol_eval
+                             for c in ("t", "p")]
+    else:
+        tol_eval = ()
+        columns = ["OSM", "TOL"]
+    cells, boxes, values = grid_accuracy(osm, ref, w, n, ewres, nsres, rows,
+                                         cols, tol_eval, args.tol_max,
+                                         args.perc)
+    write_cells(args.output, cells, boxes.tolist(), columns, values, srs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m libosm.engine",
+        description="Compare OSM and reference line files in memory")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    def command(name, func, help):
+        sub = commands.add_parser(name, help=help)
+        sub.add_argument("osm", help="OpenStreetMap dataset")
+        sub.add_argument("ref", help="Reference dataset")
+        sub.add_argument("--osm-layer", help="Layer of the OSM file")
+        sub.add_argument("--ref-layer", help="Layer of the reference file")
+        sub.set_defaults(func=func)
+        return sub
+
+    sub = command("precomp", _precomp, "statistics of v.osm.precomp")
+    sub.add_argument("--buffers", required=True,
+                     help="Buffer values separated by comma (map units)")
+    sub.add_argument("--output", help="Output file, standard output if "
+                     "omitted")
+
+    sub = command("preproc", _preproc, "matching of v.osm.preproc")
+    sub.add_argument("--buffer", type=float, required=True,
+                     help="Buffer around reference dataset (map units)")
+    sub.add_argument("--angle-thres", type=float, required=True,
+                     help="Threshold value for angular coefficient "
+                     "comparison (degrees)")
+    sub.add_argument("--output", required=True,
+                     help="Output .gpkg or .shp file")
+
+    sub = command("acc", _acc, "grid evaluation of v.osm.acc")
+    sub.add_argument("--ul", required=True,
+                     help="Coordinates of the upper left grid corner "
+                     "(north,west), as ul_grid of v.osm.acc")
+    sub.add_argument("--lr", required=True,
+                     help="Coordinates of the lower right grid corner "
+                     "(south,east), as lr_grid of v.osm.acc")
+    sub.add_argument("--box", required=True,
+                     help="Width and height of the grid boxes (map units)")
+    sub.add_argument("--tol-eval", help="Threshold values for accuracy "
+                     "evaluation, separated by comma (map units)")
+    sub.add_argument("--tol-max", type=float, help="Maximum threshold for "
+                     "the automated accuracy evaluation (map units)")
+    sub.add_argument("--perc", type=float, default=100.0,
+                     help="Percentage of OSM length within the tolerance")
+    sub.add_argument("--output", required=True,
+                     help="Output .gpkg or .shp file")
+
+    args = parser.parse_args(argv)
+    args.func(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+#  -*- coding:utf-8 -*-
+##############################################################################
+# LIBRARY:   libosm.geomstats
+# AUTHOR(S): Monia Molinari, Marco Minghini
+# PURPOSE:   Geometry statistics of vector maps read directly from the maps
+# COPYRIGHT: (C) 2015 by the GRASS Development Team
+#
+# This program is free software under the GNU General Public
+# License (>=v2). Read the file COPYING that comes with GRASS
+# for details.
+# ############################################################################
+"""Line statistics read directly from the vector maps.
+
+The statistics are computed with pygrass, without running other modules,
+and are memoized on the map name and the stamp of its coor file, so that
+asking again for an unchanged map costs nothing.
+"""
+
+import os
+
+import grass.script as grass
+from grass.pygrass.utils import get_mapset_vector
+from grass.pygrass.vector import VectorTopo
+
+_cache = {}
+_latlong = []
+
+
+def split_name(data):
+    """Return name and mapset of data, looking for it in the search path"""
+    if '@' in data:
+        name, mapset = data.split('@', 1)
+    else:
+        name, mapset = data, get_mapset_vector(data)
+    return name, mapset
+
+
+def _gisenv():
+    """Return the variables of the GISRC file without running g.gisenv"""
+    env = {}
+    fil = open(os.environ['GISRC'])
+    for line in fil:
+        if ':' in line:
+            key, val = line.split(':', 1)
+            env[key.strip()] = val.strip()
+    fil.close()
+    return env
+
+
+def stamp(data):
+    """Return a key changing every time the geometry of data is written"""
+    name, mapset = split_name(data)
+    env = _gisenv()
+    coor = os.path.join(env['GISDBASE'], env['LOCATION_NAME'], mapset,
+                        'vector', name, 'coor')
+    try:
+        st = os.stat(coor)
+    except OSError:
+        return None
+    return (name, mapset, st.st_ino, st.st_size, st.st_mtime)
+
+
+def _stats(data):
+    key = stamp(data)
+    if key is not None and key in _cache:
+        return _cache[key]
+    if not _latlong:
+        _latlong.append(grass.locn_is_latlong())
+
+    name, mapset = split_name(data)
+    vect = VectorTopo(name, mapset)
+    vect.open('r')
+    n_lines = vect.number_of("lines")
+    s_data = 0
+    if n_lines > 0:
+        for line in vect.viter("lines"):
+            if _latlong[0]:
+                s_data += line.length_geodesic()
+            else:
+                s_data += line.length()
+    vect.close()
+
+    if key is not None:
+        _cache[key] = (n_lines, s_data)
+    return (n_lines, s_data)
+
+
+def length(data):
+    """Return the total length of the lines of data"""
+    return _stats(data)[1]
+
+
+def nlines(data):
+    """Return the number of lines of data"""
+    return _stats(data)[0]
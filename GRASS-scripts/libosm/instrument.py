@@ -0,0 +1,138 @@
+#  -*- coding:utf-8 -*-
+##############################################################################
+# LIBRARY:   libosm.instrument
+# AUTHOR(S): Monia Molinari, Marco Minghini
+# PURPOSE:   Timing of the GRASS modules run by the v.osm scripts
+# COPYRIGHT: (C) 2015 by the GRASS Development Team
+#
+# This program is free software under the GNU General Public
+# License (>=v2). Read the file COPYING that comes with GRASS
+# for details.
+# ############################################################################
+"""Timing of the GRASS modules run by the scripts.
+
+Once enabled, run_command, read_command, write_command and parse_command
+of grass.script record for every call the wall time and the bytes passed
+through the pipes (the output of read_command, the input of write_command),
+grouped by the stage of the script and by GRASS module. The helpers of
+grass.script running a module themselves, as find_file or vector_info, are
+recorded under the name of that module. A script marks the
+beginning of each stage with stage(); calls made by pool workers are
+counted in the stage active when the pool was started, so their times may
+sum up to more than the wall time of the stage.
+"""
+
+import json
+import threading
+import time
+
+import grass.script as grass
+
+_enabled = []
+_calls = {}
+_stages = {}
+_current = [None, None]
+_lock = threading.Lock()
+
+# Helpers of grass.script and the GRASS module they run
+_HELPERS = {'find_file': 'g.findfile', 'gisenv': 'g.gisenv',
+            'region': 'g.region', 'vector_info': 'v.info',
+            'vector_columns': 'v.info', 'vector_db': 'v.db.connect',
+            'vector_db_select': 'v.db.select'}
+
+
+def _record(stage, module, seconds, size, count=1):
+    # Commands may run in concurrent threads (see libosm.dag)
+    _lock.acquire()
+    rec = _calls.setdefault((stage, module), [0, 0.0, 0])
+    rec[0] += count
+    rec[1] += seconds
+    rec[2] += size
+    _lock.release()
+
+
+def _wrap(func, module=None):
+    def wrapper(*args, **kwargs):
+        if module is not None:
+            prog = module
+        else:
+            prog = args[0] if args else kwargs.get('prog')
+        start = time.time()
+        result = func(*args, **kwargs)
+        if func.__name__ == 'read_command':
+            size = len(result)
+        elif func.__name__ == 'write_command':
+            size = len(kwargs.get('stdin') or '')
+        else:
+            size = 0
+        _record(_current[0], prog, time.time() - start, size)
+        return result
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+
+def enable():
+    """Start recording the GRASS modules run through grass.script"""
+    if _enabled:
+        return
+    for name in ('run_command', 'read_command', 'write_command',
+                 'parse_command'):
+        setattr(grass, name, _wrap(getattr(grass, name)))
+    for name, module in _HELPERS.items():
+        setattr(grass, name, _wrap(getattr(grass, name), module))
+    _enabled.append(time.time())
+    stage('main')
+
+
+def enabled():
+    return len(_enabled) > 0
+
+
+def stage(name):
+    """End the running stage and start the stage name"""
+    if not _enabled:
+        return
+    now = time.time()
+    if _current[0] is not None:
+        rec = _stages.setdefault(_current[0], [0, 0.0])
+        rec[0] += 1
+        rec[1] += now - _current[1]
+    _current[0] = name
+    _current[1] = now
+
+
+def reset():
+    """Forget the calls recorded so far, as in a new pool worker"""
+    _calls.clear()
+
+
+def take():
+    """Return the calls recorded so far and forget them"""
+    calls = [(st, mo) + tuple(rec) for (st, mo), rec in _calls.items()]
+    _calls.clear()
+    return calls
+
+
+def merge(calls):
+    """Add the calls returned by take() in another process"""
+    for st, mo, count, seconds, size in calls:
+        _record(st, mo, seconds, size, count)
+
+
+def write(fileName):
+    """End the running stage and write the JSON profile to fileName"""
+    stage(None)
+    stages = {}
+    for name, (count, seconds) in _stages.items():
+        stages[name] = {"time": round(seconds, 3), "count": count,
+                        "modules": {}}
+    for (st, mo), (count, seconds, size) in _calls.items():
+        rec = stages.setdefault(st, {"time": 0.0, "count": 0, "modules": {}})
+        rec["modules"][mo] = {"calls": count, "time": round(seconds, 3),
+                              "bytes": size}
+    fil = open(fileName, "w")
+    json.dump({"time": round(time.time() - _enabled[0], 3),
+               "calls": sum(rec[0] for rec in _calls.values()),
+               "stages": stages}, fil, indent=2, sort_keys=True)
+    fil.write("\n")
+    fil.close()
@@ -0,0 +1,161 @@
+#  -*- coding:utf-8 -*-
+##############################################################################
+# LIBRARY:   libosm.matcher
+# AUTHOR(S): Monia Molinari, Marco Minghini
+# PURPOSE:   In-memory matching of OSM segments with reference segments
+# COPYRIGHT: (C) 2015 by the GRASS Development Team
+#
+# This program is free software under the GNU General Public
+# License (>=v2). Read the file COPYING that comes with GRASS
+# for details.
+# ############################################################################
+"""In-memory version of the matching step of v.osm.preproc.
+
+For every reference segment the OSM segments are clipped with its buffer
+(round caps, or flat caps for the segments touching a dead end) and the
+pieces whose angular coefficient differs from the reference one by at most
+the angle threshold are accepted. Candidate pairs are found with a grid
+index and clipped and compared in bulk with NumPy.
+"""
+
+import numpy as np
+
+from libosm.segments import GridIndex
+
+# Angular coefficient of vertical segments, as in v.osm.preproc
+VERTICAL = 10 ** 9
+
+
+def slope(coords):
+    """Return the angular coefficient of the segments"""
+    dx = coords[:, 2] - coords[:, 0]
+    dy = coords[:, 3] - coords[:, 1]
+    vertical = dx == 0
+    return np.where(vertical, VERTICAL, dy / np.where(vertical, 1, dx))
+
+
+def angle(m1, m2):
+    """Return the angle (degrees) between lines with coefficients m1, m2"""
+    num = m1 - m2
+    den = 1 + m1 * m2
+    perpendicular = den == 0
+    ang = np.degrees(np.abs(np.arctan(num / np.where(perpendicular, 1,
+                                                        den))))
+    return np.where(perpendicular, 90.0, ang)
+
+
+def _slab(a, b, low, high):
+    """Return the interval of t where low <= a + b * t <= high"""
+    flat = b == 0
+    div = np.where(flat, 1, b)
+    t1 = (low - a) / div
+    t2 = (high - a) / div
+    inside = (a >= low) & (a <= high)
+    t_min = np.where(flat, np.where(inside, -np.inf, np.inf),
+                     np.minimum(t1, t2))
+    t_max = np.where(flat, np.where(inside, np.inf, -np.inf),
+                     np.maximum(t1, t2))
+    return t_min, t_max
+
+
+def _disc(wx, wy, dx, dy, dist):
+    """Return the interval of t where |w + t * d| <= dist"""
+    a = dx * dx + dy * dy
+    b = 2 * (wx * dx + wy * dy)
+    c = wx * wx + wy * wy - dist * dist
+    delta = b * b - 4 * a * c
+    empty = (delta < 0) | (a == 0)
+    root = np.sqrt(np.where(empty, 0, delta))
+    div = np.where(empty, 1, 2 * a)
+    t_min = np.where(empty, np.inf, (-b - root) / div)
+    t_max = np.where(empty, -np.inf, (-b + root) / div)
+    return t_min, t_max
+
+
+def buffer_intervals(ref, osm, dist, flat):
+    """Return the part of every osm segment inside the buffer of ref.
+
+    ref and osm are arrays of paired segments, flat tells which buffers
+    have flat caps. The result is the interval (t_min, t_max) of the
+    parameter along the osm segments; it is empty when t_min >= t_max.
+    """
+    ax, ay, bx, by = ref[:, 0], ref[:, 1], ref[:, 2], ref[:, 3]
+    px, py, qx, qy = osm[:, 0], osm[:, 1], osm[:, 2], osm[:, 3]
+    length = np.hypot(bx - ax, by - ay)
+    point = length == 0
+    div = np.where(point, 1, length)
+    ux = (bx - ax) / div
+    uy = (by - ay) / div
+    dx = qx - px
+    dy = qy - py
+    wx = px - ax
+    wy = py - ay
+
+    # Rectangle around the segment, in its own reference system
+    s_min, s_max = _slab(wx * ux + wy * uy, dx * ux + dy * uy, 0, length)
+    r_min, r_max = _slab(wy * ux - wx * uy, dy * ux - dx * uy, -dist, dist)
+    t_min = np.maximum(s_min, r_min)
+    t_max = np.minimum(s_max, r_max)
+    # An empty interval must not stretch the union with the caps
+    empty = point | (t_min >= t_max)
+    t_min = np.where(empty, np.inf, t_min)
+    t_max = np.where(empty, -np.inf, t_max)
+
+    # Round caps; the buffer is convex, so the union is a single interval
+    round_caps = ~flat
+    for cx, cy in ((ax, ay), (bx, by)):
+        c_min, c_max = _disc(px - cx, py - cy, dx, dy, dist)
+        t_min = np.where(round_caps, np.minimum(t_min, c_min), t_min)
+        t_max = np.where(round_caps, np.maximum(t_max, c_max), t_max)
+
+    return np.maximum(t_min, 0), np.minimum(t_max, 1)
+
+
+def candidates(index, ref, dist):
+    """Return the pairs of segments whose bounding boxes are within dist"""
+    return index.query_boxes(np.minimum(ref[:, 0], ref[:, 2]) - dist,
+                             np.minimum(ref[:, 1], ref[:, 3]) - dist,
+                             np.maximum(ref[:, 0], ref[:, 2]) + dist,
+                             np.maximum(ref[:, 1], ref[:, 3]) + dist)
+
+
+def match(ref, osm, dist, angle_thres, flat, chunk=10000):
+    """Match the osm segments with the ref segments.
+
+    flat is a boolean array telling which ref segments get a buffer with
+    flat caps. Return the indices of the ref and osm segments of every
+    accepted pair and the coordinates of the accepted pieces.
+    """
+    index = GridIndex(osm)
+    m_osm = slope(osm)
+    found_ref = []
+    found_osm = []
+    found_pieces = []
+    for start in range(0, len(ref), chunk):
+        i_ref, i_osm = candidates(index, ref[start:start + chunk], dist)
+        i_ref += start
+        if len(i_ref) == 0:
+            continue
+        t_min, t_max = buffer_intervals(ref[i_ref], osm[i_osm], dist,
+                                        flat[i_ref])
+        m_ref = slope(ref[i_ref])
+        accepted = ((t_max > t_min) &
+                    (angle(m_ref, m_osm[i_osm]) <= angle_thres))
+        i_ref = i_ref[accepted]
+        i_osm = i_osm[accepted]
+        t_min = t_min[accepted]
+        t_max = t_max[accepted]
+        seg = osm[i_osm]
+        dx = seg[:, 2] - seg[:, 0]
+        dy = seg[:, 3] - seg[:, 1]
+        found_pieces.append(np.column_stack((seg[:, 0] + t_min * dx,
+                                             seg[:, 1] + t_min * dy,
+                                             seg[:, 0] + t_max * dx,
+                                             seg[:, 1] + t_max * dy)))
+        found_ref.append(i_ref)
+        found_osm.append(i_osm)
+    if len(found_ref) == 0:
+        return (np.array([], dtype=int), np.array([], dtype=int),
+                np.zeros((0, 4)))
+    return (np.concatenate(found_ref), np.concatenate(found_osm),
+            np.concatenate(found_pieces))
@@ -0,0 +1,102 @@
+#  -*- coding:utf-8 -*-
+##############################################################################
+# LIBRARY:   libosm.pool
+# AUTHOR(S): Monia Molinari, Marco Minghini
+# PURPOSE:   Pool of GRASS workers, each one in its own temporary mapset
+# COPYRIGHT: (C) 2015 by the GRASS Development Team
+#
+# This program is free software under the GNU General Public
+# License (>=v2). Read the file COPYING that comes with GRASS
+# for details.
+# ############################################################################
+"""Pool of worker processes running GRASS modules.
+
+Every worker moves in its own temporary mapset, with the region of the
+current mapset and a private database, so that the workers can create
+temporary maps with the same names without clashing.
+"""
+
+import os
+import shutil
+from multiprocessing import Pool, Queue
+
+import grass.script as grass
+
+from libosm import instrument
+
+
+def scratch_mapset(gisenv, mapset):
+    """Create a temporary mapset with the current region.
+
+    A mapset with the same name left by a killed run is replaced. Return the
+    path of a GISRC file pointing to the new mapset.
+    """
+    location = os.path.join(gisenv['GISDBASE'], gisenv['LOCATION_NAME'])
+    path = os.path.join(location, mapset)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.mkdir(path)
+    os.mkdir(os.path.join(path, 'sqlite'))
+    shutil.copy(os.path.join(location, gisenv['MAPSET'], 'WIND'),
+                os.path.join(path, 'WIND'))
+    gisrc = os.path.join(path, 'GISRC')
+    fil = open(gisrc, "w")
+    fil.write("GISDBASE: {st}\n".format(st=gisenv['GISDBASE']))
+    fil.write("LOCATION_NAME: {st}\n".format(st=gisenv['LOCATION_NAME']))
+    fil.write("MAPSET: {st}\n".format(st=mapset))
+    fil.close()
+    return gisrc
+
+
+def init_worker(q_gisrc):
+    """Move the worker in its own temporary mapset and database"""
+    os.environ['GISRC'] = q_gisrc.get()
+    instrument.reset()
+    grass.run_command("db.connect", flags="d", quiet=True)
+
+
+def timed_task(args):
+    """Run a task and return also the GRASS calls it recorded"""
+    func, task = args
+    result = func(task)
+    return result, instrument.take()
+
+
+def run_tasks(func, tasks, nproc, name):
+    """Run func on every task and yield the results as soon as they are ready.
+
+    With more than one process the tasks are scheduled dynamically on a pool
+    of workers, each one working in its own temporary mapset tmp_<name>_<n>,
+    so they don't share the vector directory and the database of the current
+    mapset. Input maps must be given with their fully qualified names.
+    """
+    if nproc <= 1:
+        for task in tasks:
+            yield func(task)
+        return
+
+    gisenv = grass.gisenv()
+    location = os.path.join(gisenv['GISDBASE'], gisenv['LOCATION_NAME'])
+    mapsets = ["tmp_{name}_{n}".format(name=name, n=n) for n in range(nproc)]
+    q_gisrc = Queue()
+    try:
+        for mapset in mapsets:
+            q_gisrc.put(scratch_mapset(gisenv, mapset))
+        pool = Pool(nproc, init_worker, (q_gisrc,))
+        try:
+            if instrument.enabled():
+                for result, calls in pool.imap_unordered(
+                        timed_task, [(func, task) for task in tasks]):
+                    instrument.merge(calls)
+                    yield result
+            else:
+                for result in pool.imap_unordered(func, tasks):
+                    yield result
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        pool.join()
+    finally:
+        for mapset in mapsets:
+            shutil.rmtree(os.path.join(location, mapset), ignore_errors=True)
@@ -0,0 +1,196 @@
+#  -*- coding:utf-8 -*-
+##############################################################################
+# LIBRARY:   libosm.segments
+# AUTHOR(S): Monia Molinari, Marco Minghini
+# PURPOSE:   In-memory straight segments of vector maps and their index
+# COPYRIGHT: (C) 2015 by the GRASS Development Team
+#
+# This program is free software under the GNU General Public
+# License (>=v2). Read the file COPYING that comes with GRASS
+# for details.
+# ############################################################################
+"""Straight segments of line maps held in memory.
+
+Segments are stored in NumPy arrays with one row (x1, y1, x2, y2) for each
+segment; GridIndex finds the segments near a bounding box.
+"""
+
+import numpy as np
+
+
+def read_segments(data):
+    """Return categories and coordinates of the segments of the lines of data.
+
+    Every line is broken in its straight segments; the category of a segment
+    is the category of its line (layer 1).
+    """
+    from grass.pygrass.vector import VectorTopo
+    from libosm.geomstats import split_name
+
+    name, mapset = split_name(data)
+    vect = VectorTopo(name, mapset)
+    vect.open('r')
+    cats = []
+    coords = []
+    if vect.number_of("lines") > 0:
+        for line in vect.viter("lines"):
+            pts = line.to_list()
+            for p1, p2 in zip(pts[:-1], pts[1:]):
+                cats.append(line.cat)
+                coords.append((p1[0], p1[1], p2[0], p2[1]))
+    vect.close()
+    return (np.array(cats, dtype=int),
+            np.array(coords, dtype=float).reshape((-1, 4)))
+
+
+def read_boxes(data):
+    """Return the bounding box (west, south, east, north) of the areas of
+    data by category (layer 1)"""
+    from grass.pygrass.vector import VectorTopo
+    from libosm.geomstats import split_name
+
+    name, mapset = split_name(data)
+    vect = VectorTopo(name, mapset)
+    vect.open('r')
+    boxes = {}
+    if vect.number_of("areas") > 0:
+        for area in vect.viter("areas"):
+            if area.cat is None:
+                continue
+            bbox = area.bbox()
+            boxes[area.cat] = (bbox.west, bbox.south, bbox.east, bbox.north)
+    vect.close()
+    return boxes
+
+
+def write_segments(output, coords, cats=None):
+    """Write the segments to a new vector map with a single v.in.ascii run.
+
+    Without cats the segments get categories from 1 on.
+    """
+    import grass.script as grass
+
+    lines = []
+    for k, (x1, y1, x2, y2) in enumerate(coords):
+        cat = k + 1 if cats is None else cats[k]
+        lines.append("L  2 1\n {x1} {y1}\n {x2} {y2}\n 1 {ca}\n".format(
+            x1=repr(float(x1)), y1=repr(float(y1)), x2=repr(float(x2)),
+            y2=repr(float(y2)), ca=int(cat)))
+    grass.write_command("v.in.ascii", input="-", output=output,
+                        format="standard", flags="n", stdin="".join(lines),
+                        overwrite=True, quiet=True)
+
+
+def segment_keys(coords):
+    """Return a text key of every segment, equal for segments with the same
+    end points whatever their direction.
+
+    Coordinates are rounded to 6 decimals; the coordinates can be read back
+    from the key with split().
+    """
+    keys = []
+    for seg in coords.tolist():
+        x1, y1, x2, y2 = [round(c, 6) + 0.0 for c in seg]
+        if (x1, y1) > (x2, y2):
+            x1, y1, x2, y2 = x2, y2, x1, y1
+        keys.append("%.6f %.6f %.6f %.6f" % (x1, y1, x2, y2))
+    return keys
+
+
+def min_degree(cats, coords):
+    """Return the set of categories of the segments touching a node of minimum
+    degree.
+
+    Nodes are the distinct end points of the segments and their degree is the
+    number of segment ends falling on them, counted in a single pass.
+    """
+    if len(coords) == 0:
+        return set()
+    ends = np.concatenate((coords[:, 0:2], coords[:, 2:4]))
+    nodes, inverse, degree = np.unique(ends, axis=0, return_inverse=True,
+                                       return_counts=True)
+    touching = degree[inverse.reshape(-1)] == degree.min()
+    touching = touching[:len(coords)] | touching[len(coords):]
+    return set(int(cat) for cat in np.unique(cats[touching]))
+
+
+def _expand(i0, i1, j0, j1):
+    """Return the owner and the position of every cell of the ranges of
+    cells [i0, i1] x [j0, j1], one range for each owner"""
+    width = np.maximum(j1 - j0 + 1, 0)
+    count = np.maximum(i1 - i0 + 1, 0) * width
+    owner = np.repeat(np.arange(len(count)), count)
+    pos = np.arange(owner.size) - np.repeat(np.cumsum(count) - count, count)
+    div = np.where(width > 0, width, 1)[owner]
+    return owner, i0[owner] + pos // div, j0[owner] + pos % div
+
+
+class GridIndex(object):
+    """Uniform grid index over the bounding boxes of segments.
+
+    Every segment is registered in all the cells touched by its bounding
+    box; a query returns the segments whose bounding box intersects the
+    query box. Without cell the cell size is the mean bounding box side.
+    The cells are kept sorted in arrays, so many boxes are queried at once.
+    """
+
+    def __init__(self, coords, cell=None):
+        self.xmin = np.minimum(coords[:, 0], coords[:, 2])
+        self.xmax = np.maximum(coords[:, 0], coords[:, 2])
+        self.ymin = np.minimum(coords[:, 1], coords[:, 3])
+        self.ymax = np.maximum(coords[:, 1], coords[:, 3])
+        if cell is None:
+            if len(coords) > 0:
+                cell = float(np.mean(np.maximum(self.xmax - self.xmin,
+                                                  self.ymax - self.ymin)))
+            if not cell or cell <= 0:
+                cell = 1.0
+        self.cell = cell
+        self.x0 = float(self.xmin.min()) if len(coords) > 0 else 0.0
+        self.y0 = float(self.ymin.min()) if len(coords) > 0 else 0.0
+
+        i0, j0 = self._cell(self.xmin, self.ymin)
+        i1, j1 = self._cell(self.xmax, self.ymax)
+        self.ni = int(i1.max()) + 1 if len(coords) > 0 else 0
+        self.nj = int(j1.max()) + 1 if len(coords) > 0 else 0
+        owner, i, j = _expand(i0, i1, j0, j1)
+        keys = i * self.nj + j
+        order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[order]
+        self.found = owner[order]
+
+    def _cell(self, x, y):
+        return (np.floor((x - self.x0) / self.cell).astype(int),
+                np.floor((y - self.y0) / self.cell).astype(int))
+
+    def query_boxes(self, xmin, ymin, xmax, ymax):
+        """Return the pairs of boxes and segments intersecting them, as
+        indices sorted by box and segment"""
+        xmin, ymin, xmax, ymax = [np.asarray(c, dtype=float)
+                                  for c in (xmin, ymin, xmax, ymax)]
+        i0, j0 = self._cell(xmin, ymin)
+        i1, j1 = self._cell(xmax, ymax)
+        # Cells outside the grid hold no segment
+        box, i, j = _expand(np.maximum(i0, 0), np.minimum(i1, self.ni - 1),
+                            np.maximum(j0, 0), np.minimum(j1, self.nj - 1))
+        keys = i * self.nj + j
+        start = np.searchsorted(self.keys, keys, 'left')
+        count = np.searchsorted(self.keys, keys, 'right') - start
+        box = np.repeat(box, count)
+        pos = np.arange(box.size) - np.repeat(np.cumsum(count) - count,
+                                              count)
+        found = self.found[np.repeat(start, count) + pos]
+        # A segment is found in every cell shared with the box
+        nseg = max(len(self.xmin), 1)
+        pair = np.unique(box * nseg + found)
+        box = pair // nseg
+        found = pair % nseg
+        inside = ((self.xmin[found] <= xmax[box]) &
+                  (self.xmax[found] >= xmin[box]) &
+                  (self.ymin[found] <= ymax[box]) &
+                  (self.ymax[found] >= ymin[box]))
+        return box[inside], found[inside]
+
+    def query(self, xmin, ymin, xmax, ymax):
+        """Return the indices of the segments intersecting the box"""
+        return self.query_boxes([xmin], [ymin], [xmax], [ymax])[1]
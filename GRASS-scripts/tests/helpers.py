@@ -0,0 +1,90 @@
+#  -*- coding:utf-8 -*-
+##############################################################################
+# MODULE:    tests.helpers
+# AUTHOR(S): Monia Molinari, Marco Minghini
+# PURPOSE:   Shared code of the tests
+# COPYRIGHT: (C) 2015 by the GRASS Development Team
+#
+# This program is free software under the GNU General Public
+# License (>=v2). Read the file COPYING that comes with GRASS
+# for details.
+# ############################################################################
+"""Shared code of the tests.
+
+Importing the module puts the GRASS-scripts folder on the path, so that
+libosm can be imported without installing the modules. GrassTestCase runs
+the modules of the working tree on segment fixtures and is skipped outside
+a GRASS session.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, SCRIPTS)
+
+
+def grass_session():
+    """Return grass.script inside a GRASS session, None otherwise"""
+    try:
+        import grass.script as grass
+    except ImportError:
+        return None
+    if "GISRC" not in os.environ:
+        return None
+    return grass
+
+
+def ascii_segments(coords):
+    """Return the segments in the standard format of v.in.ascii, with
+    categories from 1 on"""
+    out = []
+    for cat, (x1, y1, x2, y2) in enumerate(coords.tolist(), 1):
+        out.append("L  2 1\n %r %r\n %r %r\n 1 %d\n" % (x1, y1, x2, y2, cat))
+    return "".join(out)
+
+
+@unittest.skipIf(grass_session() is None, "needs a GRASS session")
+class GrassTestCase(unittest.TestCase):
+    """Imports the segments of MAPS, a dict of arrays by map name, before
+    every test and removes the maps starting with PREFIX after it"""
+
+    PREFIX = "test_"
+    MAPS = {}
+
+    def setUp(self):
+        self.grass = grass_session()
+        self.tmp = tempfile.mkdtemp()
+        for name, coords in self.MAPS.items():
+            self.grass.write_command("v.in.ascii", input="-", output=name,
+                                     format="standard", flags="n",
+                                     stdin=ascii_segments(coords),
+                                     overwrite=True, quiet=True)
+
+    def tearDown(self):
+        self.grass.run_command("g.remove", type="vect",
+                               pattern=self.PREFIX + "*", flags="f",
+                               quiet=True)
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def run_module(self, module, **options):
+        args = [sys.executable,
+                os.path.join(SCRIPTS, module, module + ".py"),
+                "--overwrite", "--quiet"]
+        args += ["%s=%s" % item for item in sorted(options.items())]
+        subprocess.check_call(args)
+
+    def precomp_rows(self, **options):
+        """Run v.osm.precomp and return its rows sorted by buffer"""
+        out = os.path.join(self.tmp, "precomp.json")
+        self.run_module("v.osm.precomp", output=os.path.join(self.tmp, "txt"),
+                        out_data=out, data_format="json", **options)
+        fil = open(out)
+        rows = sorted(json.load(fil)["rows"], key=lambda r: r["buffer"])
+        fil.close()
+        return rows
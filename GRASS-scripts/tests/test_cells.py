@@ -0,0 +1,153 @@
+#  -*- coding:utf-8 -*-
+##############################################################################
+# MODULE:    tests.test_cells
+# AUTHOR(S): Monia Molinari, Marco Minghini
+# PURPOSE:   Tests of the lengths and tolerances by grid cell
+# COPYRIGHT: (C) 2015 by the GRASS Development Team
+#
+# This program is free software under the GNU General Public
+# License (>=v2). Read the file COPYING that comes with GRASS
+# for details.
+# ############################################################################
+"""Tests of libosm.cells.
+
+Lengths are checked on segments whose buffers are known; the tolerances
+read from the distance of the OSM parts are compared with a bisection on
+the covered lengths.
+"""
+
+import unittest
+
+import numpy as np
+
+import helpers  # noqa: F401
+
+from libosm.cells import (cell_fingerprints, cell_tolerance, covered,
+                          lattice_pieces, lengths, pairs)
+
+# OSM moves away from REF, bends around the inner side of a REF corner and
+# crosses REF twice
+REF = np.array([[0.0, 0.0, 100.0, 0.0],
+                [100.0, 0.0, 100.0, 50.0]])
+OSM = np.array([[0.0, 1.0, 50.0, 6.0],
+                [50.0, 6.0, 95.0, 8.0],
+                [95.0, 8.0, 96.0, 40.0],
+                [96.0, 40.0, 104.0, 45.0],
+                [10.0, -3.0, 30.0, 2.0]])
+CELLS = np.array([0, 0, 1, 1, 0])
+BOXES = np.array([[-10.0, -10.0, 200.0, 200.0],
+                  [-10.0, -10.0, 200.0, 200.0]])
+
+
+def bisection(osm, ref, target, tol_max):
+    """Return the distance within which target length of osm lies"""
+    i_osm, i_ref = pairs(osm, ref, tol_max)
+    # Lengths are summed in different orders
+    target *= 1 - 1e-9
+
+    def length(dist):
+        return covered(osm, ref, i_osm, i_ref, dist).sum()
+    if length(tol_max) < target:
+        return np.nan
+    low, high = 0.0, tol_max
+    for _ in range(50):
+        mid = (low + high) / 2
+        if length(mid) >= target:
+            high = mid
+        else:
+            low = mid
+    return high
+
+
+class CoveredTest(unittest.TestCase):
+
+    def test_union(self):
+        # The buffers of the two REF segments overlap around the corner,
+        # where the first OSM segment is counted once
+        osm = np.array([[90.0, 1.0, 99.0, 1.0], [50.0, 3.0, 60.0, 3.0]])
+        i_osm, i_ref = pairs(osm, REF, 2.0)
+        np.testing.assert_allclose(covered(osm, REF, i_osm, i_ref, 2.0),
+                                   [9.0, 0.0])
+
+    def test_distance_by_pair(self):
+        # Only the distance of the pair with the first REF segment reaches
+        # the OSM segment
+        osm = np.array([[0.0, 1.0, 10.0, 1.0]])
+        i_osm, i_ref = np.array([0, 0]), np.array([0, 1])
+        for dist, expected in (([0.5, 1.0], 0.0), ([1.0, 0.5], 10.0)):
+            length = covered(osm, REF, i_osm, i_ref, np.array(dist))
+            np.testing.assert_allclose(length, [expected])
+        self.assertEqual(covered(osm, REF, np.array([], dtype=int),
+                                 np.array([], dtype=int), 1.0).tolist(),
+                         [0.0])
+
+
+class LatticePiecesTest(unittest.TestCase):
+
+    def test_split(self):
+        # A 2 x 2 grid of 10 x 10 from (0, 20); the diagonal crosses three
+        # cells and leaves the grid
+        coords = np.array([[5.0, 5.0, 25.0, 15.0]])
+        pieces, cells = lattice_pieces(coords, 0.0, 20.0, 10.0, 10.0, 2, 2)
+        self.assertEqual(cells.tolist(), [2, 3, 1])
+        np.testing.assert_allclose(pieces[:, 0], [5.0, 10.0, 15.0])
+        self.assertAlmostEqual(float(lengths(pieces).sum()),
+                               float(lengths(coords).sum()) * 0.75)
+
+
+class CellFingerprintsTest(unittest.TestCase):
+
+    BOXES = [(0.0, -10.0, 50.0, 10.0), (50.0, -10.0, 110.0, 60.0)]
+
+    def test_order_and_direction(self):
+        flipped = OSM[::-1][:, [2, 3, 0, 1]]
+        self.assertEqual(cell_fingerprints([(OSM, self.BOXES)]),
+                         cell_fingerprints([(flipped, self.BOXES)]))
+
+    def test_changed_cell(self):
+        moved = OSM.copy()
+        moved[2, 2] += 0.5
+        before = cell_fingerprints([(OSM, self.BOXES), (REF, self.BOXES)])
+        after = cell_fingerprints([(moved, self.BOXES), (REF, self.BOXES)])
+        self.assertEqual(before[0], after[0])
+        self.assertNotEqual(before[1], after[1])
+
+    def test_salt(self):
+        self.assertNotEqual(cell_fingerprints([(OSM, self.BOXES)], "1"),
+                            cell_fingerprints([(OSM, self.BOXES)], "2"))
+
+
+class CellToleranceTest(unittest.TestCase):
+
+    def test_bisection(self):
+        total = np.bincount(CELLS, weights=np.hypot(OSM[:, 2] - OSM[:, 0],
+                                                    OSM[:, 3] - OSM[:, 1]))
+        for perc in (10.0, 50.0, 90.0, 100.0):
+            target = total * perc / 100.0
+            tol = cell_tolerance(OSM, CELLS, REF, BOXES, target, 20.0)
+            for cell in (0, 1):
+                osm = OSM[CELLS == cell]
+                self.assertAlmostEqual(tol[cell],
+                                       bisection(osm, REF, target[cell],
+                                                 20.0),
+                                       delta=1e-4)
+
+    def test_tol_max(self):
+        # The second cell reaches 8 from REF
+        tol = cell_tolerance(OSM, CELLS, REF, BOXES, [0.0, 50.0], 5.0)
+        self.assertEqual(tol[0], 0.0)
+        self.assertTrue(np.isnan(tol[1]))
+
+    def test_boxes(self):
+        # Only the end of the corner is inside the box of the second cell
+        boxes = np.array([[-10.0, -10.0, 200.0, 200.0],
+                          [90.0, 30.0, 110.0, 60.0]])
+        tol = cell_tolerance(OSM, CELLS, REF, boxes, [0.0, 1.0], 20.0)
+        osm = OSM[CELLS == 1]
+        ref = np.array([[100.0, 30.0, 100.0, 50.0]])
+        self.assertAlmostEqual(tol[1], bisection(osm, ref, 1.0, 20.0),
+                               delta=1e-4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+#  -*- coding:utf-8 -*-
+##############################################################################
+# MODULE:    tests.test_distprofile
+# AUTHOR(S): Monia Molinari, Marco Minghini
+# PURPOSE:   Tests of the distance profiles against exact lengths
+# COPYRIGHT: (C) 2015 by the GRASS Development Team
+#
+# This program is free software under the GNU General Public
+# License (>=v2). Read the file COPYING that comes with GRASS
+# for details.
+# ############################################################################
+"""Tests of libosm.distprofile.
+
+The profiles are built from pieces measured in memory like v.split and
+v.distance do, and compared with the exact lengths of libosm.cells. The
+comparison of the profile and overlay methods of v.osm.precomp is skipped
+outside a GRASS session.
+"""
+
+import math
+import unittest
+
+import numpy as np
+
+from helpers import GrassTestCase
+
+from libosm.cells import covered, lengths, pairs
+from libosm.distprofile import make_profile, profile_distance, profile_length
+
+# OSM moves away from REF with slope 0.1, then bends around the inner side
+# of a REF corner
+REF = np.array([[0.0, 0.0, 100.0, 0.0],
+                [100.0, 0.0, 100.0, 50.0]])
+OSM = np.array([[0.0, 1.0, 50.0, 6.0],
+                [50.0, 6.0, 95.0, 8.0],
+                [95.0, 8.0, 96.0, 40.0]])
+
+
+def _point_distance(points, segs):
+    # Distance of every point from the nearest segment
+    p = points[:, None, :]
+    a = segs[None, :, 0:2]
+    d = segs[None, :, 2:4] - a
+    t = np.clip(((p - a) * d).sum(axis=2) / (d * d).sum(axis=2), 0, 1)
+    return np.hypot(*(a + t[:, :, None] * d - p).transpose(2, 0, 1)).min(1)
+
+
+def measured_pieces(data, other, step):
+    """Return the pieces of data not longer than step with their smallest
+    and largest distance from other, sampled finely"""
+    pieces = []
+    for x1, y1, x2, y2 in data.tolist():
+        n = int(math.ceil(math.hypot(x2 - x1, y2 - y1) / step))
+        for k in range(n):
+            t = np.linspace(float(k) / n, float(k + 1) / n, 101)
+            d = _point_distance(np.column_stack((x1 + t * (x2 - x1),
+                                                 y1 + t * (y2 - y1))), other)
+            ends = d[[0, -1]]
+            pieces.append((float(d.min()), float(ends.max()),
+                           math.hypot(x2 - x1, y2 - y1) / n))
+    return pieces
+
+
+def exact_length(data, other, buff):
+    i_data, i_other = pairs(data, other, buff)
+    return float(covered(data, other, i_data, i_other, buff).sum())
+
+
+class ProfileTest(unittest.TestCase):
+
+    def test_steps(self):
+        # Pieces at a single distance give a step profile
+        profile = make_profile([(1.0, 1.0, 10.0), (2.0, 2.0, 5.0)], 20.0)
+        self.assertEqual(profile_length(profile, 0.5), (0, 20.0))
+        self.assertEqual(profile_length(profile, 1.0), (10.0, 20.0))
+        self.assertEqual(profile_length(profile, 1.5), (10.0, 20.0))
+        self.assertEqual(profile_length(profile, 3.0), (15.0, 20.0))
+        self.assertEqual(profile_distance(profile, 12.0), 2.0)
+        self.assertEqual(profile_distance(profile, 16.0), None)
+
+    def test_empty(self):
+        profile = make_profile([], 5.0)
+        self.assertEqual(profile_length(profile, 1.0), (0, 5.0))
+        self.assertEqual(profile_distance(profile, 1.0), None)
+
+    def test_linear(self):
+        # A straight line moving away from REF is measured exactly
+        step = 5.0
+        pieces = measured_pieces(OSM[:1], REF, step)
+        total = float(lengths(OSM[:1]).sum())
+        profile = make_profile(pieces, total)
+        for buff in (1.0, 2.3, 4.75, 6.0):
+            self.assertAlmostEqual(profile_length(profile, buff)[0],
+                                   exact_length(OSM[:1], REF, buff))
+        # TOL of the whole line is its largest distance
+        self.assertAlmostEqual(profile_distance(profile, total), 6.0)
+        self.assertAlmostEqual(profile_distance(profile, total / 2), 3.5)
+
+    def test_bound(self):
+        # Elsewhere the error is bounded by step for every piece crossing
+        # the buffer border
+        for step in (0.5, 2.0, 5.0):
+            pieces = measured_pieces(OSM, REF, step)
+            profile = make_profile(pieces, float(lengths(OSM).sum()))
+            for buff in (1.0, 3.0, 5.0, 7.0, 10.0):
+                crossing = sum(1 for low, high, l in pieces
+                               if low <= buff < high)
+                self.assertLessEqual(
+                    abs(profile_length(profile, buff)[0] -
+                        exact_length(OSM, REF, buff)),
+                    step * crossing + 1e-6)
+
+
+class PrecompTest(GrassTestCase):
+    """The profile method of v.osm.precomp against the overlay one"""
+
+    PREFIX = "test_profile_"
+    MAPS = {"test_profile_osm": OSM, "test_profile_ref": REF}
+
+    def test_profile(self):
+        options = {"osm": "test_profile_osm", "ref": "test_profile_ref",
+                   "buffers": "1,3,5,7"}
+        overlay = self.precomp_rows(method="overlay", **options)
+        profile = self.precomp_rows(method="profile", step=0.5, **options)
+        for row, other in zip(overlay, profile):
+            for column in ("osm_in", "ref_in"):
+                self.assertAlmostEqual(row[column], other[column], delta=1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
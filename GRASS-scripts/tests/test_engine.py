@@ -0,0 +1,163 @@
+#  -*- coding:utf-8 -*-
+##############################################################################
+# MODULE:    tests.test_engine
+# AUTHOR(S): Monia Molinari, Marco Minghini
+# PURPOSE:   Tests of libosm.engine against known lengths and the modules
+# COPYRIGHT: (C) 2015 by the GRASS Development Team
+#
+# This program is free software under the GNU General Public
+# License (>=v2). Read the file COPYING that comes with GRASS
+# for details.
+# ############################################################################
+"""Tests of the file based engine.
+
+The engine is checked on a small fixture whose lengths are known. The
+comparison with the overlay method of the modules needs a GRASS session on
+a projected location and is skipped without it.
+"""
+
+import os
+import unittest
+
+import numpy as np
+
+from helpers import GrassTestCase
+
+from libosm.cells import lengths
+from libosm.engine import (buffer_stats, enlarge_boxes, grid_accuracy,
+                           match_pieces)
+
+# Three cells of 10 x 10 from (0, 0) to (30, 10); OSM runs 1 north of REF,
+# then goes on along the REF direction 2 beyond its end, where it is a
+# dead end, and has a road crossing REF at right angle
+REF = np.array([[0.0, 4.0, 20.0, 4.0]])
+OSM = np.array([[0.0, 5.0, 20.0, 5.0],
+                [22.0, 4.0, 24.0, 4.0],
+                [5.0, 0.0, 5.0, 9.0]])
+GRID = (0.0, 10.0, 10.0, 10.0, 1, 3)
+
+
+class BufferStatsTest(unittest.TestCase):
+
+    def test_parallel(self):
+        stats = buffer_stats(OSM[:1], REF, [0.5, 2.0])
+        self.assertEqual(len(stats), 2)
+        ref_in, ref_out, osm_in, osm_out = stats[0]
+        self.assertAlmostEqual(ref_in, 0.0)
+        self.assertAlmostEqual(osm_in, 0.0)
+        self.assertAlmostEqual(osm_out, 20.0)
+        ref_in, ref_out, osm_in, osm_out = stats[1]
+        self.assertAlmostEqual(ref_in, 20.0)
+        self.assertAlmostEqual(ref_out, 0.0)
+        self.assertAlmostEqual(osm_in, 20.0)
+
+    def test_round_caps(self):
+        # Only the first unit of the segment beyond the REF end is within
+        # a round buffer of 3
+        ref_in, ref_out, osm_in, osm_out = buffer_stats(OSM[1:2], REF,
+                                                        [3.0])[0]
+        self.assertAlmostEqual(osm_in, 1.0)
+        self.assertAlmostEqual(osm_out, 1.0)
+
+    def test_no_buffers(self):
+        self.assertEqual(buffer_stats(OSM, REF, []), [])
+
+
+class MatchPiecesTest(unittest.TestCase):
+
+    def test_angle_and_flat_caps(self):
+        # The crossing road is rejected by the angle, the segment beyond
+        # the dead end by the flat cap
+        pieces = match_pieces(OSM, REF, 2.0, 30.0)
+        self.assertEqual(pieces.shape, (1, 4))
+        self.assertAlmostEqual(float(lengths(pieces).sum()), 20.0)
+
+    def test_merge(self):
+        # The pieces accepted by two REF segments are merged
+        ref = np.array([[0.0, 4.0, 10.0, 4.0], [10.0, 4.0, 20.0, 4.0]])
+        pieces = match_pieces(OSM[:1], ref, 2.0, 30.0)
+        self.assertEqual(pieces.shape, (1, 4))
+        self.assertAlmostEqual(float(lengths(pieces).sum()), 20.0)
+
+    def test_empty(self):
+        pieces = match_pieces(OSM[2:], REF, 2.0, 30.0)
+        self.assertEqual(pieces.shape, (0, 4))
+
+
+class GridAccuracyTest(unittest.TestCase):
+
+    def test_boxes(self):
+        boxes = enlarge_boxes([[0.0, 0.0, 10.0, 10.0]])
+        np.testing.assert_allclose(boxes, [[-0.5, -0.5, 10.5, 10.5]])
+
+    def test_tol_eval(self):
+        cells, boxes, values = grid_accuracy(OSM, REF, *GRID,
+                                             tol_eval=["0.5", "2"])
+        self.assertEqual(cells.tolist(), [0, 1, 2])
+        np.testing.assert_allclose(boxes[0], [0.0, 0.0, 10.0, 10.0])
+        self.assertAlmostEqual(values[0]["OSM"], 19.0)
+        self.assertAlmostEqual(values[0]["t_0.5"], 1.0)
+        self.assertAlmostEqual(values[0]["t_2"], 14.0)
+        self.assertAlmostEqual(values[1]["t_2"], 10.0)
+        self.assertAlmostEqual(values[1]["p_2"], 100.0)
+        # The third cell has no REF pieces
+        self.assertEqual(values[2], {"OSM": 2.0})
+
+    def test_tol_max(self):
+        # The crossing road of the first cell reaches 5 from REF
+        cells, boxes, values = grid_accuracy(OSM, REF, *GRID, tol_max=4.5,
+                                             perc=100.0)
+        # TOL is rounded up to the next hundredth
+        self.assertEqual(values[1]["TOL"], 1.0)
+        self.assertNotIn("TOL", values[0])
+        values = grid_accuracy(OSM, REF, *GRID, tol_max=0.5)[2]
+        self.assertNotIn("TOL", values[1])
+
+
+class ModulesTest(GrassTestCase):
+    """The engine against the overlay method of the modules"""
+
+    PREFIX = "test_engine_"
+    MAPS = {"test_engine_osm": OSM, "test_engine_ref": REF}
+    INPUTS = {"osm": "test_engine_osm", "ref": "test_engine_ref"}
+
+    def test_precomp(self):
+        rows = self.precomp_rows(buffers="1.5,3", **self.INPUTS)
+        for row, stats in zip(rows, buffer_stats(OSM, REF, [1.5, 3.0])):
+            # v.buffer approximates the round caps
+            self.assertAlmostEqual(row["ref_in"], stats[0], delta=0.1)
+            self.assertAlmostEqual(row["osm_in"], stats[2], delta=0.1)
+
+    def test_preproc(self):
+        # The module clips the OSM lines with a buffer of 0.0001 around
+        # the accepted pieces, the engine writes the pieces themselves
+        out = os.path.join(self.tmp, "preproc.txt")
+        self.run_module("v.osm.preproc", buffer=2, angle_thres=30,
+                        output="test_engine_out", out_file=out,
+                        **self.INPUTS)
+        for line in open(out):
+            if line.startswith("Processed OSM dataset length"):
+                length = float(line.split(": ")[1].split(" ")[0])
+        pieces = match_pieces(OSM, REF, 2.0, 30.0)
+        self.assertAlmostEqual(length, float(lengths(pieces).sum()),
+                               delta=0.1)
+
+    def test_acc(self):
+        self.run_module("v.osm.acc", ul_grid="10,0", lr_grid="0,30",
+                        box_grid="10,10", tol_eval="0.5,2",
+                        output="test_engine_acc", **self.INPUTS)
+        data = self.grass.read_command("v.db.select", map="test_engine_acc",
+                                       columns="OSM,t_2", flags="c",
+                                       quiet=True)
+        rows = [[float(v) if v else None for v in item.split("|")]
+                for item in data.split("\n")[0:-1]]
+        values = grid_accuracy(OSM, REF, *GRID, tol_eval=["0.5", "2"])[2]
+        self.assertEqual(len(rows), len(values))
+        for (l_osm, t_2), val in zip(rows, values):
+            self.assertAlmostEqual(l_osm, val["OSM"], delta=0.01)
+            if t_2 is not None:
+                self.assertAlmostEqual(t_2, val["t_2"], delta=0.1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+#  -*- coding:utf-8 -*-
+##############################################################################
+# MODULE:    tests.test_matcher
+# AUTHOR(S): Monia Molinari, Marco Minghini
+# PURPOSE:   Tests of the buffers of the in-memory matcher
+# COPYRIGHT: (C) 2015 by the GRASS Development Team
+#
+# This program is free software under the GNU General Public
+# License (>=v2). Read the file COPYING that comes with GRASS
+# for details.
+# ############################################################################
+"""Tests of libosm.matcher.
+
+The parts of OSM segments inside the buffers of REF segments are compared
+with lengths computed by hand.
+"""
+
+import math
+import unittest
+
+import numpy as np
+
+import helpers  # noqa: F401
+
+from libosm.matcher import buffer_intervals
+
+REF = np.array([[0.0, 0.0, 10.0, 0.0]])
+
+
+def inside_length(osm, dist, flat=False):
+    t_min, t_max = buffer_intervals(REF, osm, dist, np.array([flat]))
+    length = math.hypot(osm[0, 2] - osm[0, 0], osm[0, 3] - osm[0, 1])
+    return max(float(t_max[0] - t_min[0]), 0.0) * length
+
+
+class BufferIntervalsTest(unittest.TestCase):
+
+    def test_flat_and_round(self):
+        # Along REF and 2 beyond its end: the round cap adds 1 of the
+        # segment beyond the end, the flat one nothing
+        osm = np.array([[5.0, 0.5, 12.0, 0.5]])
+        self.assertAlmostEqual(inside_length(osm, 1.0), 5.0 + math.sqrt(0.75))
+        self.assertAlmostEqual(inside_length(osm, 1.0, flat=True), 5.0)
+
+    def test_outside(self):
+        osm = np.array([[0.0, 2.0, 10.0, 2.0]])
+        self.assertAlmostEqual(inside_length(osm, 1.0), 0.0)
+        self.assertAlmostEqual(inside_length(osm, 2.0), 10.0)
+
+    def test_cap_only(self):
+        # The line y = x + 1.2 misses the rectangle of the buffer and
+        # crosses the cap around the start of REF
+        osm = np.array([[-3.0, -1.8, 3.0, 4.2]])
+        chord = 2 * math.sqrt(1 - 1.2 ** 2 / 2)
+        self.assertAlmostEqual(inside_length(osm, 1.0), chord)
+        self.assertAlmostEqual(inside_length(osm, 1.0, flat=True), 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
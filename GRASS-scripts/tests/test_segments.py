@@ -0,0 +1,115 @@
+#  -*- coding:utf-8 -*-
+##############################################################################
+# MODULE:    tests.test_segments
+# AUTHOR(S): Monia Molinari, Marco Minghini
+# PURPOSE:   Tests of the in-memory segments and their index
+# COPYRIGHT: (C) 2015 by the GRASS Development Team
+#
+# This program is free software under the GNU General Public
+# License (>=v2). Read the file COPYING that comes with GRASS
+# for details.
+# ############################################################################
+"""Tests of libosm.segments.
+
+The queries of the grid index are compared with a comparison of all the
+bounding boxes; keys and node degrees are checked on small networks.
+"""
+
+import unittest
+
+import numpy as np
+
+import helpers  # noqa: F401
+
+from libosm.matcher import candidates
+from libosm.segments import GridIndex, min_degree, segment_keys
+
+
+def random_segments(rng, count, low, high, side):
+    coords = rng.uniform(low, high, (count, 4))
+    coords[:, 2:4] = coords[:, 0:2] + rng.uniform(-side, side, (count, 2))
+    return coords
+
+
+def bounds(coords):
+    return (np.minimum(coords[:, 0], coords[:, 2]),
+            np.minimum(coords[:, 1], coords[:, 3]),
+            np.maximum(coords[:, 0], coords[:, 2]),
+            np.maximum(coords[:, 1], coords[:, 3]))
+
+
+class SegmentKeysTest(unittest.TestCase):
+
+    def test_direction(self):
+        keys = segment_keys(np.array([[1.0, 2.0, 3.0, 4.0],
+                                      [3.0, 4.0, 1.0, 2.0],
+                                      [1.0, 2.0, 3.0, 4.0000001]]))
+        self.assertEqual(keys[0], "1.000000 2.000000 3.000000 4.000000")
+        self.assertEqual(keys[0], keys[1])
+        self.assertEqual(keys[0], keys[2])
+
+    def test_negative_zero(self):
+        keys = segment_keys(np.array([[-0.0, 1.0, 2.0, -0.0000001]]))
+        self.assertEqual(keys, ["0.000000 1.000000 2.000000 0.000000"])
+
+
+class MinDegreeTest(unittest.TestCase):
+
+    def test_dead_ends(self):
+        # A T junction: the three dead ends have degree 1
+        cats = np.array([1, 1, 2])
+        coords = np.array([[0.0, 0.0, 5.0, 0.0],
+                           [5.0, 0.0, 10.0, 0.0],
+                           [5.0, 0.0, 5.0, 5.0]])
+        self.assertEqual(min_degree(cats, coords), set([1, 2]))
+
+    def test_ring(self):
+        # Every node of a closed ring has degree 2
+        cats = np.array([1, 2, 3])
+        coords = np.array([[0.0, 0.0, 1.0, 0.0],
+                           [1.0, 0.0, 0.0, 1.0],
+                           [0.0, 1.0, 0.0, 0.0]])
+        self.assertEqual(min_degree(cats, coords), set([1, 2, 3]))
+
+    def test_empty(self):
+        self.assertEqual(min_degree(np.zeros(0, dtype=int),
+                                    np.zeros((0, 4))), set())
+
+
+class GridIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.osm = random_segments(rng, 500, 0.0, 1000.0, 30.0)
+        # Some REF segments fall outside the grid of the index
+        self.ref = random_segments(rng, 200, -100.0, 1100.0, 30.0)
+
+    def test_candidates(self):
+        i_ref, i_osm = candidates(GridIndex(self.osm), self.ref, 5.0)
+        o_w, o_s, o_e, o_n = bounds(self.osm)
+        r_w, r_s, r_e, r_n = bounds(self.ref)
+        near = ((o_w[None, :] <= r_e[:, None] + 5) &
+                (o_e[None, :] >= r_w[:, None] - 5) &
+                (o_s[None, :] <= r_n[:, None] + 5) &
+                (o_n[None, :] >= r_s[:, None] - 5))
+        e_ref, e_osm = np.nonzero(near)
+        self.assertTrue(len(e_ref) > 0)
+        np.testing.assert_array_equal(i_ref, e_ref)
+        np.testing.assert_array_equal(i_osm, e_osm)
+
+    def test_query(self):
+        o_w, o_s, o_e, o_n = bounds(self.osm)
+        found = GridIndex(self.osm).query(100.0, 200.0, 300.0, 250.0)
+        expected = np.flatnonzero((o_w <= 300) & (o_e >= 100) &
+                                  (o_s <= 250) & (o_n >= 200))
+        np.testing.assert_array_equal(found, expected)
+
+    def test_empty(self):
+        index = GridIndex(np.zeros((0, 4)))
+        self.assertEqual(len(index.query(0.0, 0.0, 10.0, 10.0)), 0)
+        i_ref, i_osm = candidates(index, self.ref, 5.0)
+        self.assertEqual((len(i_ref), len(i_osm)), (0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
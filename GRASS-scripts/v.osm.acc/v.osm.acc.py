@@ -54,6 +54,13 @@
 #% required: no
 #%end
 #%option G_OPT_V_INPUT
+#% key: previous
+#% guisection: Grid
+#% label: Output grid of a previous run
+#% description: Results of the cells whose OSM and REF geometry did not change are copied from this map
+#% required: no
+#%end
+#%option G_OPT_V_INPUT
 #% key: output
 #% type: string
 #% guisection: Grid
@@ -82,11 +89,63 @@
 #% description: Threshold values for accuracy evaluation, separated by comma (map units)
 #% required: no
 #%end
+#%option
+#% key: method
+#% type: string
+#% guisection: Deviation analysis
+#% options: overlay,profile,memory
+#% description: Evaluation method: buffer overlays, distance profiles or in-memory pieces
+#% answer: overlay
+#% required: no
+#%end
+#%option
+#% key: step
+#% type: double
+#% guisection: Deviation analysis
+#% description: Maximum length of the OSM pieces measured by the profile method (map units)
+#% answer: 1
+#% required: no
+#%end
+#%option
+#% key: nprocs
+#% type: integer
+#% description: Number of processes evaluating the cells with the overlay and profile methods
+#% answer: 1
+#% required: no
+#%end
+#%option G_OPT_F_OUTPUT
+#% key: profile
+#% description: Name for output JSON file with the time spent in each stage and GRASS module
+#% required: no
+#%end
+#%flag
+#% key: f
+#% guisection: Grid
+#% description: Store the fingerprint of every cell, so that the output can be the previous map of a later run
+#%end
 
+import os
 import sys
 import math
 import time
+import numpy as np
 import grass.script as grass
+from grass.pygrass.utils import set_path
+
+set_path('v.osm', 'libosm',
+         os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from libosm import instrument
+from libosm.cells import cell_fingerprints, clip_boxes, lattice_pieces
+from libosm.dag import Graph
+from libosm.distprofile import get_profile, get_profiles, profile_distance, profile_length
+from libosm.engine import cell_tolerances, cell_values
+from libosm.geomstats import length, nlines
+from libosm.pool import run_tasks
+from libosm.segments import GridIndex, read_boxes, read_segments, write_segments
+
+## REF segments and their index, by map name
+REF_INDEX = {}
+
 
 def GetList(vect):
     list_vect = grass.read_command("v.db.select",map=vect,columns="cat",flags="c",quiet=True)
@@ -98,41 +157,45 @@ def MakeGrid(n,w,s,e,nsres,ewres,out):
     cols = math.ceil(float((e-w)/ewres))   
     grass.run_command("g.region",n=n,s=n-nsres*rows,e=w+ewres*cols,w=w,quiet=True)    
     grass.run_command("v.mkgrid",map=out,grid="%s,%s"%(rows,cols),quiet=True)
+    return int(rows), int(cols)
+
+def BigBox(box):
+    # Box 10% bigger than the cell (west,south,east,north)
+    w,s,e,n = box
+    ns_ext = (math.ceil(n-s))*10/100
+    ew_ext = (math.ceil(e-w))*10/100
+    return (w-ew_ext/2,s-ns_ext/2,e+ew_ext/2,n+ns_ext/2)
 
-def GetRefBox(ref,ref_box,k_box,processid):    
-    N = grass.region()['n']
-    S = grass.region()['s']
-    E = grass.region()['e']
-    W = grass.region()['w']
-    grass.run_command("g.region",vect=k_box,quiet=True)
-    ns_ext = (math.ceil(grass.region()['n']-grass.region()['s']))*10/100
-    ew_ext = (math.ceil(grass.region()['e']-grass.region()['w']))*10/100
-    grass.run_command("g.region",n=grass.region()['n']+ns_ext/2,s=grass.region()['s']-ns_ext/2,w=grass.region()['w']-ew_ext/2,e=grass.region()['e']+ew_ext/2,quiet=True)
-    grass.run_command("v.in.region",output="new_box_%s"%processid,quiet=True)
-    grass.run_command("v.overlay",ainput=ref,atype="line",binput="new_box_%s"%processid,btype="area",operator="and",output=ref_box,quiet=True)
-    grass.run_command("g.remove",type="vect", name="new_box_%s"%processid,flags="f",quiet=True)
-    grass.run_command("g.region",n=N,s=S,e=E,w=W,quiet=True)
+def GetRefBox(ref,ref_box,box):    
+    # REF segments are read and indexed once for each process, then clipped
+    # with the bigger box of the cell
+    if ref not in REF_INDEX:
+        cats,coords = read_segments(ref)
+        REF_INDEX[ref] = (cats,coords,GridIndex(coords))
+    cats,coords,index = REF_INDEX[ref]
+    big_box = BigBox(box)
+    found = index.query(*big_box)
+    clipped,inside = clip_boxes(coords[found],np.tile(big_box,(len(found),1)))
+    write_segments(ref_box,clipped[inside],cats[found][inside])
     
-def AddCol(vect,t):
-    list_c = []
-    list_col = ((grass.read_command("db.describe",table=vect,flags="c",quiet=True)).split("\n"))[2:-1]
-    for c in list_col:
-        list_c.append((c.split(":")[1]).lstrip())
-    if not "%s"%t in list_c:
-        grass.run_command("v.db.addcolumn",map=vect,columns="%s double"%t,quiet=True)
+def AddCols(vect,cols,coltype="double"):
+    # Check the columns once and add the missing ones with a single call
+    list_c = [c.lower() for c in grass.vector_columns(vect)]
+    new_cols = ["%s %s"%(t,coltype) for t in cols if not t.lower() in list_c]
+    if new_cols:
+        grass.run_command("v.db.addcolumn",map=vect,columns=",".join(new_cols),quiet=True)
+
+def UpdateTable(vect,results):
+    # Write all the values at once: db.execute runs the statements in a
+    # single transaction
+    db = grass.vector_db(vect)[1]
+    sql = []
+    for k in sorted(results,key=int):
+        values = ",".join("%s=%s"%(c,"'%s'"%v if isinstance(v,str) else repr(float(v))) for c,v in sorted(results[k].items()))
+        sql.append("UPDATE %s SET %s WHERE %s=%s;\n"%(db["table"],values,db["key"],k))
+    if sql:
+        grass.write_command("db.execute",input="-",database=db["database"],driver=db["driver"],stdin="".join(sql),quiet=True)
         
-def length(data):
-    feat_data = int(((grass.read_command("v.info", map=data,flags="t")).split("\n")[2]).split("=")[1])
-    if feat_data>0:
-        length_data = grass.read_command("v.to.db",map=data,option="length",flags="p")
-        s_data=0 
-        l_data = length_data.split("\n")
-        for item in l_data[1:-1]:
-            s_data+=float(item.split("|")[1])         
-    else:
-        s_data=0
-    return s_data
-   
 def CalcTol(data1,data2,value):
     processid = str(time.time()).replace(".","_")
     grass.run_command("v.buffer",input=data1,output="data1_buf_"+processid,distance=value,quiet=True)
@@ -141,6 +204,171 @@ def CalcTol(data1,data2,value):
     grass.run_command("g.remove",type="vect", pattern=processid,flags="fr",quiet=True)
     return val
 
+def GridProfiles(osm,ref,grid,step,dmax,processid,cats=None):
+    # Clip OSM and REF with the whole grid at once, then measure the distance
+    # of every OSM piece from the REF lines of its own box
+    osm_grid = "osm_grid_"+processid
+    ref_grid = "ref_grid_"+processid
+    if cats is not None:
+        # Only the given boxes are clipped and measured
+        if len(cats) == 0:
+            return {}, set()
+        grid_cats = "grid_cats_"+processid
+        cats_file = grass.tempfile()
+        fil = open(cats_file,"w")
+        fil.write("\n".join(cats)+"\n")
+        fil.close()
+        grass.run_command("v.extract",input=grid,output=grid_cats,file=cats_file,quiet=True)
+        os.remove(cats_file)
+        grid = grid_cats
+    graph = Graph()
+    graph.command(osm_grid,"v.overlay",ainput=osm,atype="line",binput=grid,btype="area",operator="and",output=osm_grid,quiet=True)
+    graph.command(ref_grid,"v.overlay",ainput=ref,atype="line",binput=grid,btype="area",operator="and",output=ref_grid,quiet=True)
+    graph.run(2)
+    profiles = get_profiles(osm_grid,ref_grid,step,dmax,processid,"b_cat")
+    ref_boxes = set(grass.read_command("v.db.select",map=ref_grid,columns="b_cat",flags="c",quiet=True).split("\n")[0:-1])
+    return profiles, ref_boxes
+
+def EvalBox(args):
+    # Length of OSM within every tolerance from REF in box k
+    k,osm,ref,output,list_tol,processid = args
+    k_box = "k_box_"+processid
+    osm_box = "osm_box_"+processid
+    ref_box = "ref_box_"+processid
+    values = {}
+    # OSM and REF clips only depend on the box
+    graph = Graph()
+    graph.command(k_box,"v.extract",input=output,output=k_box,where="cat=%s"%k,quiet=True)
+    graph.command(osm_box,"v.overlay",after=[k_box],ainput=osm,atype="line",binput=k_box,btype="area",operator="and",output=osm_box,quiet=True)
+    graph.command(ref_box,"v.overlay",after=[k_box],ainput=ref,atype="line",binput=k_box,btype="area",operator="and",output=ref_box,quiet=True)
+    graph.run(2)
+    l_osm = length(osm_box)
+    values["OSM"] = l_osm
+    feat_ref_box = nlines(ref_box)
+    if feat_ref_box>0:
+        for item in list_tol:
+            val = CalcTol(ref_box,osm_box,float(item))
+            values["t_%s"%item] = val
+            values["p_%s"%item] = val*100.0/l_osm
+    grass.run_command("g.remove",type="vect", pattern=processid,flags="fr",quiet=True)
+    return k, values
+
+def TolBox(args):
+    # Tolerance containing the required OSM length of box k
+    k,box,osm,ref,output,tol_max,perc,method,step,processid = args
+    k_box = "k_box_"+processid
+    osm_box = "osm_box_"+processid
+    ref_box = "ref_box_"+processid
+    acc = 0.005
+    values = {}
+    # OSM clip and REF_BOX data in slightly bigger box only depend on the box
+    graph = Graph()
+    graph.command(k_box,"v.extract",input=output,output=k_box,where="cat=%s"%k,quiet=True)
+    graph.command(osm_box,"v.overlay",after=[k_box],ainput=osm,atype="line",binput=k_box,btype="area",operator="and",output=osm_box,quiet=True)
+    graph.add(ref_box,GetRefBox,(ref,ref_box,box))
+    graph.run(2)
+    real_l_osm = length(osm_box)
+    if perc == 100.0:
+        l_osm = real_l_osm
+    else:
+        l_osm = real_l_osm*float(perc)/100.0
+
+    values["OSM"] = real_l_osm
+    if length(ref_box)>0:
+        if method == "profile":
+            # TOL is the distance within which l_osm of the box lies
+            x = profile_distance(get_profile(osm_box,ref_box,step,float(tol_max),processid),l_osm)
+            ## The profile reaches beyond tol_max by up to one step
+            exit = 1 if x is not None and x <= float(tol_max) else 2
+        else:
+            x = 0
+            val = 0
+            UP = float(tol_max)
+            DOWN = 0.0
+            up = float(tol_max)
+            down = 0.0
+            mid = down + (up-down)/2
+            exit = 0
+            while exit==0:
+                val = CalcTol(ref_box,osm_box,mid)
+
+                if val >= l_osm: # all in
+                    new_mid = down + (mid-down)/2
+                    up = mid
+                    mid = new_mid
+
+                elif val < l_osm: # not all in
+
+                    if not down < mid + acc < up:
+                        if up!=UP:
+                            x = up
+                            exit = 1
+                        else:
+                            exit = 2
+                    else:
+                        val = CalcTol(ref_box,osm_box,mid + acc)
+
+                    if val >= l_osm:  # all in (considering epsilon)
+                        x = mid + acc
+                        exit = 1
+                    elif val < l_osm:  # not all in (considering epsilon)
+                        new_mid =(mid+acc) + (up-(mid+acc))/2
+                        down = mid + acc
+                        mid = new_mid
+        if exit == 1:
+            values["TOL"] = (math.ceil(x*100))/100
+    grass.run_command("g.remove",type="vect",pattern=processid,flags="fr")
+    return k, values
+
+def CopyPrevious(previous,fingerprints,columns):
+    # Results of the boxes whose fingerprint is unchanged, and boxes to compute
+    old = grass.vector_db_select(previous)
+    names = dict((c.lower(),c) for c in columns)
+    cols = [c.lower() for c in old["columns"]]
+    if not "fp" in cols:
+        grass.fatal(_("Vector map <%s> has no fingerprints") % previous)
+    i_fp = cols.index("fp")
+    results = {}
+    todo = []
+    for k in sorted(fingerprints,key=int):
+        row = old["values"].get(int(k))
+        if row and row[i_fp] == fingerprints[k]:
+            results[k] = dict((names[c],float(v)) for c,v in zip(cols,row) if c in names and v != "")
+        else:
+            todo.append(k)
+    return results, todo
+
+def LatticeCats(grid,lattice):
+    # Lattice cell of every box, from the coordinates of its centroid
+    w,n,ewres,nsres,rows,cols = lattice
+    cats = {}
+    coords = grass.read_command("v.to.db",map=grid,option="coor",type="centroid",flags="p",quiet=True).split("\n")[1:-1]
+    for item in coords:
+        c = item.split("|")
+        cats[int(math.floor((n-float(c[2]))/nsres))*cols+int(math.floor((float(c[1])-w)/ewres))] = c[0]
+    return cats
+
+def CellPieces(data,grid,lattice,processid):
+    # Pieces of data and the category of the box of every piece
+    if lattice:
+        # Pieces are split at the box edges and assigned by their coordinates
+        cell_cats = LatticeCats(grid,lattice)
+        pieces, cells = lattice_pieces(read_segments(data)[1],*lattice)
+        return pieces, [cell_cats.get(c) for c in cells]
+    # Single clip with the whole grid, boxes are read from the attributes
+    data_grid = "grid_%s_%s"%(data.split("@")[0],processid)
+    grass.run_command("v.overlay",ainput=data,atype="line",binput=grid,btype="area",operator="and",output=data_grid,quiet=True)
+    b_cats = dict(item.split("|")[0:2] for item in grass.read_command("v.db.select",map=data_grid,columns="cat,b_cat",flags="c",quiet=True).split("\n")[0:-1])
+    piece_cats, pieces = read_segments(data_grid)
+    grass.run_command("g.remove",type="vect",name=data_grid,flags="f",quiet=True)
+    return pieces, [b_cats.get(str(c)) for c in piece_cats]
+
+def BoxPieces(pieces,cats,list_box):
+    # Keep the pieces in the boxes of list_box, with the position of their box
+    position = dict((k,i) for i,k in enumerate(list_box))
+    keep = np.array([c in position for c in cats],dtype=bool)
+    return pieces[keep], np.array([position[c] for c in cats if c in position],dtype=int)
+
 def main():
     osm = options["osm"]
     ref =  options["ref"] 
@@ -152,14 +380,23 @@ def main():
     tol_eval = options["tol_eval"]
     tol_max = options["tol_max"]
     perc = float(options["perc"])
+    method = options["method"]
+    step = float(options["step"])
+    nproc = int(options["nprocs"])
+    previous = options["previous"]
+    profile = options["profile"]
+    store_fp = flags["f"] or len(previous)>0
 
-    
+    if profile:
+        instrument.enable()
 
     ## Check if input files exist
-    if not grass.find_file(name=osm,element='vector')['file']:
+    osm_file = grass.find_file(name=osm,element='vector')
+    if not osm_file['file']:
         grass.fatal(_("Vector map <%s> not found") % osm)
 
-    if not grass.find_file(name=ref,element='vector')['file']:
+    ref_file = grass.find_file(name=ref,element='vector')
+    if not ref_file['file']:
         grass.fatal(_("Vector map <%s> not found") % ref)
 
     if grass.find_file(name=output,element='vector')['file']:
@@ -169,7 +406,12 @@ def main():
         if not grass.find_file(name=grid,element='vector')['file']:
             grass.fatal(_("Vector map <%s> not found") % grid)
 
+    if len(previous)>0:
+        if not grass.find_file(name=previous,element='vector')['file']:
+            grass.fatal(_("Vector map <%s> not found") % previous)
+
     # Check length OSM and REF
+    instrument.stage("lengths")
     check_ref = length(ref)
     check_osm = length(osm)
 
@@ -190,6 +432,12 @@ def main():
         grass.fatal("Please specify almost one between <tol_eval> or <tol_max> parameters")
     
     
+    if nproc < 1:
+        grass.fatal(_("Option <nprocs> must be at least 1"))
+
+    if method == "profile" and step <= 0:
+        grass.fatal(_("Option <step> must be greater than zero"))
+
     ## Check grid parameters
     if (len(grid)>0 and (len(ul_grid)>0 or len(lr_grid)>0 or len(box_grid)>0 or len(output)>0)):
         grass.warning("A <grid> vector has been specified. All the others parameters will be ignored")    
@@ -204,12 +452,13 @@ def main():
 
     # Prepare temporary map raster names
     processid = str(time.time()).replace(".","_")  
-    k_box = "k_box_"+processid
-    osm_box = "osm_box_"+processid
-    ref_box = "ref_box_"+processid
+    mapset = grass.gisenv()["MAPSET"]
     tmp_output = "tmp_out_"+processid
+    lattice = None
+    osm_pieces = None
     
     # Get or create grid #    
+    instrument.stage("grid")
     if (len(grid)>0):
         tmp_output = grid
         grass.run_command("g.region",vect=grid,quiet=True) 
@@ -220,7 +469,8 @@ def main():
         e = float(lr_grid.split(",")[1])
         nsres = float(box_grid.split(",")[1])
         ewres = float(box_grid.split(",")[0])    
-        MakeGrid(n,w,s,e,nsres,ewres,tmp_output)        
+        rows, cols = MakeGrid(n,w,s,e,nsres,ewres,tmp_output)
+        lattice = (w,n,ewres,nsres,rows,cols)
     if (len(grid)==0 and len(ul_grid)==0 and len(lr_grid)==0 and len(box_grid)==0 and len(output)>0):
         grass.run_command("g.region",vect=ref,quiet=True)
         grass.run_command("v.in.region",output=output,quiet=True)  
@@ -228,89 +478,108 @@ def main():
     
     # Extract box id with where OSM data exists
     if not (len(grid)==0 and len(ul_grid)==0 and len(lr_grid)==0 and len(box_grid)==0 and len(output)>0):
-        grass.run_command("v.select",ainput=tmp_output,binput=osm,operator="overlap",output=output,quiet=True)
-        list_box = GetList(output)
+        if method == "memory" and lattice:
+            # Boxes with OSM data come from the OSM pieces
+            osm_pieces, osm_cats = CellPieces(osm,tmp_output,lattice,processid)
+            list_box = sorted(set(osm_cats)-set([None]),key=int)
+            cats_file = grass.tempfile()
+            fil = open(cats_file,"w")
+            fil.write("\n".join(list_box)+"\n")
+            fil.close()
+            grass.run_command("v.extract",input=tmp_output,output=output,file=cats_file,quiet=True)
+            os.remove(cats_file)
+        else:
+            grass.run_command("v.select",ainput=tmp_output,binput=osm,operator="overlap",output=output,quiet=True)
+            list_box = GetList(output)
     
-    # Get tolerance values and evaluate #       
     if len(tol_eval)>0:
         list_tol = tol_eval.split(",")
-        AddCol(output,"OSM")
-        for item in list_tol:
-            AddCol(output,"t_%s"%item)
-            AddCol(output,"p_%s"%item)
+        columns = ["OSM"]+["%s_%s"%(c,item) for item in list_tol for c in ("t","p")]
+    else:
+        columns = ["OSM","TOL"]
+    all_boxes = None
+    ref_segs = None
+    fingerprints = {}
+
+    # Fingerprint the OSM and REF geometry of the boxes #
+    if store_fp:
+        instrument.stage("fingerprints")
+        all_boxes = read_boxes(output)
+        boxes = [all_boxes[int(k)] for k in list_box]
+        salt = "%s|%s|%s|%s|%s"%(tol_eval,tol_max,perc,method,step)
+        ref_segs = read_segments(ref)[1]
+        fps = cell_fingerprints([(read_segments(osm)[1],boxes),(ref_segs,[BigBox(b) for b in boxes])],salt)
+        fingerprints = dict(zip(list_box,fps))
+        AddCols(output,["FP"],"varchar(32)")
+    AddCols(output,columns)
+    results = {}
+    if len(previous)>0:
+        # Only the changed boxes are evaluated again
+        results, list_box = CopyPrevious(previous,fingerprints,columns)
+        grass.message(_("%d boxes changed, %d copied from <%s>")%(len(list_box),len(results),previous))
+
+    # Get tolerance values and evaluate #       
+    if len(tol_eval)>0:
+        instrument.stage("evaluation")
         
-        for k in list_box:
-            grass.run_command("v.extract",input=output,output=k_box,where="cat=%s"%k,quiet=True)
-            grass.run_command("v.overlay",ainput=osm,atype="line",binput=k_box,btype="area",operator="and",output=osm_box,quiet=True)
-	    l_osm = length(osm_box)
-            grass.run_command("v.db.update",map=output,column="OSM",value=l_osm,where="cat=%s"%k,quiet=True)   
-            grass.run_command("v.overlay",ainput=ref,atype="line",binput=k_box,btype="area",operator="and",output=ref_box,quiet=True)
-	    feat_ref_box = int(((grass.read_command("v.info", map=ref_box,flags="t")).split("\n")[2]).split("=")[1])
-            if feat_ref_box>0:
-                for item in list_tol:
-                    val = CalcTol(ref_box,osm_box,float(item))
-                    grass.run_command("v.db.update",map=output,column="t_%s"%item,value=val,where="cat=%s"%k,quiet=True) 
-                    grass.run_command("v.db.update",map=output,column="p_%s"%item,value=val*100.0/l_osm,where="cat=%s"%k,quiet=True) 
+        if method == "memory":
+            # All the boxes and tolerances at once
+            if osm_pieces is None:
+                osm_pieces, osm_cats = CellPieces(osm,output,lattice,processid)
+            osm_pieces, osm_cell = BoxPieces(osm_pieces,osm_cats,list_box)
+            ref_pieces, ref_cats = CellPieces(ref,output,lattice,processid)
+            ref_pieces, ref_cell = BoxPieces(ref_pieces,ref_cats,list_box)
+            values = cell_values(osm_pieces,osm_cell,ref_pieces,ref_cell,len(list_box),list_tol)
+            for k, val in zip(list_box,values):
+                results.setdefault(k,{}).update(val)
+        elif method == "profile":
+            # A single distance profile gives the length within every tolerance
+            profiles, ref_boxes = GridProfiles(osm,ref,output,step,max(map(float,list_tol)),processid,list_box if len(previous)>0 else None)
+            for k in list_box:
+                profile = profiles.get(k,([],[],0))
+                l_osm = profile[2]
+                results.setdefault(k,{})["OSM"] = l_osm
+                if k in ref_boxes:
+                    for item in list_tol:
+                        val = profile_length(profile,float(item))[0]
+                        results.setdefault(k,{})["t_%s"%item] = val
+                        if l_osm > 0:
+                            results.setdefault(k,{})["p_%s"%item] = val*100.0/l_osm
             grass.run_command("g.remove",type="vect", pattern=processid,flags="fr",quiet=True)
-                
+        else:
+            # Boxes are evaluated by the workers in their own mapsets
+            tasks = [(k,osm_file['fullname'],ref_file['fullname'],output+"@"+mapset,list_tol,processid) for k in list_box]
+            for k, values in run_tasks(EvalBox,tasks,nproc,"acc_"+processid):
+                results[k] = values
 
     # Automated evaluation #    
     if len(str(tol_max))>0:
-        acc = 0.005
-        AddCol(output,"OSM")
-        AddCol(output,"TOL")
-       
-        for k in list_box:
-            grass.run_command("v.extract",input=output,output=k_box,where="cat=%s"%k,quiet=True)
-            grass.run_command("v.overlay",ainput=osm,atype="line",binput=k_box,btype="area",operator="and",output=osm_box,quiet=True)
-            real_l_osm = length(osm_box)
-            if perc == 100.0:
-                l_osm = real_l_osm
-            else:
-                l_osm = real_l_osm*float(perc)/100.0
-
-            grass.run_command("v.db.update",map=output,column="OSM",value=real_l_osm,where="cat=%s"%k,quiet=True)   
-            # Get REF_BOX data in slightly bigger box
-            GetRefBox(ref,ref_box,k_box,processid)
-	    if length(ref_box)>0:
-                x = 0
-                val = 0
-                UP = float(tol_max)
-                DOWN = 0.0    
-                up = float(tol_max)
-                down = 0.0
-                mid = down + (up-down)/2
-                exit = 0      
-                while exit==0:
-                    val = CalcTol(ref_box,osm_box,mid)
-                    
-                    if val >= l_osm: # all in
-                        new_mid = down + (mid-down)/2
-                        up = mid
-                        mid = new_mid                     
-                                       
-                    elif val < l_osm: # not all in 
-                        
-                        if not down < mid + acc < up:
-                            if up!=UP:
-                                x = up
-                                exit = 1
-                            else:
-                                exit = 2
-                        else:
-                            val = CalcTol(ref_box,osm_box,mid + acc)
-                        
-                        if val >= l_osm:  # all in (considering epsilon)
-                            x = mid + acc
-                            exit = 1
-                        elif val < l_osm:  # not all in (considering epsilon)
-                            new_mid =(mid+acc) + (up-(mid+acc))/2
-                            down = mid + acc
-                            mid = new_mid                                                    
-                if exit == 1:
-                    grass.run_command("v.db.update",map=output,column="TOL",value=(math.ceil(x*100))/100,where="cat=%s"%k)
-                grass.run_command("g.remove",type="vect",pattern=processid,flags="fr")
-	    grass.run_command("g.remove",type="vect",pattern=processid,flags="fr")
+        instrument.stage("bisection")
+        if all_boxes is None:
+            all_boxes = read_boxes(output)
+
+        if method == "memory":
+            # REF is clipped with a slightly bigger box, as in GetRefBox
+            if osm_pieces is None:
+                osm_pieces, osm_cats = CellPieces(osm,output,lattice,processid)
+            osm_pieces, osm_cell = BoxPieces(osm_pieces,osm_cats,list_box)
+            if ref_segs is None:
+                ref_segs = read_segments(ref)[1]
+            values = cell_tolerances(osm_pieces,osm_cell,ref_segs,[all_boxes[int(k)] for k in list_box],tol_max,perc)
+            for k, val in zip(list_box,values):
+                results.setdefault(k,{}).update(val)
+        else:
+            tasks = [(k,all_boxes[int(k)],osm_file['fullname'],ref_file['fullname'],output+"@"+mapset,tol_max,perc,method,step,processid) for k in list_box]
+            for k, values in run_tasks(TolBox,tasks,nproc,"acc_"+processid):
+                results[k] = values
+
+    instrument.stage("table")
+    for k in fingerprints:
+        results.setdefault(k,{})["FP"] = fingerprints[k]
+    UpdateTable(output,results)
+
+    if profile:
+        instrument.write(profile)
                         
 
 if __name__ == "__main__":
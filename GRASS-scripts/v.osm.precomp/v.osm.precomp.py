@@ -36,7 +36,23 @@
 #% key: buffers
 #% type: string
 #% description: List of buffer values around reference and OpenStreetMap dataset (map units)
-#% required: yes
+#% required: no
+#%end
+
+#%option
+#% key: buffer_range
+#% type: string
+#% key_desc: min,max
+#% description: Range of buffer values to be sampled adaptively instead of using a list of buffers (map units)
+#% required: no
+#%end
+
+#%option
+#% key: budget
+#% type: integer
+#% description: Number of buffer values evaluated in buffer_range
+#% answer: 10
+#% required: no
 #%end
 
 #%option
@@ -47,6 +63,22 @@
 #% required: no
 #%end
 
+#%option
+#% key: rois
+#% type: string
+#% gisprompt: old,vector,vector
+#% description: Vector map with the regions of interest to be analysed in batch
+#% required: no
+#%end
+
+#%option
+#% key: rois_column
+#% type: string
+#% description: Column of rois used to identify the regions of interest in the output file
+#% answer: cat
+#% required: no
+#%end
+
 #%option
 #% key: out_graphs
 #% type: string
@@ -59,6 +91,27 @@
 #% required: yes
 #%end
 
+#%option G_OPT_F_OUTPUT
+#% key: out_data
+#% description: Name for output file with the statistics in machine-readable format
+#% required: no
+#%end
+
+#%option
+#% key: data_format
+#% type: string
+#% description: Format of the out_data file
+#% options: csv,json
+#% answer: csv
+#% required: no
+#%end
+
+#%option G_OPT_F_OUTPUT
+#% key: profile
+#% description: Name for output JSON file with the time spent in each stage and GRASS module
+#% required: no
+#%end
+
 #%option
 #% key: nprocs
 #% type: integer
@@ -68,12 +121,69 @@
 #% answer: 1
 #%end
 
+#%option
+#% key: tiles
+#% type: string
+#% key_desc: rows,cols
+#% description: Number of rows and columns of tiles used to split the analysis among the processes
+#% required: no
+#%end
+
+#%option
+#% key: method
+#% type: string
+#% description: Method used to compute the statistics for the buffer values
+#% descriptions: overlay;buffer and overlay the datasets for each buffer value;profile;compute the distance profile of the datasets once and read every buffer value from it;memory;load the segments of the datasets once and compute every buffer value in memory
+#% options: overlay,profile,memory
+#% answer: overlay
+#% required: no
+#%end
+
+#%option
+#% key: step
+#% type: double
+#% description: Maximum length of the pieces used to sample distances with method=profile (map units)
+#% answer: 1
+#% required: no
+#%end
+
 import sys
 import time
 import grass.script as grass
 import os
-from multiprocessing import Queue, Process
+import json
+import csv
+from multiprocessing import Process, Queue
 from types import TupleType
+from grass.pygrass.utils import set_path
+
+set_path('v.osm', 'libosm',
+         os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from libosm import instrument
+from libosm.dag import Graph
+from libosm.distprofile import get_profile, get_profiles, profile_length
+from libosm.geomstats import length
+from libosm.pool import run_tasks
+
+# GRASS commands run at the same time by all the processes together
+STEPS = 4
+
+# Name, dataset, buffered dataset, side of the buffer, unit and legend
+# position of every graph
+GRAPHS = [("osm_in_km", "OSM", "REF", "in", "km", "lower right"),
+          ("osm_in_perc", "OSM", "REF", "in", "%", "lower right"),
+          ("osm_out_km", "OSM", "REF", "out", "km", "upper right"),
+          ("osm_out_perc", "OSM", "REF", "out", "%", "upper right"),
+          ("ref_in_km", "REF", "OSM", "in", "km", "lower right"),
+          ("ref_in_perc", "REF", "OSM", "in", "%", "lower right"),
+          ("ref_out_km", "REF", "OSM", "out", "km", "upper right"),
+          ("ref_out_perc", "REF", "OSM", "out", "%", "upper right")]
+
+
+def Steps(nproc):
+    """Return the GRASS commands each one of nproc processes can run at the
+    same time"""
+    return max(1, STEPS // max(nproc, 1))
 
 
 def checkPath(path):
@@ -88,176 +198,376 @@ def checkPath(path):
             return 1
 
 
-def GetStat(osm, ref, buff, processid):
-    buffs = str(buff).replace('.', '_')
-    ref_buffer = "ref_buffer_{idd}_{buf}".format(idd=processid, buf=buffs)
-    osm_buffer = "osm_buffer_{idd}_{buf}".format(idd=processid, buf=buffs)
-    ref_in = "ref_in_{idd}_{buf}".format(idd=processid, buf=buffs)
-    ref_out = "ref_out_{idd}_{buf}".format(idd=processid, buf=buffs)
-    osm_in = "osm_in_{idd}_{buf}".format(idd=processid, buf=buffs)
-    osm_out = "osm_out_{idd}_{buf}".format(idd=processid, buf=buffs)
-
+def GetStat(osm, ref, buff, processid, steps=STEPS):
+    # The two buffers and the four overlays only depend on their buffer
+    graph = Graph()
     # Calculate REF data in and out OSM buffer
-    grass.run_command("v.buffer", input=osm, output=osm_buffer, distance=buff,
-                      type="line", overwrite=True, quiet=True)
-    grass.run_command("v.overlay", ainput=ref, binput=osm_buffer,
-                      operator="and", output=ref_in, atype="line", flags="t",
-                      overwrite=True, quiet=True)
-    grass.run_command("v.overlay", ainput=ref, binput=osm_buffer,
-                      operator="not", output=ref_out, atype="line", flags="t",
-                      overwrite=True, quiet=True)
-    s_ref_in = length(ref_in)
-    s_ref_out = length(ref_out)
-
+    ref_maps = GetInOut(graph, ref, osm, buff, "ref", processid)
     # Calculate OSM data in and out REF buffer
-    grass.run_command("v.buffer", input=ref, output=ref_buffer, distance=buff,
-                      type="line", overwrite=True, quiet=True)
-    grass.run_command("v.overlay", ainput=osm, binput=ref_buffer,
-                      operator="and", output=osm_in, atype="line", flags="t",
-                      overwrite=True, quiet=True)
-    grass.run_command("v.overlay", ainput=osm, binput=ref_buffer,
-                      operator="not", output=osm_out, atype="line", flags="t",
-                      overwrite=True, quiet=True)
-    s_osm_in = length(osm_in)
-    s_osm_out = length(osm_out)
+    osm_maps = GetInOut(graph, osm, ref, buff, "osm", processid)
+    graph.run(steps)
 
-    # Remove temporary data
-    grass.run_command("g.remove", type="vect", flags="fr", quiet=True,
-                      pattern="*{st}_{buf}".format(st=processid, buf=buffs))
+    (s_ref_in, s_ref_out) = InOutLength(ref_maps)
+    (s_osm_in, s_osm_out) = InOutLength(osm_maps)
 
     return (s_ref_in, s_ref_out, s_osm_in, s_osm_out)
 
 
-def Plot(buff, osm_in, ref_in, REF_tot, OSM_tot, out):
-    import pylab
-
-    ref_in = pylab.array(ref_in)
-    ref_out = REF_tot - ref_in
-    ref_in_perc = (ref_in / float(REF_tot)) * 100
-    ref_out_perc = 100 - ref_in_perc
-    osm_in = pylab.array(osm_in)
-    osm_out = OSM_tot - osm_in
-    osm_in_perc = (osm_in / float(OSM_tot)) * 100
-    osm_out_perc = 100 - osm_in_perc
-
-    REF_tot_km = REF_tot / float(1000)
-    ref_in_km = ref_in / float(1000)
-    ref_out_km = ref_out / float(1000)
-    OSM_tot_km = OSM_tot / float(1000)
-    osm_in_km = osm_in / float(1000)
-    osm_out_km = osm_out / float(1000)
-
-    # Plot of the length of OSM in the buffer around REF
-    pylab.figure()
-    pylab.plot(buff, osm_in_km, 'ro-',
-               label='OSM total length = {st} km'.format(st=OSM_tot_km))
-    pylab.title('Similarity of OSM compared to REF')
-    pylab.xlabel('Buffer width around REF dataset [m]')
-    pylab.ylabel('OSM length included in the buffer [km]')
-    pylab.axis([0, buff[-1] * 1.05, 0, OSM_tot_km * 1.05])
-    pylab.legend(loc="lower right")
-    pylab.grid()
-    pylab.savefig("{st}/osm_in_km.png".format(st=out))
-
-    # Plot of the percentage of OSM in the buffer around REF
-    pylab.figure()
-    pylab.plot(buff, osm_in_perc, 'ro-',
-               label='OSM total length = {st} km'.format(st=OSM_tot_km))
-    pylab.title('Similarity of OSM compared to REF')
-    pylab.xlabel('Buffer width around REF dataset [m]')
-    pylab.ylabel('OSM length included in the buffer [%]')
-    pylab.axis([0, buff[-1] * 1.05, 0, 100])
-    pylab.legend(loc="lower right")
-    pylab.grid()
-    pylab.savefig("{st}/osm_in_perc.png".format(st=out))
-
-    # Plot of the length of OSM outside the buffer around REF
-    pylab.figure()
-    pylab.plot(buff, osm_out_km, 'ro-',
-               label='OSM total length = {st} km'.format(st=OSM_tot_km))
-    pylab.title('Similarity of OSM compared to REF')
-    pylab.xlabel('Buffer width around REF dataset [m]')
-    pylab.ylabel('OSM length not included in the buffer [km]')
-    pylab.axis([0, buff[-1] * 1.05, 0, OSM_tot_km * 1.05])
-    pylab.legend(loc="upper right")
-    pylab.grid()
-    pylab.savefig("{st}/osm_out_km.png".format(st=out))
-
-    # Plot of the percentage of OSM outside the buffer around REF
-    pylab.figure()
-    pylab.plot(buff, osm_out_perc, 'ro-',
-               label='OSM total length = {st} km'.format(st=OSM_tot_km))
-    pylab.title('Similarity of OSM compared to REF')
-    pylab.xlabel('Buffer width around REF dataset [m]')
-    pylab.ylabel('OSM length not included in the buffer [%]')
-    pylab.axis([0, buff[-1] * 1.05, 0, 100])
-    pylab.legend(loc="upper right")
-    pylab.grid()
-    pylab.savefig("{st}/osm_out_perc.png".format(st=out))
-
-    # Plot of the length of REF in the buffer around OSM
-    pylab.figure()
-    pylab.plot(buff, ref_in_km, 'bo-',
-               label='REF total length = {st} km'.format(st=REF_tot_km))
-    pylab.title('Similarity of REF compared to OSM')
-    pylab.xlabel('Buffer width around OSM dataset [m]')
-    pylab.ylabel('REF length included in the buffer [km]')
-    pylab.axis([0, buff[-1] * 1.05, 0, REF_tot_km * 1.05])
-    pylab.legend(loc="lower right")
-    pylab.grid()
-    pylab.savefig("{st}/ref_in_km.png".format(st=out))
-
-    # Plot of the percentage of REF in the buffer around OSM
-    pylab.figure()
-    pylab.plot(buff, ref_in_perc, 'bo-',
-               label='REF total length = {st} km'.format(st=REF_tot_km))
-    pylab.title('Similarity of REF compared to OSM')
-    pylab.xlabel('Buffer width around OSM dataset [m]')
-    pylab.ylabel('REF length included in the buffer [%]')
-    pylab.axis([0, buff[-1] * 1.05, 0, 100])
-    pylab.legend(loc="lower right")
-    pylab.grid()
-    pylab.savefig("{st}/ref_in_perc.png".format(st=out))
-
-    # Plot of the length of REF outside the buffer around OSM
-    pylab.figure()
-    pylab.plot(buff, ref_out_km, 'bo-',
-               label='REF total length = {st} km'.format(st=REF_tot_km))
-    pylab.title('Similarity of REF compared to OSM')
-    pylab.xlabel('Buffer width around OSM dataset [m]')
-    pylab.ylabel('REF length not included in the buffer [km]')
-    pylab.axis([0, buff[-1] * 1.05, 0, REF_tot_km * 1.05])
-    pylab.legend(loc="upper right")
-    pylab.grid()
-    pylab.savefig("{st}/ref_out_km.png".format(st=out))
-
-    # Plot of the percentage of REF outside the buffer around OSM
-    pylab.figure()
-    pylab.plot(buff, ref_out_perc, 'bo-',
-               label='REF total length = {st} km'.format(st=REF_tot_km))
-    pylab.title('Similarity of REF compared to OSM')
-    pylab.xlabel('Buffer width around OSM dataset [m]')
-    pylab.ylabel('REF length not included in the buffer [%]')
-    pylab.axis([0, buff[-1] * 1.05, 0, 100])
-    pylab.legend(loc="upper right")
-    pylab.grid()
-    pylab.savefig("{st}/ref_out_perc.png".format(st=out))
-    return 0
-
-
-def length(data):
-    feat_osm = int(((grass.read_command("v.info", map=data, flags="t",
-                                        quiet=True)).split("\n")[2]).split("=")[1])
-    if feat_osm > 0:
-        length_data = grass.read_command("v.to.db", map=data, option="length",
-                                         flags="p")
-        s_data = 0
-        l_data = length_data.split("\n")
-        for item in l_data[1:-1]:
-            s_data += float(item.split("|")[1])
+def GetInOut(graph, data, other, buff, name, processid):
+    """Add to graph the steps cutting data in and out of the buffer around
+    other, and return the names of the buffer and of the two results"""
+    buffs = str(buff).replace('.', '_')
+    other_buffer = "{st}_buffer_{idd}_{buf}".format(st=name, idd=processid,
+                                                    buf=buffs)
+    data_in = "{st}_in_{idd}_{buf}".format(st=name, idd=processid, buf=buffs)
+    data_out = "{st}_out_{idd}_{buf}".format(st=name, idd=processid,
+                                             buf=buffs)
+
+    graph.command(other_buffer, "v.buffer", input=other, output=other_buffer,
+                  distance=buff, type="line", overwrite=True, quiet=True)
+    graph.command(data_in, "v.overlay", after=[other_buffer], ainput=data,
+                  binput=other_buffer, operator="and", output=data_in,
+                  atype="line", flags="t", overwrite=True, quiet=True)
+    graph.command(data_out, "v.overlay", after=[other_buffer], ainput=data,
+                  binput=other_buffer, operator="not", output=data_out,
+                  atype="line", flags="t", overwrite=True, quiet=True)
+
+    return (other_buffer, data_in, data_out)
+
+
+def InOutLength(maps):
+    """Return the length of data in and out of the buffer"""
+    other_buffer, data_in, data_out = maps
+    s_data_in = length(data_in)
+    s_data_out = length(data_out)
+
+    # Remove temporary data
+    grass.run_command("g.remove", type="vect", flags="f", quiet=True,
+                      name="{bu},{di},{do}".format(bu=other_buffer,
+                                                   di=data_in, do=data_out))
+
+    return (s_data_in, s_data_out)
+
+
+def ProfileStat(ref_profile, osm_profile, buff):
+    """Return the statistics of GetStat reading them from the profiles"""
+    (s_ref_in, s_ref) = profile_length(ref_profile, buff)
+    (s_osm_in, s_osm) = profile_length(osm_profile, buff)
+    return (s_ref_in, s_ref - s_ref_in, s_osm_in, s_osm - s_osm_in)
+
+
+def calculate_profiles(args):
+    data, other, step, dmax, processid, column = args
+    return data, get_profiles(data, other, step, dmax, processid, column)
+
+
+def RoiStat(osm, ref, rois, list_buff, step, nproc, processid):
+    """Return the statistics of every region of interest and buffer value.
+
+    Both datasets are assigned to the regions of interest with a single
+    overlay each and their distance profiles are computed once, measuring
+    distances only between features of the same region. The result is a
+    list of (roi category, REF length, OSM length, buffer, statistics).
+    """
+    mapset = grass.gisenv()['MAPSET']
+    ref_rois = "ref_rois_" + processid
+    osm_rois = "osm_rois_" + processid
+    grass.run_command("v.overlay", ainput=ref, atype="line", binput=rois,
+                      operator="and", output=ref_rois, quiet=True)
+    grass.run_command("v.overlay", ainput=osm, atype="line", binput=rois,
+                      operator="and", output=osm_rois, quiet=True)
+    ref_rois = "{st}@{ma}".format(st=ref_rois, ma=mapset)
+    osm_rois = "{st}@{ma}".format(st=osm_rois, ma=mapset)
+
+    dmax = max(list_buff)
+    tasks = [(ref_rois, osm_rois, step, dmax, processid, "b_cat"),
+             (osm_rois, ref_rois, step, dmax, processid, "b_cat")]
+    profiles = dict(run_tasks(calculate_profiles, tasks, nproc,
+                              "precomp_" + processid))
+    ref_profiles = profiles[ref_rois]
+    osm_profiles = profiles[osm_rois]
+
+    stats = []
+    empty = ([], [], 0)
+    for cat in sorted(set(ref_profiles) | set(osm_profiles), key=int):
+        ref_profile = ref_profiles.get(cat, empty)
+        osm_profile = osm_profiles.get(cat, empty)
+        for b in list_buff:
+            stats.append((cat, ref_profile[2], osm_profile[2], b,
+                          ProfileStat(ref_profile, osm_profile, b)))
+    return stats
+
+
+def GetExtent(maps):
+    """Return the bounding box (n, s, e, w) containing all the maps"""
+    n = s = e = w = None
+    for data in maps:
+        info = grass.vector_info(data)
+        if n is None:
+            n, s, e, w = (info['north'], info['south'], info['east'],
+                          info['west'])
+        else:
+            n = max(n, info['north'])
+            s = min(s, info['south'])
+            e = max(e, info['east'])
+            w = min(w, info['west'])
+    return (n, s, e, w)
+
+
+def GetTiles(extent, rows, cols, halo):
+    """Split extent in rows x cols tiles.
+
+    Return a list of (core, halo) boxes: the core boxes cover extent without
+    overlapping, the halo boxes are the core boxes grown by halo.
+    """
+    n, s, e, w = extent
+    ns_res = (n - s) / float(rows)
+    ew_res = (e - w) / float(cols)
+    tiles = []
+    for r in range(rows):
+        t_n = n - r * ns_res
+        t_s = s if r == rows - 1 else n - (r + 1) * ns_res
+        for c in range(cols):
+            t_w = w + c * ew_res
+            t_e = e if c == cols - 1 else w + (c + 1) * ew_res
+            tiles.append(((t_n, t_s, t_e, t_w),
+                          (t_n + halo, t_s - halo, t_e + halo, t_w - halo)))
+    return tiles
+
+
+def BoxMap(box, output):
+    """Create a vector map with a single area covering box (n, s, e, w)"""
+    n, s, e, w = box
+    area = "B  5\n {w} {n}\n {e} {n}\n {e} {s}\n {w} {s}\n {w} {n}\n" \
+           "C  1 1\n {x} {y}\n 1 1\n".format(n=repr(n), s=repr(s),
+                                                e=repr(e), w=repr(w),
+                                                x=repr((e + w) / 2.0),
+                                                y=repr((n + s) / 2.0))
+    grass.write_command("v.in.ascii", input="-", output=output,
+                        format="standard", flags="n", stdin=area,
+                        overwrite=True, quiet=True)
+
+
+def Clip(data, box, output):
+    """Clip data with box; return False if nothing is left"""
+    grass.run_command("v.overlay", ainput=data, atype="line", binput=box,
+                      btype="area", operator="and", output=output, flags="t",
+                      overwrite=True, quiet=True)
+    return length(output) > 0
+
+
+def calculate_tile(args):
+    """Return the statistics of all the buffer values inside a tile.
+
+    The lengths are measured on the data inside the core box of the tile,
+    while the buffers are built on the data inside the halo box, so that
+    summing the lengths of all the tiles gives the statistics of the whole
+    datasets.
+    """
+    osm, ref, k, core, halo, list_buff, method, step, steps, processid = args
+    tileid = "{idd}_t{k}".format(idd=processid, k=k)
+    core_box = "core_box_" + tileid
+    halo_box = "halo_box_" + tileid
+    osm_core = "osm_core_" + tileid
+    ref_core = "ref_core_" + tileid
+    osm_halo = "osm_halo_" + tileid
+    ref_halo = "ref_halo_" + tileid
+
+    BoxMap(core, core_box)
+    BoxMap(halo, halo_box)
+    has_osm = Clip(osm, core_box, osm_core)
+    has_ref = Clip(ref, core_box, ref_core)
+    has_osm_halo = has_ref_halo = False
+    if has_osm or has_ref:
+        has_osm_halo = Clip(osm, halo_box, osm_halo)
+        has_ref_halo = Clip(ref, halo_box, ref_halo)
+
+    stats = []
+    if method == "profile" and has_ref and has_osm_halo:
+        ref_profile = get_profile(ref_core, osm_halo, step, max(list_buff),
+                                  tileid)
+    if method == "profile" and has_osm and has_ref_halo:
+        osm_profile = get_profile(osm_core, ref_halo, step, max(list_buff),
+                                  tileid)
+    for b in list_buff:
+        s_ref = s_osm = (0, 0)
+        graph = Graph()
+        ref_maps = osm_maps = None
+        if has_ref:
+            if not has_osm_halo:
+                s_ref = (0, length(ref_core))
+            elif method == "profile":
+                s_ref = profile_length(ref_profile, b)
+                s_ref = (s_ref[0], s_ref[1] - s_ref[0])
+            else:
+                ref_maps = GetInOut(graph, ref_core, osm_halo, b, "ref",
+                                    tileid)
+        if has_osm:
+            if not has_ref_halo:
+                s_osm = (0, length(osm_core))
+            elif method == "profile":
+                s_osm = profile_length(osm_profile, b)
+                s_osm = (s_osm[0], s_osm[1] - s_osm[0])
+            else:
+                osm_maps = GetInOut(graph, osm_core, ref_halo, b, "osm",
+                                    tileid)
+        graph.run(steps)
+        if ref_maps:
+            s_ref = InOutLength(ref_maps)
+        if osm_maps:
+            s_osm = InOutLength(osm_maps)
+        stats.append(s_ref + s_osm)
+
+    grass.run_command("g.remove", type="vect", flags="fr", quiet=True,
+                      pattern="*_{st}".format(st=tileid))
+    return stats
+
+
+def TileStat(osm, ref, extent, rows, cols, list_buff, method, step, nproc,
+             processid):
+    """Return the statistics of every buffer value summing them by tile"""
+    tiles = GetTiles(extent, rows, cols, max(list_buff))
+    tasks = [(osm, ref, k, core, halo, list_buff, method, step, Steps(nproc),
+              processid) for k, (core, halo) in enumerate(tiles)]
+    stats = [(0, 0, 0, 0) for b in list_buff]
+    for n_done, tile_stats in enumerate(run_tasks(calculate_tile, tasks, nproc,
+                                                  "precomp_" + processid)):
+        stats = [tuple(t + v for t, v in zip(tot, val))
+                 for tot, val in zip(stats, tile_stats)]
+        grass.percent(n_done + 1, len(tasks), 1)
+    return stats
+
+
+def NextBuffers(results, s_osm, s_ref, n, min_width):
+    """Return up to n new buffer values to be evaluated.
+
+    The new values split in half the intervals between the buffer values
+    already evaluated where OSM_IN(%) or REF_IN(%) change the most;
+    intervals narrower than twice min_width are not split anymore.
+    """
+    points = sorted((p[0], p[1] / s_osm * 100, p[2] / s_ref * 100)
+                    for p in results)
+    intervals = []
+    for (b1, o1, r1), (b2, o2, r2) in zip(points[:-1], points[1:]):
+        if b2 - b1 < 2 * min_width:
+            continue
+        change = max(abs(o2 - o1), abs(r2 - r1))
+        intervals.append((change, b2 - b1, b1, b2))
+    intervals.sort(reverse=True)
+    return [b1 + (b2 - b1) / 2.0 for change, width, b1, b2 in intervals[:n]]
+
+
+def FindKnee(results, s_osm, s_ref):
+    """Return the buffer value at the knee of the mean OSM_IN/REF_IN curve.
+
+    The knee is the point of the normalized curve with the largest distance
+    above the line joining its first and last points.
+    """
+    points = sorted((p[0], (p[1] / s_osm + p[2] / s_ref) * 50)
+                    for p in results)
+    (x0, y0), (x1, y1) = points[0], points[-1]
+    if x1 == x0 or y1 == y0:
+        return x1
+    knee = max(points, key=lambda p: (p[1] - y0) / (y1 - y0) -
+               (p[0] - x0) / (x1 - x0))
+    return knee[0]
+
+
+def render(q_rows, REF_tot, OSM_tot, out):
+    """Update the graphs every time new rows arrive in q_rows.
+
+    Rows are (buffer, OSM_IN, REF_IN) tuples; None ends the rendering.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    graphs = Graphs(REF_tot, OSM_tot, out)
+    rows = []
+    finished = False
+    while not finished:
+        # Draw once for all the rows already waiting
+        new_rows = [q_rows.get()]
+        while not q_rows.empty():
+            new_rows.append(q_rows.get())
+        finished = None in new_rows
+        rows.extend(row for row in new_rows if row is not None)
+        if len(rows) > 0:
+            rows.sort()
+            graphs.update([row[0] for row in rows], [row[1] for row in rows],
+                          [row[2] for row in rows])
+    graphs.close()
+
+
+def WriteData(fileName, fmt, summary, columns, rows):
+    """Write the statistics to fileName as CSV or JSON"""
+    checkPath(os.path.split(fileName)[0])
+    fil = open(fileName, "w")
+    if fmt == "json":
+        data = dict(summary)
+        data["rows"] = [dict(zip(columns, row)) for row in rows]
+        json.dump(data, fil, indent=2, sort_keys=True)
+        fil.write("\n")
     else:
-        s_data = 0
-    return s_data
+        # Values such as the names of the rois may hold commas or quotes
+        writer = csv.writer(fil, lineterminator="\n")
+        writer.writerow(columns)
+        writer.writerows(rows)
+    fil.close()
+
+
+class Graphs(object):
+    """The graphs of the lengths in and out of the buffers.
+
+    Figures, axes and legends are drawn once; update only replaces the
+    points of the lines and saves the figures again.
+    """
+
+    def __init__(self, REF_tot, OSM_tot, out):
+        import pylab
+
+        self.REF_tot = float(REF_tot)
+        self.OSM_tot = float(OSM_tot)
+        self.out = out
+        self.graphs = []
+        for name, data, other, side, unit, loc in GRAPHS:
+            tot_km = (self.OSM_tot if data == "OSM" else self.REF_tot) / 1000
+            fig = pylab.figure()
+            axes = fig.gca()
+            line = axes.plot([], [], 'ro-' if data == "OSM" else 'bo-',
+                             label='{da} total length = {st} km'.format(
+                                 da=data, st=tot_km))[0]
+            axes.set_title('Similarity of {da} compared to {ot}'.format(
+                da=data, ot=other))
+            axes.set_xlabel('Buffer width around {ot} dataset [m]'.format(
+                ot=other))
+            axes.set_ylabel('{da} length {si} in the buffer [{un}]'.format(
+                da=data, un=unit,
+                si="included" if side == "in" else "not included"))
+            axes.set_ylim(0, 100 if unit == "%" else tot_km * 1.05)
+            axes.legend(loc=loc)
+            axes.grid()
+            self.graphs.append((name, fig, axes, line))
+
+    def update(self, buff, osm_in, ref_in):
+        import numpy
+
+        values = {}
+        for data, data_in, tot in (("OSM", osm_in, self.OSM_tot),
+                                   ("REF", ref_in, self.REF_tot)):
+            data_in = numpy.array(data_in, dtype=float)
+            values[data, "in", "km"] = data_in / 1000
+            values[data, "out", "km"] = (tot - data_in) / 1000
+            values[data, "in", "%"] = data_in / tot * 100
+            values[data, "out", "%"] = 100 - data_in / tot * 100
+        for (name, fig, axes, line), graph in zip(self.graphs, GRAPHS):
+            line.set_data(buff, values[graph[1], graph[3], graph[4]])
+            axes.set_xlim(0, buff[-1] * 1.05)
+            fig.savefig("{st}/{na}.png".format(st=self.out, na=name))
+
+    def close(self):
+        import pylab
+
+        for name, fig, axes, line in self.graphs:
+            pylab.close(fig)
 
 
 def GetInfo(fileName):
@@ -267,33 +577,40 @@ def GetInfo(fileName):
     return (float(ref_in), float(osm_in))
 
 
-def calculate(osm, s_osm, ref, s_ref, b, processid):
-    (s_ref_in, s_ref_out, s_osm_in, s_osm_out) = GetStat(osm, ref, b,
-                                                         processid)
+def calculate(osm, s_osm, ref, s_ref, b, processid, steps=STEPS):
+    return FormatStat(b, s_osm, s_ref, GetStat(osm, ref, b, processid,
+                                               steps))
+
+
+def calculate_buffer(args):
+    return calculate(*args)
+
+
+COLUMNS = ["buffer", "osm_in", "osm_in_perc", "osm_out", "osm_out_perc",
+           "ref_in", "ref_in_perc", "ref_out", "ref_out_perc"]
+
+
+def Perc(value, total):
+    if total == 0:
+        return 0.0
+    return round(value / total * 100, 1)
+
+
+def FormatStat(b, s_osm, s_ref, stat):
+    (s_ref_in, s_ref_out, s_osm_in, s_osm_out) = stat
     osm_in = round(s_osm_in, 1)
-    var_osm_in = round(s_osm_in / s_osm * 100, 1)
+    var_osm_in = Perc(s_osm_in, s_osm)
     ref_in = round(s_ref_in, 1)
-    var_ref_in = round(s_ref_in / s_ref * 100, 1)
+    var_ref_in = Perc(s_ref_in, s_ref)
     osm_out = round(s_osm_out, 1)
-    var_osm_out = round(s_osm_out / s_osm * 100, 1)
+    var_osm_out = Perc(s_osm_out, s_osm)
     ref_out = round(s_ref_out, 1)
-    var_ref_out = round(s_ref_out / s_ref * 100, 1)
+    var_ref_out = Perc(s_ref_out, s_ref)
 
-    out = "{bi}|{oi}|{voi}|{oo}|{voo}|{ri}|{vri}|{ro}|{vro}" \
-          "\n".format(bi=b, oi=osm_in, voi=var_osm_in, oo=osm_out,
-                      voo=var_osm_out, ri=ref_in, vri=var_ref_in,
-                      ro=ref_out, vro=var_ref_out)
-    return osm_in, ref_in, out
-
-
-def spawn(func):
-    def fun(q_in, q_out):
-        while True:
-            osm, so, ref, sr, b, pr = q_in.get()
-            if b is None:
-                break
-            q_out.put(func(osm, so, ref, sr, b, pr))
-    return fun
+    values = (b, osm_in, var_osm_in, osm_out, var_osm_out, ref_in,
+              var_ref_in, ref_out, var_ref_out)
+    out = "|".join(str(val) for val in values) + "\n"
+    return b, osm_in, ref_in, out, values
 
 
 def main():
@@ -302,22 +619,50 @@ def main():
     ref = options["ref"]
     buff = options["buffers"]
     roi = options["roi"]
+    rois = options["rois"]
+    rois_column = options["rois_column"]
     out_graphs = options["out_graphs"]
     out = options["output"]
     nproc = int(options["nprocs"])
+    method = options["method"]
+    step = float(options["step"])
+    tiles = options["tiles"]
+    buffer_range = options["buffer_range"]
+    budget = int(options["budget"])
+    out_data = options["out_data"]
+    data_format = options["data_format"]
+    profile = options["profile"]
+
+    if profile:
+        instrument.enable()
 
     # Check if input files exist
-    if not grass.find_file(name=osm, element='vector')['file']:
+    osm_file = grass.find_file(name=osm, element='vector')
+    if not osm_file['file']:
         grass.fatal(_("Vector map <%s> not found") % osm)
 
-    if not grass.find_file(name=ref, element='vector')['file']:
+    ref_file = grass.find_file(name=ref, element='vector')
+    if not ref_file['file']:
         grass.fatal(_("Vector map <%s> not found") % ref)
 
     if len(roi) > 0:
         if not grass.find_file(name=roi, element='vector')['file']:
             grass.fatal(_("Vector map <%s> not found") % roi)
 
+    if len(rois) > 0:
+        if not grass.find_file(name=rois, element='vector')['file']:
+            grass.fatal(_("Vector map <%s> not found") % rois)
+        if len(roi) > 0 or len(tiles) > 0:
+            grass.fatal(_("Option <rois> can't be used with <roi> or "
+                          "<tiles>"))
+
+    # Workers run in other mapsets, so they need fully qualified names
+    osm = osm_file['fullname']
+    ref = ref_file['fullname']
+    mapset = grass.gisenv()['MAPSET']
+
     # OSM and REF length
+    instrument.stage("lengths")
     s_ref = length(ref)
     s_osm = length(osm)
 
@@ -340,38 +685,138 @@ def main():
     osm_roi = "osm_roi_" + processid
 
     # Apply mask
+    instrument.stage("roi")
     if len(roi) > 0:
         grass.run_command("v.overlay", ainput=ref, atype="line", binput=roi,
                           operator="and", output=ref_roi, flags="t", quiet=True)
         grass.run_command("v.overlay", ainput=osm, atype="line", binput=roi,
                           operator="and", output=osm_roi, flags="t", quiet=True)
-        ref = ref_roi
-        osm = osm_roi
+        ref = "{st}@{ma}".format(st=ref_roi, ma=mapset)
+        osm = "{st}@{ma}".format(st=osm_roi, ma=mapset)
 
     # Extract list of buffer values
-    list_buff = map(float, buff.split(","))
+    if (len(buff) > 0) == (len(buffer_range) > 0):
+        grass.fatal(_("Please specify one between <buffers> and "
+                      "<buffer_range>"))
+    if len(buff) > 0:
+        list_buff = map(float, buff.split(","))
+    else:
+        try:
+            b_min, b_max = map(float, buffer_range.split(","))
+        except ValueError:
+            grass.fatal(_("Option <buffer_range> must be in the form min,max"))
+        if not 0 < b_min < b_max:
+            grass.fatal(_("Option <buffer_range> must be 0 < min < max"))
+        if budget < 3:
+            grass.fatal(_("Option <budget> must be at least 3"))
+        if len(rois) > 0:
+            grass.fatal(_("Option <rois> requires <buffers>"))
+        list_buff = [b_min, b_max]
 
     # Calculate list of statistics
-    l_osm_in = []
-    l_ref_in = []
-
-    q_in = Queue(1)
-    q_out = Queue()
-    procs = [Process(target=spawn(calculate), args=(q_in, q_out))
-             for _ in range(nproc)]
-    for proc in procs:
-        proc.daemon = True
-        proc.start()
-    # for each file create the polygon of bounding box
-    ans = [q_in.put((osm, s_osm, ref, s_ref, i, processid)) for i in list_buff]
-
-    # set the end of the cycle
-    [q_in.put((None, None, None, None, None, None)) for proc in procs]
-    [proc.join() for proc in procs]
-    processed = [q_out.get() for _ in ans]
-    if len(processed) != len(list_buff):
-        grass.fatal(_("Some errors occurred during analysis"))
+    if (method == "profile" or len(rois) > 0) and step <= 0:
+        grass.fatal(_("Option <step> must be greater than zero"))
+
+    summary = {"ref_length": round(s_ref, 1), "osm_length": round(s_osm, 1),
+               "difference": round(diff, 1),
+               "difference_perc": round(diff_p, 1)}
+
+    if len(rois) > 0:
+        # Batch mode always uses the distance profiles
+        instrument.stage("rois")
+        stats = RoiStat(osm, ref, rois, list_buff, step, nproc, processid)
+        roi_keys = {}
+        key_data = grass.read_command("v.db.select", map=rois,
+                                      columns="cat,{st}".format(st=rois_column),
+                                      flags="c", quiet=True)
+        for item in key_data.split("\n")[0:-1]:
+            cat, val = item.split("|")[0:2]
+            roi_keys[cat] = val
+
+        checkPath(os.path.split(out)[0])
+        fil = open(out, "w")
+        fil.write("REF length: {rl} m\n".format(rl=round(s_ref, 1)))
+        fil.write("OSM length: {ol} m\n".format(ol=round(s_osm, 1)))
+        fil.write("REF-OSM difference: {di} m ({dp}%)\n".format(
+            di=round(diff, 1), dp=round(diff_p, 1)))
+        fil.write("\n")
+        fil.write("ROI|REF(m)|OSM(m)|BUFFER(m)|OSM_IN(m)|OSM_IN(%)|"
+                  "OSM_OUT(m)|OSM_OUT(%)|REF_IN(m)|REF_IN(%)|REF_OUT(m)|"
+                  "REF_OUT(%)\n")
+        data_rows = []
+        for cat, r_roi, o_roi, b, stat in stats:
+            p = FormatStat(b, o_roi, r_roi, stat)
+            roi_row = (roi_keys.get(cat, cat), round(r_roi, 1),
+                       round(o_roi, 1))
+            fil.write("|".join(str(val) for val in roi_row) + "|" + p[3])
+            data_rows.append(roi_row + p[4])
+        fil.close()
+        if out_data:
+            WriteData(out_data, data_format, summary,
+                      ["roi", "ref_length", "osm_length"] + COLUMNS,
+                      data_rows)
+        if out_graphs:
+            grass.warning(_("Graphs are not drawn with option <rois>"))
+        grass.run_command("g.remove", type="vect", flags="fr",
+                          pattern="*_{st}".format(st=processid), quiet=True)
+        if profile:
+            instrument.write(profile)
         return 0
+
+    if len(tiles) > 0 and method == "memory":
+        grass.fatal(_("Option <tiles> can't be used with method=memory"))
+
+    if len(tiles) > 0:
+        try:
+            rows, cols = map(int, tiles.split(","))
+        except ValueError:
+            grass.fatal(_("Option <tiles> must be in the form rows,cols"))
+        if rows < 1 or cols < 1:
+            grass.fatal(_("Option <tiles> needs at least one row and one "
+                          "column"))
+        # Tiles cover the ROI or both datasets
+        if len(roi) > 0:
+            extent = GetExtent([roi])
+        else:
+            extent = GetExtent([osm, ref])
+
+        def evaluate(values):
+            stats = TileStat(osm, ref, extent, rows, cols, values, method,
+                             step, nproc, processid)
+            return [FormatStat(b, s_osm, s_ref, stat)
+                    for b, stat in zip(values, stats)]
+    elif method == "memory":
+        # Same computation as the file based engine, on the GRASS maps
+        from libosm.engine import buffer_stats
+        from libosm.segments import read_segments
+
+        instrument.stage("segments")
+        ref_segs = read_segments(ref)[1]
+        osm_segs = read_segments(osm)[1]
+
+        def evaluate(values):
+            stats = buffer_stats(osm_segs, ref_segs, values)
+            return [FormatStat(b, s_osm, s_ref, stat)
+                    for b, stat in zip(values, stats)]
+    elif method == "profile":
+        # Distances are only needed up to the largest buffer value
+        instrument.stage("profiles")
+        dmax = max(list_buff)
+        ref_profile = get_profile(ref, osm, step, dmax, processid)
+        osm_profile = get_profile(osm, ref, step, dmax, processid)
+
+        def evaluate(values):
+            return [FormatStat(b, s_osm, s_ref,
+                               ProfileStat(ref_profile, osm_profile, b))
+                    for b in values]
+    else:
+        # Rows are written as soon as each buffer value is done
+        def evaluate(values):
+            tasks = [(osm, s_osm, ref, s_ref, b, processid, Steps(nproc))
+                     for b in values]
+            return run_tasks(calculate_buffer, tasks, nproc,
+                             "precomp_" + processid)
+
     # Print statistics
     checkPath(os.path.split(out)[0])
     fil = open(out, "w")
@@ -382,24 +827,63 @@ def main():
     fil.write("\n")
     fil.write("BUFFER(m)|OSM_IN(m)|OSM_IN(%%)|OSM_OUT(m)|OSM_OUT(%%)|REF_IN(m)"
               "|REF_IN(%%)|REF_OUT(m)|REF_OUT(%%)\n")
-    for p in processed:
-        if type(p) != TupleType or len(p) != 3:
+    fil.flush()
+
+    # Graphs are drawn by another process while the rows arrive
+    if out_graphs:
+        checkPath(out_graphs)
+        q_rows = Queue()
+        renderer = Process(target=render,
+                           args=(q_rows, s_ref, s_osm, out_graphs))
+        renderer.daemon = True
+        renderer.start()
+
+    results = []
+    n_eval = 0
+    while len(list_buff) > 0:
+        instrument.stage("evaluation" if n_eval == 0 else "refinement")
+        for p in evaluate(list_buff):
+            if type(p) != TupleType or len(p) != 5:
+                grass.fatal(_("Some errors occurred during analysis"))
+                return 0
+            results.append(p)
+            fil.write(p[3])
+            fil.flush()
+            if out_graphs:
+                q_rows.put(p[0:3])
+        n_eval += len(list_buff)
+        if len(results) != n_eval:
             grass.fatal(_("Some errors occurred during analysis"))
             return 0
-        l_osm_in.append(p[0])
-        l_ref_in.append(p[1])
-        fil.write(p[2])
-
+        if len(buffer_range) == 0:
+            break
+        # Refine where the curves change fastest, one value per process
+        list_buff = NextBuffers(results, s_osm, s_ref,
+                                min(max(nproc, 1), budget - n_eval),
+                                (b_max - b_min) / 1000.0)
+
+    instrument.stage("output")
+    if len(buffer_range) > 0:
+        knee = FindKnee(results, s_osm, s_ref)
+        fil.write("\n")
+        fil.write("Suggested buffer: {bu} m\n".format(bu=knee))
+        grass.message(_("Suggested buffer for v.osm.preproc: %s") % knee)
+        summary["suggested_buffer"] = knee
     fil.close()
+    results.sort()
+    if out_data:
+        WriteData(out_data, data_format, summary, COLUMNS,
+                  [p[4] for p in results])
     # Remove temporary data
     grass.run_command("g.remove", type="vect", flags="fr",
                       pattern="{st}*".format(st=processid), quiet=True)
     # Graphs
-    checkPath(out_graphs)
     if out_graphs:
-        Plot(list_buff, l_osm_in, l_ref_in, s_ref, s_osm, out_graphs)
+        q_rows.put(None)
+        renderer.join()
+    if profile:
+        instrument.write(profile)
 
 if __name__ == "__main__":
     options, flags = grass.parser()
     sys.exit(main())
-    
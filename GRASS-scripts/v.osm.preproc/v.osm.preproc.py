@@ -58,52 +58,231 @@
 #% required: no
 #%end
 
+#%option
+#% key: method
+#% type: string
+#% options: overlay,memory
+#% description: Matching engine: GRASS overlays of single segments or in-memory matching
+#% answer: overlay
+#% required: no
+#%end
+
+#%option
+#% key: nprocs
+#% type: integer
+#% description: Number of processes for the overlay method
+#% answer: 1
+#% required: no
+#%end
+
 #%option G_OPT_F_OUTPUT
 #% key: out_file
 #% description: Name for output file with statistics (if omitted or "-" output to stdout)
 #% required: no
 #%end
 
+#%option G_OPT_F_OUTPUT
+#% key: checkpoint
+#% description: Name for progress file of the overlay method, to resume interrupted runs
+#% required: no
+#%end
+
+#%option G_OPT_F_OUTPUT
+#% key: cache
+#% description: Name for file with the matches of the run; REF segments far from OSM changes reuse them at the next run
+#% required: no
+#%end
+
+#%option G_OPT_F_OUTPUT
+#% key: profile
+#% description: Name for output JSON file with the time spent in each stage and GRASS module
+#% required: no
+#%end
+
+#%flag
+#% key: r
+#% description: Resume an interrupted run from the checkpoint file
+#%end
+
+import json
 import math
+import os
 import sys
-import shutil
 import time
 import grass.script as grass
-
-def length(data):
-    feat_osm = int(((grass.read_command("v.info", map=data,flags="t",quiet=True)).split("\n")[2]).split("=")[1])
-    if feat_osm>0:
-        length_data = grass.read_command("v.to.db",map=data,option="length",flags="p")
-        s_data=0 
-        l_data = length_data.split("\n")
-        for item in l_data[1:-1]:
-            s_data+=float(item.split("|")[1])         
-    else:
-        s_data=0
-    return s_data
-
-
-def GetCoeff(vect):
-    coord_start = grass.read_command("v.to.db", map=vect, option="start", type="line",flags="p").split("\n")[1]
-    x_start = float(coord_start.split("|")[1])
-    y_start = float(coord_start.split("|")[2])
-    coord_end = grass.read_command("v.to.db", map=vect, option="end", type="line",flags="p").split("\n")[1]   
-    x_end = float(coord_end.split("|")[1])
-    y_end = float(coord_end.split("|")[2])
+from grass.pygrass.utils import set_path
+
+set_path('v.osm', 'libosm',
+         os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from libosm import instrument
+from libosm.geomstats import length, nlines, stamp
+from libosm.pool import run_tasks
+from libosm.segments import min_degree, read_segments, segment_keys, write_segments
+
+## REF features for each chunk and seconds between checkpoints
+CHECKPOINT_CHUNK = 1000
+CHECKPOINT_INTERVAL = 60
+
+
+def SplitLines(vect, output):
+    ## One category and one table row for each segment of two vertices
+    tmp_split = output + "_split"
+    tmp_nocat = output + "_nocat"
+    grass.run_command("v.split",input=vect,output=tmp_split,vertices=2,overwrite=True,quiet=True)
+    grass.run_command("v.category",input=tmp_split,output=tmp_nocat,option="del",cat=-1,overwrite=True,quiet=True)
+    grass.run_command("v.category",input=tmp_nocat,output=output,option="add",overwrite=True,quiet=True)
+    if grass.vector_db(output):
+        grass.run_command("v.db.droptable",map=output,layer=1,flags="f",quiet=True)
+    grass.run_command("v.db.addtable",map=output,quiet=True)
+    grass.run_command("g.remove",type="vect",name="%s,%s"%(tmp_split,tmp_nocat),flags="f",quiet=True)
+
+def GetEnds(vect):
+    ends = {}
+    for option in ("start","end"):
+        coords = grass.read_command("v.to.db", map=vect, option=option, type="line",flags="p").split("\n")[1:]
+        for coord in coords:
+            if coord:
+                c = coord.split("|")
+                ends[c[0]] = ends.get(c[0],()) + (float(c[1]),float(c[2]))
+    return ends
+
+def GetCoeff(ends):
+    x_start, y_start, x_end, y_end = ends
     if (x_end-x_start) <> 0:
         m = (y_end-y_start)/(x_end-x_start)
     else:
         m = 10**9
     return m
 
+def GetAngle(m_ref, m_osm):
+    if 1+m_ref*m_osm == 0:
+        return 90.0
+    return math.degrees(abs(math.atan((m_ref-m_osm)/(1+m_ref*m_osm))))
+
+def MatchMemory(ref_cats, ref_segs, osm, bf, angle_thres, dead_ends, skip=()):
+    ## Accepted pieces by REF segment, except for the segments in skip
+    from libosm.matcher import match
+    import numpy as np
+
+    todo = ~np.isin(ref_cats, np.array(sorted(skip), dtype=int))
+    ref_cats = ref_cats[todo]
+    osm_cats, osm_segs = read_segments(osm)
+    flat = np.isin(ref_cats, np.array(sorted(dead_ends), dtype=int))
+    i_ref, i_osm, pieces = match(ref_segs[todo], osm_segs, bf, angle_thres, flat)
+    matches = {}
+    for cat, piece in zip(ref_cats[i_ref].tolist(), pieces.tolist()):
+        matches.setdefault(cat, []).append(piece)
+    return matches
+
+def CachedMatches(old, ref_cats, ref_segs, ref_keys, osm_keys, bf):
+    ## Accepted pieces of the previous run by REF segment, for the segments
+    ## whose buffer doesn't touch new, changed or deleted OSM segments
+    from libosm.matcher import candidates
+    from libosm.segments import GridIndex
+    import numpy as np
+
+    changed = set(osm_keys).symmetric_difference(old["osm"])
+    changed = np.array([[float(c) for c in key.split()] for key in changed], dtype=float).reshape((-1,4))
+    touched = set()
+    if len(changed) > 0:
+        rows, found = candidates(GridIndex(changed), ref_segs, bf)
+        touched = set(ref_cats[rows].tolist())
+    reused = {}
+    for cat, key in zip(ref_cats.tolist(), ref_keys):
+        if cat not in touched and key in old["matches"]:
+            reused[cat] = old["matches"][key]
+    return reused
+
+def ZOrder(x, y):
+    key = 0
+    for bit in range(16):
+        key |= ((x >> bit) & 1) << (2*bit) | ((y >> bit) & 1) << (2*bit+1)
+    return key
+
+def SpatialChunks(ref, n, size=0, done=()):
+    ## Sort the REF features not yet done along a Z-order curve of their
+    ## midpoints and cut them in n groups of neighbouring features, or more
+    ## groups if needed to have at most size features in each one
+    ends = dict((f,e) for f,e in GetEnds(ref).items() if f not in done)
+    if size:
+        n = max(n, -(-len(ends)//size))
+    if n <= 1 or len(ends) == 0:
+        return [sorted(ends)]
+    mid = dict((f,((e[0]+e[2])/2.,(e[1]+e[3])/2.)) for f,e in ends.items())
+    xmin = min(p[0] for p in mid.values())
+    ymin = min(p[1] for p in mid.values())
+    size = max(max(p[0] for p in mid.values())-xmin,max(p[1] for p in mid.values())-ymin) or 1.
+    scale = (2**16-1)/size
+    list_feature = sorted(mid, key=lambda f: ZOrder(int((mid[f][0]-xmin)*scale),int((mid[f][1]-ymin)*scale)))
+    n = min(n, len(list_feature))
+    return [list_feature[len(list_feature)*k//n:len(list_feature)*(k+1)//n] for k in range(n)]
+
+def match_chunk(args):
+    return args[5], MatchOverlay(*args)
+
+def ReadState(fileName):
+    fil = open(fileName)
+    state = json.load(fil)
+    fil.close()
+    return state
+
+def WriteState(fileName, state):
+    ## Write a new file and move it on the old one, so that a run killed
+    ## while writing leaves the previous checkpoint intact
+    fil = open(fileName+".tmp","w")
+    json.dump(state, fil)
+    fil.close()
+    os.rename(fileName+".tmp", fileName)
+
+def MatchOverlay(ref, osm, bf, angle_thres, dead_ends, list_feature, processid):
+    fdata = "fdata_" + processid
+    fbuffer = "fbuffer_" + processid
+    odata = "odata_" + processid
+
+    ## Accepted OSM subfeatures, by REF feature and subfeature
+    accepted = {}
+
+    ## Angular coefficient Comparison
+    for f in list_feature:
+        grass.run_command("v.extract",input=ref,output=fdata+"_%s"%f,where="cat=%s"%f,overwrite=True,quiet=True) 
+        if int(f) in dead_ends:
+            grass.run_command("v.buffer",input=fdata+"_%s"%f,output=fbuffer+"_%s"%f,flags="c",distance=bf,overwrite=True,quiet=True)
+        else:
+            grass.run_command("v.buffer",input=fdata+"_%s"%f,output=fbuffer+"_%s"%f,distance=bf,overwrite=True,quiet=True)
+
+        grass.run_command("v.overlay",ainput=osm, atype="line",binput=fbuffer+"_%s"%f,output=odata+"_%s"%f,operator="and",overwrite=True,quiet=True)
+        if nlines(odata+"_%s"%f)>0:
+            ## Get REF angular coefficient
+            m_ref = GetCoeff(GetEnds(fdata+"_%s"%f)[f])
+            #print m_ref
+
+            ## Get OSM subfeatures angular coefficient
+            ends = GetEnds(odata+"_%s"%f)
+            for sf in sorted(ends):
+                if GetAngle(m_ref, GetCoeff(ends[sf]))<=angle_thres:
+                    accepted[(f,sf)] = ends[sf]
+        grass.run_command("g.remove", type="vect", name="%s_%s,%s_%s,%s_%s"%(fdata,f,fbuffer,f,odata,f), flags="f",quiet=True)
+
+    return accepted
+
 def main():
     osm = options["osm"]
     ref =  options["ref"]
     bf = options["buffer"]
-    angle_thres = options["angle_thres"]
+    angle_thres = float(options["angle_thres"])
     doug = options["douglas_thres"]
     out = options["output"]
     out_file =  options["out_file"]
+    method = options["method"]
+    nproc = int(options["nprocs"])
+    checkpoint = options["checkpoint"]
+    cache = options["cache"]
+    profile = options["profile"]
+    inputs = {"osm": osm, "ref": ref, "buffer": bf, "angle_thres": options["angle_thres"], "douglas_thres": doug}
+    cache_inputs = {"buffer": bf, "angle_thres": options["angle_thres"], "douglas_thres": doug}
+
+    if profile:
+        instrument.enable()
 
     ## Check if input files exist
     if not grass.find_file(name=osm,element='vector')['file']:
@@ -112,19 +291,33 @@ def main():
     if not grass.find_file(name=ref,element='vector')['file']:
         grass.fatal(_("Vector map <%s> not found") % ref)
 
-    ## Prepare temporary map names
-    processid = str(time.time()).replace(".","_")
+    ## The geometry files of the inputs change every time the maps are written
+    signature = [list(stamp(osm) or []), list(stamp(ref) or [])]
+
+    ## Read progress of the interrupted run
+    state = None
+    if flags["r"]:
+        if not checkpoint:
+            grass.fatal(_("Option <checkpoint> is required to resume a run"))
+        if not os.path.exists(checkpoint):
+            grass.fatal(_("Checkpoint file <%s> not found") % checkpoint)
+        state = ReadState(checkpoint)
+        if state["inputs"] != inputs:
+            grass.fatal(_("Checkpoint file <%s> was written with different inputs") % checkpoint)
+        if state.get("signature") != signature:
+            grass.fatal(_("Input maps changed after checkpoint file <%s> was written") % checkpoint)
+    if checkpoint and method == "memory":
+        grass.warning(_("Option <checkpoint> is used only by the overlay method"))
+
+    ## Prepare temporary map names, the same of the interrupted run if resuming
+    if state:
+        processid = state["processid"]
+    else:
+        processid = str(time.time()).replace(".","_")
     ref_gen = "ref_gen_" + processid
     ref_split = "ref_split_" + processid
     osm_split = "osm_split_" + processid
-    deg_points = "deg_points_" + processid
-    degmin_points = "degmin_points_" + processid
-    ref_degmin = "ref_degmin_" + processid
     patch = "patch_" + processid
-    fdata = "fdata_" + processid
-    fbuffer = "fbuffer_" + processid
-    odata = "odata_" + processid
-    osdata = "osdata_" + processid
     outbuff = "outbuff_" + processid
 
     ## Calculate length original data
@@ -140,91 +333,101 @@ def main():
         grass.fatal(_("No OSM data for comparison"))
 
 
+    instrument.stage("split")
+
     ## Generalize
     if doug:
-        grass.run_command("v.generalize",input=ref,output=ref_gen,method="douglas", threshold=doug,quiet=True)
+        grass.run_command("v.generalize",input=ref,output=ref_gen,method="douglas", threshold=doug,overwrite=True,quiet=True)
         ref = ref_gen
 
     ## Split REF datasets
-    grass.run_command("v.split",input=ref,output=ref_split,vertices=2,quiet=True)   
-    grass.run_command("v.out.ogr",input=ref_split,output="/tmp/%s"%ref_split,flags="s",quiet=True)
-    grass.run_command("g.remove",type="vect",name=ref_split,flags="f",quiet=True)
-    grass.run_command("v.in.ogr",input="/tmp/%s/%s.shp"%(ref_split,ref_split),output=ref_split,quiet=True)
+    SplitLines(ref, ref_split)
     ref = ref_split
-    shutil.rmtree('/tmp/%s/'%ref_split)
 
     ## Split OSM datasets
-    grass.run_command("v.split",input=osm,output=osm_split,vertices=2,quiet=True)
-    grass.run_command("v.out.ogr",input=osm_split,output="/tmp/%s"%osm_split,flags="s",quiet=True)
-    grass.run_command("g.remove",type="vect",name=osm_split,flags="f",quiet=True)
-    grass.run_command("v.in.ogr",input="/tmp/%s/%s.shp"%(osm_split,osm_split),output=osm_split,quiet=True)
+    SplitLines(osm, osm_split)
     osm_orig = osm
     osm = osm_split
-    shutil.rmtree('/tmp/%s/'%osm_split)
-
-    # Calculate degree and extract REF category lines intersecting points with minimum value
-    grass.run_command("v.net.centrality",input=ref, output=deg_points, degree="degree",flags="a",quiet=True)
-    list_values = (grass.read_command("v.db.select",map=deg_points,columns="degree",flags="c",quiet=True)).split("\n")[0:-1]
-    degmin = min(map(float,list_values))
- 
-    grass.run_command("v.extract", input=deg_points, output=degmin_points, where="degree=%s"%degmin,quiet=True)
-    grass.run_command("v.select",ainput=ref,binput=degmin_points,output=ref_degmin,operator="overlap",quiet=True)
-    list_lines = (grass.read_command("v.db.select",map=ref_degmin,columns="cat",flags="c",quiet=True)).split("\n")[0:-1]
-    #print list_lines
-  
-    ## Create new vector map
-    grass.run_command("v.edit",map=patch+"_0_0",tool="create",quiet=True)
-    
-    list_feature = grass.read_command("v.db.select",map=ref,columns="cat",flags="c",quiet=True).split("\n")[0:-1]
-    i=0
-    z=0
-    #print list_feature
-
-    ## Angular coefficient Comparison
-    for f in list_feature:
-        grass.run_command("v.extract",input=ref,output=fdata+"_%s"%f,where="cat=%s"%f,overwrite=True,quiet=True) 
-        if f in list_lines:
-            grass.run_command("v.buffer",input=fdata+"_%s"%f,output=fbuffer+"_%s"%f,flags="c",distance=bf,overwrite=True,quiet=True)
-        else:
-            grass.run_command("v.buffer",input=fdata+"_%s"%f,output=fbuffer+"_%s"%f,distance=bf,overwrite=True,quiet=True)
 
-        grass.run_command("v.overlay",ainput=osm, atype="line",binput=fbuffer+"_%s"%f,output=odata+"_%s"%f,operator="and",overwrite=True,quiet=True)
-        lines = ((grass.read_command("v.info", map=odata+"_%s"%f,flags="t",quiet=True)).split("\n")[2]).split("=")[1]
-        if int(lines)==0:
-            grass.run_command("g.remove", type="vect", name="%s_%s,%s_%s,%s_%s"%(fdata,f,fbuffer,f,odata,f),flags="f",quiet=True)
-        else:
-            ## Get REF angular coefficient
-            list_subfeature = grass.read_command("v.db.select",map=odata+"_%s"%f,columns="cat",flags="c",quiet=True).split("\n")[0:-1]
-            m_ref = GetCoeff(fdata+"_%s"%f)
-            #print m_ref
-
-            ## Get OSM subfeatures angular coefficient
-            for sf in list_subfeature:    
-                grass.run_command("v.extract",input=odata+"_%s"%f,output=osdata+"_%s_%s"%(f,sf),where="cat=%s"%sf,overwrite=True,quiet=True) 
-                m_osm = GetCoeff(osdata+"_%s_%s"%(f,sf))
-    
-                     
-                if math.degrees(abs(math.atan((m_ref-m_osm)/(1+m_ref*m_osm))))<=angle_thres:
-                    grass.run_command("v.patch",input="%s_%s_%s,%s_%s_%s"%(patch,i,z,osdata,f,sf),output=patch+"_%s_%s"%(f,sf),overwrite=True,quiet=True)
-                    grass.run_command("g.remove", type="vect", name="%s_%s_%s,%s_%s_%s"%(patch,i,z,osdata,f,sf), flags="f",quiet=True)
-                    i=f
-                    z=sf
-                else:
-                    grass.run_command("g.remove", type="vect", name=osdata+"_%s_%s"%(f,sf), flags="f",quiet=True)
-            grass.run_command("g.remove", type="vect", name="%s_%s,%s_%s,%s_%s"%(fdata,f,fbuffer,f,odata,f), flags="f",quiet=True)
-
-    ## Clean output map
-    l_map = grass.read_command("g.list",type="vect",quiet=True).split("\n")[0:-1]
-    last_map = [s for s in l_map if "patch" in s]
-    grass.run_command("v.buffer", input=last_map[0],output=outbuff, distance=0.0001,quiet=True)
-    grass.run_command("v.overlay",ainput=osm_orig,atype="line",binput=outbuff,output=out,operator="and",flags="t",quiet=True)
+    # Calculate node degree and find REF segments touching nodes with minimum value
+    instrument.stage("degree")
+    ref_cats, ref_segs = read_segments(ref)
+    dead_ends = min_degree(ref_cats, ref_segs)
+
+    ## Matches of the previous run, by REF segment
+    reused = {}
+    if cache:
+        instrument.stage("cache")
+        ref_keys = [key+("|d" if cat in dead_ends else "") for cat, key in zip(ref_cats.tolist(), segment_keys(ref_segs))]
+        osm_keys = segment_keys(read_segments(osm)[1])
+        if os.path.exists(cache):
+            old = ReadState(cache)
+            if old["inputs"] != cache_inputs:
+                grass.warning(_("Cache file <%s> was written with different parameters, all the segments are matched again") % cache)
+            else:
+                reused = CachedMatches(old, ref_cats, ref_segs, ref_keys, osm_keys, float(bf))
+                grass.message(_("%d REF segments of %d reuse the matches of the previous run") % (len(reused), len(ref_keys)))
+
+    instrument.stage("matching")
+    if method == "memory":
+        ## Angular coefficient Comparison of all segments at once
+        matches = MatchMemory(ref_cats, ref_segs, osm, float(bf), angle_thres, dead_ends, reused)
+    else:
+        ## Angular coefficient Comparison of chunks of neighbouring segments
+        ## Split categories are the same at every run, so the REF features
+        ## already done and their accepted subfeatures can be reused
+        processed = set()
+        accepted = {}
+        if state:
+            processed.update(state["processed"])
+            accepted.update(((f,sf),tuple(e)) for f,sf,e in state["accepted"])
+        mapset = grass.gisenv()['MAPSET']
+        done = processed | set(str(cat) for cat in reused)
+        chunks = SpatialChunks(ref, 4*nproc if nproc > 1 else 1, CHECKPOINT_CHUNK if checkpoint else 0, done)
+        tasks = [(ref+"@"+mapset, osm+"@"+mapset, bf, angle_thres, dead_ends, chunk, processid) for chunk in chunks if chunk]
+        saved = 0
+        for chunk, chunk_accepted in run_tasks(match_chunk, tasks, nproc, "preproc_" + processid):
+            processed.update(chunk)
+            accepted.update(chunk_accepted)
+            if checkpoint and time.time()-saved >= CHECKPOINT_INTERVAL:
+                WriteState(checkpoint, {"processid": processid, "inputs": inputs, "signature": signature, "processed": sorted(processed),
+                                             "accepted": [[f,sf,e] for (f,sf),e in accepted.items()]})
+                saved = time.time()
+        matches = {}
+        for (f,sf),e in sorted(accepted.items()):
+            matches.setdefault(int(f), []).append(e)
+    matches.update(reused)
+    pieces = [piece for cat in sorted(matches) for piece in matches[cat]]
+
+    instrument.stage("clean")
+
+    ## Write the accepted OSM subfeatures at once
+    if pieces:
+        write_segments(patch, pieces)
+
+        ## Clean output map
+        grass.run_command("v.buffer", input=patch,output=outbuff, distance=0.0001,overwrite=True,quiet=True)
+        grass.run_command("v.overlay",ainput=osm_orig,atype="line",binput=outbuff,output=out,operator="and",flags="t",quiet=True)
+        grass.run_command("g.remove",type="vect",name="%s,%s"%(patch,outbuff),flags="f",quiet=True)
+    else:
+        ## No OSM subfeature accepted, the output map is empty
+        grass.warning(_("No OSM segment matches the REF dataset"))
+        grass.run_command("v.edit",map=out,tool="create",quiet=True)
 
     ## Delete all maps
-    grass.run_command("g.remove",type="vect",name="%s,%s,%s,%s,%s,%s,%s"%(deg_points,ref_degmin,degmin_points,ref_gen,ref_split,osm_split,outbuff),flags="f",quiet=True)
+    grass.run_command("g.remove",type="vect",name="%s,%s,%s"%(ref_gen,ref_split,osm_split),flags="f",quiet=True)
+
+    ## Save the matches of every REF segment, also of the unmatched ones
+    if cache:
+        WriteState(cache, {"inputs": cache_inputs, "osm": osm_keys,
+                                "matches": dict((key, [list(e) for e in matches.get(cat, [])]) for cat, key in zip(ref_cats.tolist(), ref_keys))})
 
-    grass.run_command("g.remove",type="vect",name="%s"%last_map[0],flags="f",quiet=True)
+    ## The run is complete, its progress is no longer needed
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
 
     ## Calculate final map statistics
+    instrument.stage("statistics")
     l_osm_proc = length(out)
     diff_osm = l_osm - l_osm_proc
     diff_p_osm = diff_osm/l_osm*100
@@ -248,7 +451,9 @@ def main():
     print("Difference between OSM original and processed datasets length: %s m (%s%%)\n"%(round(diff_osm,1),round(diff_p_osm,1)))
     print("Difference between REF dataset and processed OSM dataset length: %s m (%s%%)\n"%(round(diff_new,1),round(diff_p_new,1)))
     print("#####################################################################\n")
-    
+
+    if profile:
+        instrument.write(profile)
 
 
 if __name__ == "__main__":